@@ -1,18 +1,194 @@
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import json
+import lzma
 import os
+import re
+import shutil
 import subprocess
 import tarfile
+import tempfile
+import threading
+import time
 from pathlib import Path
 from urllib.parse import urlparse
-from ipaddress import IPv4Network
 
 import requests
+import urllib3
+from cloud_init_seed.templates import render_cloud_init_templates
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Size of the blocks images are downloaded, hashed and written in
+download_chunk_size = 1024 * 1024
+
+# Size of the blocks checked for zeros and skipped when writing images, keeping them sparse
+sparse_block_size = 64 * 1024
+
+# Leading bytes identifying the compression of an image archive
+compression_magic = (
+    ('gzip', b'\x1f\x8b'),
+    ('zstd', b'\x28\xb5\x2f\xfd'),
+    ('xz', b'\xfd7zXZ\x00'),
+)
+
+# External decompressors by compression, in order of preference. They run in their own
+# process, next to the tar parsing and writing, and the first ones use several cores:
+# pigz for reading, writing and checking, pzstd for multi-frame zstd and xz for multi-block xz.
+# The gzip command is left out, it decompresses slower than zlib in-process
+decompression_commands = {
+    'gzip': (
+        ['pigz', '-dc'],
+    ),
+    'zstd': (
+        ['pzstd', '-dc', '-p', str(os.cpu_count() or 1)],
+        ['zstd', '-dc'],
+    ),
+    'xz': (
+        ['xz', '-dc', '-T0'],
+    ),
+}
+
+# Directory, within the hypervisor destination directory, holding the image cache
+image_cache_directory_name = '.image_cache'
+
+# Suffix of the complete entries of the image cache
+image_cache_suffix = '.image'
+
+# Directory, within the hypervisor destination directory, holding the base images of linked clones
+image_base_directory = '.image_bases'
+
+# Ways the disk of a VM can be provisioned
+vm_disk_modes = ('full', 'linked')
 
 
 def create_directory(path):
     os.makedirs(path, exist_ok=True)
 
 
-def download_or_retrieve_file(url_or_file):
+def file_sha256(file_path, chunk_size=download_chunk_size):
+    """
+    Compute the SHA-256 of a file, reading it in fixed-size chunks.
+
+    Parameters
+    ----------
+    file_path : str
+        The path of the file to hash.
+    chunk_size : int, optional
+        The number of bytes read at once (default is download_chunk_size).
+
+    Returns
+    -------
+    hashlib._Hash
+        The SHA-256 object holding the digest of the file so far, which can be updated further.
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256
+
+
+def _content_total_length(response, offset):
+    """
+    Return the full size of the file served by a (ranged) response, None when unknown.
+    """
+    content_range = response.headers.get('Content-Range')
+    if response.status_code == 206 and content_range:
+        match = re.match(r'bytes \d+-\d+/(\d+)', content_range)
+        return int(match.group(1)) if match else None
+    content_length = response.headers.get('Content-Length')
+    return offset + int(content_length) if content_length else None
+
+
+def download_file(url, file_name, chunk_size=download_chunk_size, max_retries=5, retry_delay=5, timeout=60):
+    """
+    Stream a file from a URL to disk, resuming interrupted transfers.
+
+    Parameters
+    ----------
+    url : str
+        The HTTP(S) URL of the file.
+    file_name : str
+        The path the file is saved to.
+    chunk_size : int, optional
+        The number of bytes read from the network and written to disk at once
+        (default is download_chunk_size).
+    max_retries : int, optional
+        The number of attempts made before giving up (default is 5).
+    retry_delay : int, optional
+        The delay (in seconds) between attempts (default is 5).
+    timeout : int, optional
+        The connect and read timeout (in seconds) of each request (default is 60).
+
+    Returns
+    -------
+    Tuple[str, str]
+        The absolute path of the downloaded file and its SHA-256 hex digest.
+
+    Raises
+    ------
+    requests.RequestException
+        If the file could not be downloaded within `max_retries` attempts.
+
+    Notes
+    -----
+    The data is written to `<file_name>.part` in chunks of `chunk_size` bytes and hashed
+    while it streams, so memory use does not depend on the size of the file. When a partial
+    file exists, from this or an earlier run, an HTTP Range request asks only for the missing
+    bytes. Servers which ignore the range get the download restarted from the first byte.
+    The partial file is renamed to `file_name` once all bytes have arrived.
+    """
+    part_name = file_name + '.part'
+    offset = os.path.getsize(part_name) if os.path.exists(part_name) else 0
+    sha256 = file_sha256(part_name, chunk_size) if offset else hashlib.sha256()
+
+    for attempt in range(1, max_retries + 1):
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                if offset and response.status_code == 416:
+                    # The partial file already holds every byte
+                    break
+                response.raise_for_status()
+                if offset and response.status_code != 206:
+                    print('Server does not support ranges, restarting download of', url)
+                    offset = 0
+                    sha256 = hashlib.sha256()
+                total_length = _content_total_length(response, offset)
+
+                with open(part_name, 'ab' if offset else 'wb') as file:
+                    for chunk in response.iter_content(chunk_size):
+                        file.write(chunk)
+                        sha256.update(chunk)
+                        offset += len(chunk)
+
+            if total_length is None or offset >= total_length:
+                break
+            raise requests.ConnectionError(
+                f'Connection closed after {offset} of {total_length} bytes',
+            )
+        except requests.RequestException as e:
+            # Client errors will not go away by retrying
+            status_code = getattr(e.response, 'status_code', None)
+            if (status_code is not None and 400 <= status_code < 500) or attempt == max_retries:
+                raise
+            print(f'Download attempt {attempt} failed at byte {offset}: {e}')
+            print(f'Retrying in {retry_delay} seconds...')
+            time.sleep(retry_delay)
+
+    os.replace(part_name, file_name)
+    file_path = os.path.abspath(file_name)
+    print('downloaded:', file_path, 'bytes:', offset, 'sha256:', sha256.hexdigest())
+    return file_path, sha256.hexdigest()
+
+
+def download_or_retrieve_file(url_or_file, expected_sha256=None):
     """
     Download a file from a URL or file path.
 
@@ -20,35 +196,790 @@ def download_or_retrieve_file(url_or_file):
     ----------
     url_or_file : str
         The URL of the file to download or the local file path.
+    expected_sha256 : str, optional
+        The SHA-256 hex digest the file must have (default is None, not checked).
 
     Returns
     -------
     str
         The absolute file path where the downloaded file is saved.
 
+    Raises
+    ------
+    ValueError
+        If `expected_sha256` is given and does not match the file.
+
     Notes
     -----
     This function supports downloading files from HTTP, as well as handling local file paths. The function prints
-    the file path and the source (URL or local file) for logging purposes.
+    the file path and the source (URL or local file) for logging purposes. Downloads are streamed to disk and
+    resumed when interrupted, see `download_file`.
     """
     parsed_url = urlparse(url_or_file)
     if parsed_url.scheme == 'http' or parsed_url.scheme == 'https':
         # HTTP(S) handling
-        response = requests.get(url_or_file)
         file_name = os.path.basename(parsed_url.path)
-        with open(file_name, 'wb') as file:
-            file.write(response.content)
-        file_path = os.path.abspath(file_name)
+        file_path, sha256 = download_file(url_or_file, file_name)
         print('file_path:', file_path, 'from URL')
     else:
         # Local file
         file_path = os.path.abspath(url_or_file)
+        sha256 = file_sha256(file_path).hexdigest() if expected_sha256 else None
         print('file_path:', file_path, 'local file')
 
+    if expected_sha256 and sha256 != expected_sha256.lower():
+        if parsed_url.scheme in ('http', 'https'):
+            os.remove(file_path)
+        raise ValueError(
+            f'SHA-256 mismatch for {url_or_file}: expected {expected_sha256}, got {sha256}',
+        )
+
     return file_path
 
 
-def download_extract_and_rename_qcow2(url_or_file, extract_path, new_qcow_file=None, loc_dir=None):
+def image_cache_directory(hypervisor_dest_directory):
+    """
+    Return the image cache directory of a hypervisor destination directory.
+    """
+    return os.path.join(hypervisor_dest_directory, image_cache_directory_name)
+
+
+def image_cache_key(url, expected_sha256=None, timeout=60):
+    """
+    Compute the image cache key of a URL.
+
+    Parameters
+    ----------
+    url : str
+        The HTTP(S) URL of the image.
+    expected_sha256 : str, optional
+        The SHA-256 hex digest of the image, when known (default is None).
+    timeout : int, optional
+        The timeout (in seconds) of the HEAD request (default is 60).
+
+    Returns
+    -------
+    str or None
+        The cache key, or None when the image cannot be cached.
+
+    Notes
+    -----
+    A supplied checksum identifies the content on its own. Otherwise a HEAD request fetches
+    the ETag or Last-Modified header of the URL, and the key is the SHA-256 of the URL and
+    that validator, so a changed image on the server gets a new key. Without a validator
+    there is no way to tell whether a cached copy is current, so nothing is cached.
+    """
+    if expected_sha256:
+        return 'sha256-' + expected_sha256.lower()
+    try:
+        response = requests.head(url, allow_redirects=True, timeout=timeout)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        print(f'Could not validate {url} for the image cache: {e}')
+        return None
+    validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+    if not validator:
+        print(f'{url} has no ETag or Last-Modified header, it will not be cached')
+        return None
+    return 'url-' + hashlib.sha256(f'{url}\n{validator}'.encode()).hexdigest()
+
+
+def image_cache_evict(cache_dir, max_bytes, keep=()):
+    """
+    Remove the least recently used image cache entries until the cache fits in `max_bytes`.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The directory of the image cache.
+    max_bytes : int
+        The size the cache is allowed to take up.
+    keep : Iterable[str], optional
+        Paths of entries which must not be removed, e.g. the entry in use (default is ()).
+
+    Returns
+    -------
+    list
+        The paths of the removed entries.
+
+    Notes
+    -----
+    Entries are ordered by modification time, which `image_cache_fetch` refreshes on every
+    hit. An entry is only removed under an exclusive lock on its `<key>.pin` file, so entries
+    pinned by a running build are skipped. Partial downloads and lock files are left alone.
+    """
+    keep = {os.path.abspath(path) for path in keep}
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(image_cache_suffix):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, os.path.abspath(entry.path)))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    removed = []
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        if path in keep:
+            continue
+        with open(path[:-len(image_cache_suffix)] + '.pin', 'w') as pin_file:
+            try:
+                fcntl.flock(pin_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print('image cache entry in use:', path)
+                continue
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f'Error evicting {path}: {e}')
+                continue
+        total_bytes -= size
+        removed.append(path)
+        print('image cache evicted:', path)
+    return removed
+
+
+@contextlib.contextmanager
+def image_cache_fetch(url, cache_dir, max_bytes, expected_sha256=None):
+    """
+    Pin a cached copy of an image, downloading it into the cache on a miss.
+
+    Parameters
+    ----------
+    url : str
+        The HTTP(S) URL of the image.
+    cache_dir : str
+        The directory of the image cache.
+    max_bytes : int
+        The size the cache is allowed to take up, older entries are evicted past it.
+    expected_sha256 : str, optional
+        The SHA-256 hex digest the image must have (default is None, not checked).
+
+    Yields
+    ------
+    str or None
+        The path of the cached image, or None when the image cannot be cached (see
+        `image_cache_key`) and has to be downloaded as usual.
+
+    Raises
+    ------
+    ValueError
+        If `expected_sha256` is given and does not match the downloaded image.
+
+    Notes
+    -----
+    Entries are stored as `<key>.image`. An exclusive lock on `<key>.lock` makes VMs built
+    at the same time on one hypervisor wait for a single download of the image rather than
+    fetching it once each. A download interrupted earlier resumes from its `.part` file.
+    A shared lock on `<key>.pin` is held until the context exits, so `image_cache_evict`
+    run by another build cannot remove the entry while it is being extracted.
+    """
+    key = image_cache_key(url, expected_sha256)
+    if key is None:
+        yield None
+        return
+
+    create_directory(cache_dir)
+    entry_path = os.path.join(cache_dir, key + image_cache_suffix)
+    with open(os.path.join(cache_dir, key + '.pin'), 'w') as pin_file:
+        with open(os.path.join(cache_dir, key + '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Pin before looking at the entry, so an eviction in progress finishes first
+            fcntl.flock(pin_file, fcntl.LOCK_SH)
+            if os.path.exists(entry_path):
+                # Refresh the modification time used for the LRU eviction
+                os.utime(entry_path)
+                print('image cache hit:', entry_path)
+            else:
+                print('image cache miss:', entry_path)
+                file_path, sha256 = download_file(url, entry_path)
+                if expected_sha256 and sha256 != expected_sha256.lower():
+                    os.remove(file_path)
+                    raise ValueError(
+                        f'SHA-256 mismatch for {url}: expected {expected_sha256}, got {sha256}',
+                    )
+            image_cache_evict(cache_dir, max_bytes, keep=[entry_path])
+        yield entry_path
+
+
+def image_base_key(archive_path, cache_dir=None, expected_sha256=None):
+    """
+    Compute the key identifying the base image extracted from an archive.
+
+    Parameters
+    ----------
+    archive_path : str
+        The path of the image archive.
+    cache_dir : str, optional
+        The image cache directory (default is None).
+    expected_sha256 : str, optional
+        The SHA-256 hex digest of the archive, when known (default is None).
+
+    Returns
+    -------
+    str
+        The key of the base image.
+
+    Notes
+    -----
+    An archive taken from the image cache reuses its cache key and a known checksum is used
+    as is, otherwise the archive is hashed.
+    """
+    if cache_dir is not None and os.path.dirname(os.path.abspath(archive_path)) == os.path.abspath(cache_dir):
+        return os.path.basename(archive_path)[:-len(image_cache_suffix)]
+    if expected_sha256:
+        return 'sha256-' + expected_sha256.lower()
+    return 'sha256-' + file_sha256(archive_path).hexdigest()
+
+
+def write_sparse(source, file, chunk_size=download_chunk_size, block_size=sparse_block_size):
+    """
+    Copy a stream to a file, seeking over blocks of zeros instead of writing them.
+
+    Parameters
+    ----------
+    source : file-like object
+        The stream to copy, read until it is exhausted.
+    file : file object
+        The file to write, opened in binary mode at offset 0.
+    chunk_size : int, optional
+        The number of bytes read from `source` at once (default is download_chunk_size).
+    block_size : int, optional
+        The size of the blocks checked for zeros (default is sparse_block_size).
+
+    Returns
+    -------
+    int
+        The number of bytes copied.
+
+    Notes
+    -----
+    Skipped blocks become holes in the file, so unallocated regions of the image take no space
+    on disk. The file is truncated to the copied size at the end, which also covers trailing holes.
+    """
+    zero_block = bytes(block_size)
+    size = 0
+    for chunk in iter(lambda: source.read(chunk_size), b''):
+        view = memoryview(chunk)
+        for start in range(0, len(view), block_size):
+            block = view[start:start + block_size]
+            if block == zero_block[:len(block)]:
+                file.seek(len(block), os.SEEK_CUR)
+            else:
+                file.write(block)
+        size += len(chunk)
+    file.truncate(size)
+    return size
+
+
+class PrefixedReader:
+    """
+    File-like object returning bytes already read from a stream before the rest of it.
+
+    Parameters
+    ----------
+    prefix : bytes
+        The bytes read first.
+    fileobj : file-like object
+        The stream the prefix was read from.
+    """
+
+    def __init__(self, prefix, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.fileobj.read(size)
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.fileobj.read(), b''
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        return data
+
+
+def detect_compression(fileobj):
+    """
+    Detect the compression of a stream from its magic bytes.
+
+    Parameters
+    ----------
+    fileobj : file-like object
+        The stream to inspect.
+
+    Returns
+    -------
+    Tuple[str or None, PrefixedReader]
+        The compression, one of 'gzip', 'zstd' and 'xz' or None when the stream is not
+        compressed, and a reader returning the whole stream, inspected bytes included.
+    """
+    prefix = b''
+    while len(prefix) < 6:
+        data = fileobj.read(6 - len(prefix))
+        if not data:
+            break
+        prefix += data
+    compression = next((name for name, magic in compression_magic if prefix.startswith(magic)), None)
+    return compression, PrefixedReader(prefix, fileobj)
+
+
+def _feed_process(source, process, errors, chunk_size=download_chunk_size):
+    """
+    Write a stream to the standard input of a process, storing any error in `errors`.
+    """
+    try:
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            process.stdin.write(chunk)
+    except BrokenPipeError:
+        # The decompressor stopped reading, its exit code tells why
+        pass
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def _drain_stream(stream, tail, limit=64 * 1024):
+    """
+    Read a stream to its end, keeping its last `limit` bytes in the bytearray `tail`.
+    """
+    for chunk in iter(lambda: stream.read(limit), b''):
+        tail += chunk
+        del tail[:-limit]
+
+
+@contextlib.contextmanager
+def decompressed_stream(fileobj):
+    """
+    Decompress a stream with the fastest decompressor available for its compression.
+
+    Parameters
+    ----------
+    fileobj : file-like object
+        The stream to decompress, compressed with gzip, zstd or xz, or not at all.
+
+    Yields
+    ------
+    file-like object
+        The decompressed stream.
+
+    Raises
+    ------
+    RuntimeError
+        If the external decompressor fails, or zstd compression is found without a zstd
+        command or the optional zstandard module.
+
+    Notes
+    -----
+    The compression is detected from the magic bytes (see `detect_compression`) and the
+    first command of `decompression_commands` found on the hypervisor decompresses it in a
+    separate process, fed from a thread and with its stderr drained by another one. Without
+    one the standard library, or zstandard for zstd, decompresses in-process. `fileobj` is
+    always read to its end, so a `HashingReader` around it sees every byte.
+    """
+    compression, source = detect_compression(fileobj)
+    if compression is None:
+        yield source
+        return
+
+    command = next(
+        (command for command in decompression_commands.get(compression, ()) if shutil.which(command[0])),
+        None,
+    )
+    print('compression:', compression, 'decompressor:', ' '.join(command) if command else 'in-process')
+    if command is None:
+        if compression == 'gzip':
+            yield gzip.GzipFile(fileobj=source, mode='rb')
+        elif compression == 'xz':
+            yield lzma.LZMAFile(source)
+        elif zstandard is not None:
+            yield zstandard.ZstdDecompressor().stream_reader(source, read_across_frames=True)
+        else:
+            raise RuntimeError('zstd image archives need the zstd command or the zstandard module')
+        while source.read(download_chunk_size):
+            pass
+        return
+
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    errors = []
+    feeder = threading.Thread(target=_feed_process, args=(source, process, errors), daemon=True)
+    feeder.start()
+    stderr_tail = bytearray()
+    drainer = threading.Thread(target=_drain_stream, args=(process.stderr, stderr_tail), daemon=True)
+    drainer.start()
+    try:
+        yield process.stdout
+        # Let the decompressor consume all of its input, e.g. padding after the tar archive
+        while process.stdout.read(download_chunk_size):
+            pass
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    finally:
+        process.stdout.close()
+    return_code = process.wait()
+    feeder.join()
+    drainer.join()
+    process.stderr.close()
+    stderr = stderr_tail.decode(errors='replace').strip()
+    if errors:
+        raise errors[0]
+    if return_code != 0:
+        raise RuntimeError(f'{command[0]} exited with {return_code}: {stderr}')
+
+
+def stream_extract_qcow2(fileobj, extract_path, qcow2_name=None):
+    """
+    Extract the image of a tar archive read as a stream.
+
+    Parameters
+    ----------
+    fileobj : file-like object
+        The archive, compressed with gzip, zstd or xz or not at all, read sequentially.
+    extract_path : str
+        The directory to write the image in.
+    qcow2_name : str, optional
+        The file name of the image (default is None, the name of the archive member).
+
+    Returns
+    -------
+    str
+        The path of the extracted image.
+
+    Raises
+    ------
+    ValueError
+        If the archive contains no regular file.
+
+    Notes
+    -----
+    The archive is decompressed (see `decompressed_stream`) and read in a single pass and the
+    first regular file is written straight to its final name, see `write_sparse`. Any further
+    members are skipped.
+    """
+    create_directory(extract_path)
+    qcow2_file = None
+    with decompressed_stream(fileobj) as stream, tarfile.open(fileobj=stream, mode='r|', bufsize=download_chunk_size) as tar:
+        for member in tar:
+            print('member', member)
+            if not member.isfile():
+                continue
+            if qcow2_file is not None:
+                print('skipping additional member', member.name)
+                continue
+            qcow2_file = os.path.join(extract_path, qcow2_name or os.path.basename(member.name))
+            try:
+                with open(qcow2_file, 'wb') as file:
+                    size = write_sparse(tar.extractfile(member), file)
+            except BaseException:
+                os.remove(qcow2_file)
+                raise
+            print('qcow2_file:', qcow2_file, 'bytes:', size)
+    if qcow2_file is None:
+        raise ValueError('The archive does not contain an image')
+    return qcow2_file
+
+
+def extract_qcow2(archive_path, extract_path, qcow2_name=None):
+    """
+    Extract the qcow2 image of an archive file, see `stream_extract_qcow2`.
+    """
+    with open(archive_path, 'rb') as archive:
+        return stream_extract_qcow2(archive, extract_path, qcow2_name)
+
+
+class HashingReader:
+    """
+    File-like wrapper hashing the bytes read from a stream.
+
+    Parameters
+    ----------
+    fileobj : file-like object
+        The stream to read.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        return data
+
+    def hexdigest(self, chunk_size=download_chunk_size):
+        """
+        Read the rest of the stream, e.g. the padding after the end of a tar archive, and return its SHA-256.
+        """
+        while self.read(chunk_size):
+            pass
+        return self.sha256.hexdigest()
+
+
+class HTTPStreamReader:
+    """
+    File-like object reading a URL, resuming with Range requests when the connection drops.
+
+    Parameters
+    ----------
+    url : str
+        The HTTP(S) URL to read.
+    max_retries : int, optional
+        The number of consecutive failed attempts before giving up (default is 5).
+    retry_delay : int, optional
+        The delay (in seconds) between attempts (default is 5).
+    timeout : int, optional
+        The connect and read timeout (in seconds) of each request (default is 60).
+
+    Notes
+    -----
+    Bytes already handed to the reader cannot be taken back, so a server ignoring the Range
+    request after the first byte fails the read instead of restarting the download.
+    """
+
+    def __init__(self, url, max_retries=5, retry_delay=5, timeout=60):
+        self.url = url
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.offset = 0
+        self.total_length = None
+        self.response = None
+
+    def _open(self):
+        headers = {'Range': f'bytes={self.offset}-'} if self.offset else {}
+        response = requests.get(self.url, headers=headers, stream=True, timeout=self.timeout)
+        response.raise_for_status()
+        if self.offset and response.status_code != 206:
+            response.close()
+            raise ValueError(f'{self.url} does not support ranges, the stream cannot be resumed')
+        self.total_length = _content_total_length(response, self.offset)
+        response.raw.decode_content = True
+        self.response = response
+
+    def read(self, size=-1):
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                if self.response is None:
+                    self._open()
+                data = self.response.raw.read(size if size >= 0 else None)
+                if data or self.total_length is None or self.offset >= self.total_length:
+                    self.offset += len(data)
+                    return data
+                raise requests.ConnectionError(
+                    f'Connection closed after {self.offset} of {self.total_length} bytes',
+                )
+            except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+                self.close()
+                # Client errors will not go away by retrying
+                status_code = getattr(getattr(e, 'response', None), 'status_code', None)
+                if (status_code is not None and 400 <= status_code < 500) or attempt == self.max_retries:
+                    raise
+                print(f'Download attempt {attempt} failed at byte {self.offset}: {e}')
+                print(f'Retrying in {self.retry_delay} seconds...')
+                time.sleep(self.retry_delay)
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+            self.response = None
+
+
+def stream_qcow2(url_or_file, extract_path, qcow2_name=None, expected_sha256=None):
+    """
+    Decompress an image archive from a URL or file straight into its qcow2 file.
+
+    Parameters
+    ----------
+    url_or_file : str
+        The URL or file path of the archive.
+    extract_path : str
+        The directory to write the image in.
+    qcow2_name : str, optional
+        The file name of the image (default is None, the name of the archive member).
+    expected_sha256 : str, optional
+        The SHA-256 hex digest the archive must have (default is None, not checked).
+
+    Returns
+    -------
+    str
+        The path of the extracted image.
+
+    Raises
+    ------
+    ValueError
+        If `expected_sha256` is given and does not match the archive, the image is removed.
+
+    Notes
+    -----
+    Downloads are never written to disk as an archive: the network stream is hashed,
+    decompressed and written as the image in one pass (see `stream_extract_qcow2`), and
+    resumed where it stopped if the connection drops (see `HTTPStreamReader`).
+    """
+    if urlparse(url_or_file).scheme in ('http', 'https'):
+        print('streaming:', url_or_file)
+        source = HTTPStreamReader(url_or_file)
+    else:
+        print('file_path:', os.path.abspath(url_or_file), 'local file')
+        source = open(url_or_file, 'rb')
+    try:
+        reader = HashingReader(source)
+        qcow2_file = stream_extract_qcow2(reader, extract_path, qcow2_name)
+        sha256 = reader.hexdigest()
+    finally:
+        source.close()
+    print('sha256:', sha256)
+
+    if expected_sha256 and sha256 != expected_sha256.lower():
+        os.remove(qcow2_file)
+        raise ValueError(
+            f'SHA-256 mismatch for {url_or_file}: expected {expected_sha256}, got {sha256}',
+        )
+    return qcow2_file
+
+
+def image_base_fetch(archive_path, base_dir, key):
+    """
+    Return the read-only base image of an archive, extracting it on first use.
+
+    Parameters
+    ----------
+    archive_path : str
+        The path of the image archive.
+    base_dir : str
+        The directory holding the base images.
+    key : str
+        The key of the base image, see `image_base_key`.
+
+    Returns
+    -------
+    str
+        The path of the base image, `<base_dir>/<key>.qcow2`.
+
+    Notes
+    -----
+    The image is extracted into a temporary directory and moved into place once complete,
+    under an exclusive lock on `<key>.lock` so VMs built at the same time share a single
+    extraction. Base images are backing files of the VM overlays and are never removed here.
+    """
+    create_directory(base_dir)
+    base_path = os.path.join(base_dir, key + '.qcow2')
+    with open(os.path.join(base_dir, key + '.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if os.path.exists(base_path):
+            print('base image found:', base_path)
+            return base_path
+        temp_dir = tempfile.mkdtemp(dir=base_dir)
+        try:
+            image_path = extract_qcow2(archive_path, temp_dir, 'base.qcow2')
+            os.chmod(image_path, 0o444)
+            os.replace(image_path, base_path)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    print('base image extracted:', base_path)
+    return base_path
+
+
+def create_linked_clone(base_path, overlay_path):
+    """
+    Create a qcow2 overlay backed by a base image.
+
+    Parameters
+    ----------
+    base_path : str
+        The path of the base qcow2 image.
+    overlay_path : str
+        The path of the overlay to create.
+
+    Returns
+    -------
+    str
+        The path of the overlay.
+
+    Raises
+    ------
+    RuntimeError
+        If `qemu-img` fails to create the overlay.
+    """
+    command = [
+        'qemu-img', 'create', '-f', 'qcow2', '-F', 'qcow2',
+        '-b', os.path.abspath(base_path), overlay_path,
+    ]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'qemu-img failed to create {overlay_path}: {result.stderr.strip()}')
+    print('linked clone created:', overlay_path, 'backing file:', base_path)
+    return overlay_path
+
+
+def qcow2_backing_file(qcow2_path):
+    """
+    Return the backing file of a qcow2 image, None when it has none.
+    """
+    result = subprocess.run(
+        ['qemu-img', 'info', '--output=json', qcow2_path], capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f'qemu-img failed to inspect {qcow2_path}: {result.stderr.strip()}')
+    info = json.loads(result.stdout)
+    return info.get('full-backing-filename') or info.get('backing-filename')
+
+
+def copy_sparse(source_path, destination_path):
+    """
+    Copy an image, keeping its holes and zero blocks sparse (see `write_sparse`).
+
+    Parameters
+    ----------
+    source_path : str
+        The path of the image to copy.
+    destination_path : str
+        The path of the copy.
+
+    Returns
+    -------
+    str
+        The path of the copy.
+    """
+    with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+        size = write_sparse(source, destination)
+    print('copied:', source_path, 'to:', destination_path, 'bytes:', size)
+    return destination_path
+
+
+def clone_qcow2(source_qcow2, extract_path, qcow2_name, disk_mode='full'):
+    """
+    Give a VM its own disk from the disk of another VM using the same image, before either boots.
+
+    Parameters
+    ----------
+    source_qcow2 : str
+        The disk provisioned for the other VM by `download_extract_and_rename_qcow2`.
+    extract_path : str
+        The directory of the new disk.
+    qcow2_name : str
+        The file name of the new disk.
+    disk_mode : str, optional
+        'full' copies the disk, 'linked' creates an overlay on the base image the source disk
+        is backed by (default is 'full').
+
+    Returns
+    -------
+    str
+        The path of the new disk.
+    """
+    create_directory(extract_path)
+    qcow2_file = os.path.join(extract_path, qcow2_name)
+    if disk_mode == 'linked':
+        return create_linked_clone(qcow2_backing_file(source_qcow2), qcow2_file)
+    return copy_sparse(source_qcow2, qcow2_file)
+
+
+def download_extract_and_rename_qcow2(url_or_file, extract_path, new_qcow_file=None, loc_dir=None, expected_sha256=None, cache_max_bytes=None, disk_mode='full'):
     """
     Download, extract, and optionally rename a qcow2 file.
 
@@ -62,50 +993,72 @@ def download_extract_and_rename_qcow2(url_or_file, extract_path, new_qcow_file=N
         The new name for the qcow2 file (default is None).
     loc_dir : str, optional
         The directory within the extracted path where the qcow2 file will be placed (default is None).
+    expected_sha256 : str, optional
+        The SHA-256 hex digest the downloaded archive must have (default is None, not checked).
+    cache_max_bytes : int, optional
+        The size of the image cache kept in `<extract_path>/.image_cache` (default is None,
+        images are not cached).
+    disk_mode : str, optional
+        'full' to extract a standalone copy of the image for the VM, or 'linked' to create a
+        qcow2 overlay backed by a shared base image (default is 'full').
 
     Returns
     -------
-    Tuple[str, Path, str]
-        A tuple containing the path of the qcow2 file, the extraction path, and the file path of the downloaded file.
+    Tuple[str, Path, str or None]
+        A tuple containing the path of the qcow2 file, the extraction path, and the file path of the archive, None
+        when it was streamed from a URL and never stored.
 
     Notes
     -----
     This function downloads a qcow2 file from a URL or uses a file path if provided. It extracts the contents of the qcow2
-    file to the specified extraction path. If a new name is specified, it renames the qcow2 file accordingly. The function
-    returns a tuple containing the path of the qcow2 file, the extraction path, and the file path of the downloaded file.
+    file to the specified extraction path, under the new name if one is specified. The function returns a tuple
+    containing the path of the qcow2 file, the extraction path, and the file path of the archive. In 'full' mode
+    the archive is decompressed in a single pass straight into the qcow2 file (see `stream_qcow2`). With `cache_max_bytes`, images from a URL are kept in the image cache (see `image_cache_fetch`) and the returned
+    file path points into the cache. In 'linked' mode the image is extracted once into `<extract_path>/.image_bases`
+    and the VM only gets a thin overlay (see `image_base_fetch` and `create_linked_clone`).
     """
+    if disk_mode not in vm_disk_modes:
+        raise ValueError(f'Unknown disk mode {disk_mode}, expected one of {vm_disk_modes}')
+    dest_directory = extract_path
 
     # Example usage:
     # url_or_file = "http://example.com/sample.txt"
-    file_path = download_or_retrieve_file(url_or_file)
+    if loc_dir:
+        extract_path = os.path.join(extract_path, loc_dir)
+    qcow2_name = new_qcow_file + '.qcow2' if new_qcow_file else None
 
-    # extract the file to the extract_path
-    with tarfile.open(file_path, 'r:gz') as tar:
-        for member in tar.getmembers():
-            print('member', member)
-            # Ensures there is not a race condition on the machine
-            extract_path = extract_path + '/' + loc_dir
-            create_directory(extract_path)
-            tar.extractall(path=extract_path, members=[member])
-    print('extract_path: ', extract_path)
-
-    qcow2_file = os.path.join(extract_path, member.name)
-    print('qcow2_file: ', qcow2_file)
-
-    if new_qcow_file:
-        new_qcow_file = new_qcow_file + '.qcow2'
-
-    # rename the qcow2 file if a new name is specified
-    if qcow2_file is not None and new_qcow_file is not None:
-        new_qcow2_file = os.path.join(
-            os.path.dirname(qcow2_file), new_qcow_file,
-        )
-        os.rename(qcow2_file, new_qcow2_file)
-        qcow2_file = new_qcow2_file
-        print('qcow2_file new name: ', qcow2_file)
+    with contextlib.ExitStack() as stack:
+        file_path = None
+        if cache_max_bytes is not None and urlparse(url_or_file).scheme in ('http', 'https'):
+            # Keep the cache entry pinned until the image is extracted from it
+            file_path = stack.enter_context(image_cache_fetch(
+                url_or_file, image_cache_directory(dest_directory), cache_max_bytes, expected_sha256,
+            ))
 
-    # return the directory of the qcow2 file
-    return (qcow2_file if qcow2_file is not None else None, Path(extract_path), file_path)
+        if disk_mode == 'full':
+            if file_path is None:
+                # Nothing to keep, decompress straight from the source
+                qcow2_file = stream_qcow2(url_or_file, extract_path, qcow2_name, expected_sha256)
+                if urlparse(url_or_file).scheme not in ('http', 'https'):
+                    file_path = os.path.abspath(url_or_file)
+            else:
+                qcow2_file = extract_qcow2(file_path, extract_path, qcow2_name)
+            print('extract_path: ', extract_path)
+            return (qcow2_file, Path(extract_path), file_path)
+
+        if file_path is None:
+            file_path = download_or_retrieve_file(url_or_file, expected_sha256)
+        base_path = image_base_fetch(
+            file_path,
+            os.path.join(dest_directory, image_base_directory),
+            image_base_key(file_path, image_cache_directory(dest_directory), expected_sha256),
+        )
+        create_directory(extract_path)
+        qcow2_file = os.path.join(
+            extract_path, qcow2_name or os.path.basename(base_path),
+        )
+        create_linked_clone(base_path, qcow2_file)
+        return (qcow2_file, Path(extract_path), file_path)
 
 
 def generate_cloud_init_files(
@@ -162,92 +1115,20 @@ def generate_cloud_init_files(
     settings. The generated user data template is written to the specified `cloud_init_user_data_output` file,
     while the metadata template containing only the hostname is written to the `cloud_init_meta_data_output` file.
     """
-    # Convert netmask to CIDR notation for nmcli
-    if vm_ip_netmask is not None:
-        netmask_len = len(vm_ip_netmask.split('.'))
-        if netmask_len == 1 and len(vm_ip_netmask.split('/')) == 1:
-            vm_ip_netmask = f"/{vm_ip_netmask}"
-        if netmask_len == 4:
-            vm_ip_netmask = "/" + str(IPv4Network(f'0.0.0.0/{vm_ip_netmask}').prefixlen)
-    else:
-        vm_ip_netmask = ""
-
-    cloud_init_user_data_template = '''#cloud-config
-user: {}
-password: "{}"
-chpasswd: {{expire: False}}
-ssh_pwauth: True
-runcmd:
-- hostnamectl set-hostname {}
-'''.format(vm_username, vm_hashed_password, vm_hostname)
-
-    if vm_static_ip_address:
-        cloud_init_user_data_template += f"- set -x; nmcli connection modify eth0 ipv4.method manual ipv4.addresses '{vm_static_ip_address}{vm_ip_netmask}'\n"
-
-    if vm_ip_gateway:
-        cloud_init_user_data_template += f"- set -x; nmcli connection modify eth0 ipv4.gateway '{vm_ip_gateway}'\n"
-
-    if vm_dns_server_1:
-        cloud_init_user_data_template += (
-            f"- set -x; nmcli connection modify eth0 ipv4.dns '{vm_dns_server_1}'\n"
-        )
-
-    if vm_dns_server_2:
-        cloud_init_user_data_template += (
-            f"- set -x; nmcli connection modify eth0 +ipv4.dns '{vm_dns_server_2}'\n"
-        )
-
-    if vm_nameserver:
-            cloud_init_user_data_template += (
-                f"- set -x; nmcli connection modify eth0 ipv4.dns-search '{vm_nameserver}'\n"
-            )
-
-    # Restart the network to apply the changes
-    cloud_init_user_data_template += (
-        f"- set -x; if uname -a | grep el7; then systemctl restart network; else systemctl restart NetworkManager ; fi\n"
+    cloud_init_user_data_template, cloud_init_meta_data_template = render_cloud_init_templates(
+        vm_username, vm_hashed_password, vm_hostname, vm_static_ip_address, vm_ip_gateway,
+        vm_ip_netmask, vm_dns_server_1, vm_dns_server_2, vm_nameserver,
     )
 
     # Write the cloud_init_user_data_template to the specified output file
     with open(cloud_init_user_data_output, 'w') as output_file:
         output_file.write(cloud_init_user_data_template)
 
-    cloud_init_meta_data_template = f'hostname: {vm_hostname}'
-
     # Write the cloud_init_meta_data_template to the specified output file
     with open(cloud_init_meta_data_output, 'w') as output_file:
         output_file.write(cloud_init_meta_data_template)
 
 
-def generate_cloud_init_iso(cloud_init_iso_name, user_data_directory, meta_data_directory):
-    """
-    Generate a cloud-init ISO image.
-
-    Parameters
-    ----------
-    cloud_init_iso_name : str
-        The name of the cloud-init ISO image to generate.
-    user_data_directory : str
-        The directory containing the user data file.
-    meta_data_directory : str
-        The directory containing the metadata file.
-
-    Returns
-    -------
-    None
-
-    Notes
-    -----
-    This function generates a cloud-init ISO image using the `genisoimage` command-line tool.
-    It combines the user data and metadata files from the specified directories into the ISO image.
-    The generated ISO image is saved with the provided `cloud_init_iso_name`.
-    """
-    command = [
-        'genisoimage', '-output', cloud_init_iso_name, '-volid',
-        'cidata', '-joliet', '-rock', user_data_directory, meta_data_directory,
-    ]
-    subprocess.run(command)
-
-
 def clean_up_sensitive_info(files_to_delete: list):
     """
     Delete sensitive files from the system.
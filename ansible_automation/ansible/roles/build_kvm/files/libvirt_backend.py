@@ -0,0 +1,248 @@
+import xml.etree.ElementTree as ET
+
+try:
+    import libvirt
+except ImportError:
+    libvirt = None
+
+# Connection used for the VMs of the hypervisor, test:///default runs against libvirt's in-memory test driver
+libvirt_uri = 'qemu:///system'
+
+# Domain type per libvirt driver, drivers not listed use kvm
+libvirt_domain_types = {
+    'test': 'test',
+}
+
+
+def open_connection(uri=libvirt_uri):
+    """
+    Open a connection to libvirt.
+
+    Parameters
+    ----------
+    uri : str, optional
+        The libvirt connection URI (default is libvirt_uri).
+
+    Returns
+    -------
+    libvirt.virConnect
+        The connection, to be closed with `close()`.
+
+    Raises
+    ------
+    RuntimeError
+        If the libvirt Python bindings are not installed.
+    """
+    if libvirt is None:
+        raise RuntimeError('The libvirt backend needs the libvirt Python bindings (python3-libvirt)')
+    return libvirt.open(uri)
+
+
+def domain_type(uri):
+    """
+    Return the domain type matching the driver of a libvirt connection URI.
+    """
+    return libvirt_domain_types.get(uri.split(':', 1)[0].split('+', 1)[0], 'kvm')
+
+
+def _cpu_element(cpu):
+    """
+    Translate a virt-install `--cpu` value into the cpu element of the domain XML.
+    """
+    if cpu in ('host', 'host-model'):
+        return ET.Element('cpu', mode='host-model')
+    if cpu == 'host-passthrough':
+        return ET.Element('cpu', mode='host-passthrough')
+    element = ET.Element('cpu', mode='custom', match='exact')
+    ET.SubElement(element, 'model', fallback='allow').text = cpu
+    return element
+
+
+def _interface_element(interface_type, source, model, source_mode='bridge'):
+    """
+    Build the interface element of a network attached to a bridge, a libvirt network or a host device.
+    """
+    element = ET.Element('interface', type=interface_type)
+    if interface_type == 'direct':
+        ET.SubElement(element, 'source', dev=source, mode=source_mode)
+    elif interface_type == 'network':
+        ET.SubElement(element, 'source', network=source)
+    elif interface_type == 'bridge':
+        ET.SubElement(element, 'source', bridge=source)
+    else:
+        raise ValueError(f'Unsupported network type {interface_type}')
+    ET.SubElement(element, 'model', type=model)
+    return element
+
+
+def domain_xml(
+        name,
+        vcpus,
+        memory,
+        disk,
+        bridges,
+        cdrom=None,
+        boot='hd,cdrom',
+        cpu='host',
+        model='virtio',
+        network=None,
+        virt_type='kvm',
+        smbios_serial=None,
+):
+    """
+    Generate the libvirt XML of a VM.
+
+    Parameters
+    ----------
+    name : str
+        The name of the domain.
+    vcpus : int
+        The number of virtual CPUs.
+    memory : int
+        The memory of the VM in MiB.
+    disk : str
+        The path of the qcow2 disk image.
+    bridges : Iterable[str]
+        The bridges a network interface is attached to, in order.
+    cdrom : str, optional
+        The path of an ISO attached as a read-only cdrom, e.g. the cloud-init seed (default is None).
+    boot : str, optional
+        The boot devices in order, as given to virt-install `--boot` (default is 'hd,cdrom').
+    cpu : str, optional
+        The CPU model, as given to virt-install `--cpu` (default is 'host').
+    model : str, optional
+        The model of the network interfaces (default is 'virtio').
+    network : Tuple[str, str, str], optional
+        The type ('direct', 'bridge' or 'network'), source and source mode of a network
+        interface added before the bridges (default is None).
+    virt_type : str, optional
+        The domain type, see `domain_type` (default is 'kvm').
+    smbios_serial : str, optional
+        The SMBIOS system serial, e.g. a `ds=nocloud-net;s=<url>` cloud-init seed (default is None).
+
+    Returns
+    -------
+    str
+        The domain XML.
+
+    Notes
+    -----
+    The devices match what `virt-install --import` creates for the vETO: a virtio disk, a
+    SATA cdrom, virtio network interfaces, a serial console and VNC graphics on localhost.
+    No libosinfo lookup is made, the OS variant only changes the defaults of virt-install.
+    """
+    domain = ET.Element('domain', type=virt_type)
+    ET.SubElement(domain, 'name').text = name
+    ET.SubElement(domain, 'memory', unit='MiB').text = str(memory)
+    ET.SubElement(domain, 'currentMemory', unit='MiB').text = str(memory)
+    ET.SubElement(domain, 'vcpu', placement='static').text = str(vcpus)
+
+    if smbios_serial:
+        sysinfo = ET.SubElement(domain, 'sysinfo', type='smbios')
+        ET.SubElement(ET.SubElement(sysinfo, 'system'), 'entry', name='serial').text = smbios_serial
+
+    os_element = ET.SubElement(domain, 'os')
+    ET.SubElement(os_element, 'type', arch='x86_64').text = 'hvm'
+    for device in boot.split(','):
+        ET.SubElement(os_element, 'boot', dev=device.strip())
+    if smbios_serial:
+        ET.SubElement(os_element, 'smbios', mode='sysinfo')
+
+    features = ET.SubElement(domain, 'features')
+    ET.SubElement(features, 'acpi')
+    ET.SubElement(features, 'apic')
+    if virt_type != 'test':
+        domain.append(_cpu_element(cpu))
+    ET.SubElement(domain, 'clock', offset='utc')
+    ET.SubElement(domain, 'on_poweroff').text = 'destroy'
+    ET.SubElement(domain, 'on_reboot').text = 'restart'
+    ET.SubElement(domain, 'on_crash').text = 'destroy'
+
+    devices = ET.SubElement(domain, 'devices')
+    disk_element = ET.SubElement(devices, 'disk', type='file', device='disk')
+    ET.SubElement(disk_element, 'driver', name='qemu', type='qcow2')
+    ET.SubElement(disk_element, 'source', file=disk)
+    ET.SubElement(disk_element, 'target', dev='vda', bus='virtio')
+    if cdrom:
+        cdrom_element = ET.SubElement(devices, 'disk', type='file', device='cdrom')
+        ET.SubElement(cdrom_element, 'driver', name='qemu', type='raw')
+        ET.SubElement(cdrom_element, 'source', file=cdrom)
+        ET.SubElement(cdrom_element, 'target', dev='sda', bus='sata')
+        ET.SubElement(cdrom_element, 'readonly')
+
+    if network is not None:
+        devices.append(_interface_element(network[0], network[1], model, network[2]))
+    for bridge in bridges:
+        devices.append(_interface_element('bridge', bridge, model))
+
+    serial = ET.SubElement(devices, 'serial', type='pty')
+    ET.SubElement(serial, 'target', port='0')
+    console = ET.SubElement(devices, 'console', type='pty')
+    ET.SubElement(console, 'target', type='serial', port='0')
+    if virt_type != 'test':
+        ET.SubElement(devices, 'graphics', type='vnc', port='-1', autoport='yes', listen='127.0.0.1')
+        video = ET.SubElement(devices, 'video')
+        ET.SubElement(video, 'model', type='vga')
+        ET.SubElement(devices, 'memballoon', model='virtio')
+    return ET.tostring(domain, encoding='unicode')
+
+
+def define_and_start(connection, xml, autostart=True):
+    """
+    Define a domain from its XML and start it.
+
+    Parameters
+    ----------
+    connection : libvirt.virConnect
+        The libvirt connection, see `open_connection`.
+    xml : str
+        The domain XML, see `domain_xml`.
+    autostart : bool, optional
+        Whether the domain starts with the hypervisor (default is True).
+
+    Returns
+    -------
+    libvirt.virDomain
+        The running domain.
+
+    Raises
+    ------
+    libvirt.libvirtError
+        If libvirt rejects the XML or cannot start the domain. A domain which was defined but
+        failed to start is undefined again.
+    """
+    domain = connection.defineXML(xml)
+    try:
+        domain.create()
+    except libvirt.libvirtError:
+        domain.undefine()
+        raise
+    if autostart:
+        domain.setAutostart(1)
+    print('domain started:', domain.name())
+    return domain
+
+
+def create_domains(xmls, uri=libvirt_uri, autostart=True):
+    """
+    Define and start several domains over a single libvirt connection.
+
+    Parameters
+    ----------
+    xmls : Iterable[str]
+        The domain XMLs, see `domain_xml`.
+    uri : str, optional
+        The libvirt connection URI (default is libvirt_uri).
+    autostart : bool, optional
+        Whether the domains start with the hypervisor (default is True).
+
+    Returns
+    -------
+    list
+        The names of the started domains, in order.
+    """
+    connection = open_connection(uri)
+    try:
+        return [define_and_start(connection, xml, autostart).name() for xml in xmls]
+    finally:
+        connection.close()
@@ -1,24 +1,72 @@
 import argparse
+import json
 import os
 import subprocess
+import sys
 from pathlib import Path
 
+from cloud_init_seed.iso9660 import write_cloud_init_iso
+from cloud_init_seed.templates import render_cloud_init_templates
 from helpers import clean_up_sensitive_info
+from helpers import clone_qcow2
 from helpers import download_extract_and_rename_qcow2
-from helpers import generate_cloud_init_files
-from helpers import generate_cloud_init_iso
+from helpers import image_cache_directory
+from helpers import vm_disk_modes
+from libvirt_backend import create_domains
+from libvirt_backend import define_and_start
+from libvirt_backend import domain_type
+from libvirt_backend import domain_xml
+from libvirt_backend import libvirt_uri
+from libvirt_backend import open_connection
 
 
-def parse_args():
+def build_parser():
     parser = argparse.ArgumentParser(
         description='Create bridges and launch a virtual machine from a downloaded image',
     )
 
+    parser.add_argument(
+        '--manifest',
+        help='JSON file listing several VMs to set up in one run, the other arguments then apply to every VM',
+    )
+    parser.add_argument(
+        '--results',
+        help='File the JSON results of a --manifest run are written to',
+    )
+
     # add arguments for launching the virtual machine
     parser.add_argument(
         '--hypervisor_vm_image_loc', required=True,
         help='The url/file directory where to download the tar file to be extracted on the hypervisor',
     )
+    parser.add_argument(
+        '--hypervisor_vm_image_sha256', required=False, default=None,
+        help='SHA-256 checksum the image tar file must match',
+    )
+    parser.add_argument(
+        '--vm_backend', choices=('virt-install', 'libvirt'), default='virt-install',
+        help='Create the VM with virt-install or directly through the libvirt Python bindings',
+    )
+    parser.add_argument(
+        '--libvirt_uri', default=libvirt_uri,
+        help='libvirt connection used by the libvirt backend, test:///default for the test driver',
+    )
+    parser.add_argument(
+        '--vm_seed_url', default=None,
+        help='NoCloud-net seed URL (deploy.py --seed-server) given to the VM in its SMBIOS serial instead of attaching a cloud-init ISO',
+    )
+    parser.add_argument(
+        '--vm_disk_mode', choices=vm_disk_modes, default='full',
+        help='full extracts a copy of the image per VM, linked creates a qcow2 overlay on a shared base image',
+    )
+    parser.add_argument(
+        '--image_cache', action='store_true',
+        help='Keep downloaded images in a cache in the destination directory and reuse them for later VMs',
+    )
+    parser.add_argument(
+        '--image_cache_max_gb', type=float, default=50,
+        help='Size in GB the image cache may take up before the least recently used images are removed',
+    )
     parser.add_argument(
         '--hypervisor_dest_directory', default='/var/lib/libvirt/images/',
         help='The file directory where to place the qcow image on the hypervisor',
@@ -117,8 +165,10 @@ def parse_args():
         default=None, help='Nameserver for the the VM. Multiple can be specified comma-seperated.',
     )
 
-    args = parser.parse_args()
+    return parser
+
 
+def validate_args(parser, args):
     # VM Network Config
     if args.vm_static_ip_address is not None:
         # If --vm_static_ip_address is provided, make --vm_ip_gateway and --vm_ip_netmask required
@@ -134,46 +184,52 @@ def parse_args():
     return args
 
 
-if __name__ == '__main__':
-    """
-    This code orchestrates the setup and launch of a vETO(virtual Encrypted Traffic Orchestrator) on a hypervisor.
+def parse_args(argv=None):
+    parser = build_parser()
+    return validate_args(parser, parser.parse_args(argv))
 
-    Steps:
-    1. Parse command-line arguments to extract parameters necessary for VM setup and launch.
-    2. Download, extract, and rename the QCOW2 image file required for the VM.
-    3. Generate paths for cloud-init user data and metadata files, which contain VM configuration details.
-    4. Generate cloud-init scripts using the provided parameters for user data, metadata, hostname, etc.
-    5. Specify the path for the cloud-init ISO file, which initializes the VM.
-    6. Check if the disk (QCOW2 image file) exists; if not, raise an exception.
-    7. Construct the command to launch the VM using the `virt-install` command-line tool.
-    8. Prepare network bridges for the VM by creating bridge interfaces and bringing them up.
-    9. Execute shell commands to set up network bridges and launch the VM using the `virt-install` command.
-    10. Print the constructed `virt-install` command for debugging purposes.
-    11. Clean up sensitive information by removing temporary files or directories related to the VM setup process.
+
+def provision_disk(args):
     """
-    args = parse_args()
+    Download or find the image and extract it as the disk of the VM.
 
-    # Download or find the image and rename it to the hostname
-    disk, extract_path, tar_file_path = download_extract_and_rename_qcow2(
+    Returns
+    -------
+    Tuple[str, Path, str or None]
+        The disk, the directory of the VM and the archive, see `download_extract_and_rename_qcow2`.
+    """
+    return download_extract_and_rename_qcow2(
         url_or_file=args.hypervisor_vm_image_loc,
         extract_path=args.hypervisor_dest_directory,
         new_qcow_file=args.vm_qcow_name,
         loc_dir=args.vm_qcow_name,
+        expected_sha256=args.hypervisor_vm_image_sha256,
+        cache_max_bytes=int(args.image_cache_max_gb * 1024 ** 3) if args.image_cache else None,
+        disk_mode=args.vm_disk_mode,
     )
 
-    cloud_init_user_data_output = str(
-        Path(os.path.join(extract_path, 'user-data')),
-    )
-    cloud_init_meta_data_output = str(
-        Path(os.path.join(extract_path, 'meta-data')),
-    )
+
+def generate_seed(args, extract_path):
+    """
+    Generate the cloud-init ISO of the VM.
+
+    Returns
+    -------
+    str or None
+        The path of the cloud-init ISO, None when the VM fetches its seed from `--vm_seed_url`.
+
+    Notes
+    -----
+    The user data and metadata are rendered and written into the ISO in memory, the hashed
+    password never lands in a plaintext file next to the disk.
+    """
+    if args.vm_seed_url:
+        return None
 
     # Generate cloud-init scripts
-    generate_cloud_init_files(
+    user_data, meta_data = render_cloud_init_templates(
         vm_username=args.vm_username,
         vm_hashed_password=args.vm_hashed_password,
-        cloud_init_user_data_output=cloud_init_user_data_output,
-        cloud_init_meta_data_output=cloud_init_meta_data_output,
         vm_hostname=args.vm_hostname,
         vm_static_ip_address=args.vm_static_ip_address,
         vm_ip_gateway=args.vm_ip_gateway,
@@ -188,15 +244,55 @@ if __name__ == '__main__':
     )
 
     # Generate the actual iso used
-    generate_cloud_init_iso(
-        cloud_init_iso_name=cloud_init_iso_output,
-        user_data_directory=cloud_init_user_data_output,
-        meta_data_directory=cloud_init_meta_data_output,
+    return write_cloud_init_iso(cloud_init_iso_output, user_data, meta_data)
+
+
+def vm_bridges(args):
+    return (
+        args.vm_network_net_a, args.vm_network_net_b, args.vm_network_app_a,
+        args.vm_network_app_b, args.vm_network_mir_a, args.vm_network_mir_b,
     )
 
-    if disk is None:
-        raise Exception(f'No such file exists: {disk}')
 
+def vm_smbios_serial(args):
+    """
+    Return the SMBIOS serial pointing cloud-init at the NoCloud-net seed of the VM, if any.
+    """
+    if not args.vm_seed_url:
+        return None
+    # cloud-init appends the file names to the seed URL, which must end with a slash
+    return f"ds=nocloud-net;s={args.vm_seed_url.rstrip('/')}/"
+
+
+def vm_domain_xml(args, disk, cloud_init_iso_output):
+    """
+    Generate the libvirt domain XML of the VM.
+    """
+    return domain_xml(
+        name=args.vm_qcow_name,
+        vcpus=args.vm_vcpus,
+        memory=args.vm_memory,
+        disk=disk,
+        bridges=vm_bridges(args),
+        cdrom=cloud_init_iso_output,
+        boot=args.vm_boot,
+        cpu=args.vm_cpu,
+        model=args.vm_model,
+        network=(args.vm_type, args.vm_source, args.vm_source_mode),
+        virt_type=domain_type(args.libvirt_uri),
+        smbios_serial=vm_smbios_serial(args),
+    )
+
+
+def virt_install(args, disk, cloud_init_iso_output):
+    """
+    Launch the VM with virt-install.
+
+    Raises
+    ------
+    Exception
+        If virt-install exits with a non-zero exit code.
+    """
     # Build the command to launch the virtual machine
     virt_install_command = [
         'virt-install',
@@ -205,40 +301,243 @@ if __name__ == '__main__':
         f'--memory={args.vm_memory}',
         f'--os-variant={args.vm_os_variant}',
         f'--disk={disk}',
-        f'--disk={cloud_init_iso_output},device=cdrom',
         f'--boot={args.vm_boot}',
         f'--cpu={args.vm_cpu}',
+        '--network',
+        f'type={args.vm_type},source={args.vm_source},model={args.vm_model},source_mode={args.vm_source_mode}',
     ]
 
-    virt_install_command.append(
-        f'--network type={args.vm_type},source={args.vm_source},model={args.vm_model},source_mode={args.vm_source_mode}',
-    )
+    # The seed comes either from the cloud-init ISO or from the seed server given in the SMBIOS serial
+    if cloud_init_iso_output:
+        virt_install_command.append(f'--disk={cloud_init_iso_output},device=cdrom')
+    if vm_smbios_serial(args):
+        virt_install_command.append(f'--sysinfo=type=smbios,system.serial={vm_smbios_serial(args)}')
 
     # Setup up the interfaces
-    link_setup = []
-    for net in (args.vm_network_net_a, args.vm_network_net_b, args.vm_network_app_a, args.vm_network_app_b, args.vm_network_mir_a, args.vm_network_mir_b):
+    for net in vm_bridges(args):
         # Add the network interface to the command
-        virt_install_command.append(
-            f'--network bridge={net},model={args.vm_model}',
-        )
-        link_setup.append(
-            f'ip link add name {net} type bridge; ip link set dev {net} up',
-        )
+        virt_install_command += ['--network', f'bridge={net},model={args.vm_model}']
 
     virt_install_command.append('--noautoconsole')
     virt_install_command.append('--import')
     virt_install_command.append('--autostart')
 
-    # Creating the links required
-    # for link_command in link_setup:
-    #     link_startup = subprocess.run(link_command, shell=True, stdout=True)
-
+    print('virt_install_command', virt_install_command)
     # Execute the command to launch the virtual machine
-    virsh_build = subprocess.run(
-        ' '.join(virt_install_command), shell=True, stdout=True,
-    )
+    virsh_build = subprocess.run(virt_install_command)
+    if virsh_build.returncode != 0:
+        raise Exception(f'virt-install failed with exit code {virsh_build.returncode}')
 
-    print('virt_install_command', virt_install_command)
-    clean_up_sensitive_info([
-        tar_file_path,
-    ])
+
+def remove_archive(args, tar_file_path):
+    # Cached images are kept for the next VM
+    if tar_file_path and os.path.dirname(tar_file_path) != os.path.abspath(image_cache_directory(args.hypervisor_dest_directory)):
+        clean_up_sensitive_info([
+            tar_file_path,
+        ])
+
+
+def build_vm(args):
+    """
+    Set up and launch a single VM.
+    """
+    disk, extract_path, tar_file_path = provision_disk(args)
+    cloud_init_iso_output = generate_seed(args, extract_path)
+
+    if disk is None:
+        raise Exception(f'No such file exists: {disk}')
+
+    if args.vm_backend == 'libvirt':
+        # Define and start the domain straight through the libvirt API
+        xml = vm_domain_xml(args, disk, cloud_init_iso_output)
+        print('domain_xml', xml)
+        create_domains([xml], uri=args.libvirt_uri)
+    else:
+        virt_install(args, disk, cloud_init_iso_output)
+
+    remove_archive(args, tar_file_path)
+
+
+def manifest_argv(vm):
+    """
+    Turn a manifest entry into command line arguments, flags are set by true values.
+    """
+    argv = []
+    for name, value in vm.items():
+        if value is None or value is False:
+            continue
+        argv.append(f'--{name}')
+        if value is not True:
+            argv.append(str(value))
+    return argv
+
+
+def load_manifest(manifest_path):
+    """
+    Read the VMs of a manifest.
+
+    Parameters
+    ----------
+    manifest_path : str
+        A JSON file holding either a list of VMs, or an object with a `vms` list and a
+        `defaults` object applied to every VM. Each VM is an object keyed by the argument
+        names of this script without the leading dashes, e.g. `{"vm_qcow_name": "veto1", ...}`.
+
+    Returns
+    -------
+    list
+        The VMs with the defaults applied.
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if isinstance(manifest, list):
+        return manifest
+    defaults = manifest.get('defaults', {})
+    return [{**defaults, **vm} for vm in manifest['vms']]
+
+
+def run_manifest(manifest_path, shared_argv, results_path=None):
+    """
+    Set up every VM of a manifest in one run.
+
+    Parameters
+    ----------
+    manifest_path : str
+        The manifest, see `load_manifest`.
+    shared_argv : list
+        Command line arguments applying to every VM, overridden by the manifest entries.
+    results_path : str, optional
+        A file the JSON results are written to (default is None).
+
+    Returns
+    -------
+    list
+        One result per VM: its `vm_qcow_name`, `vm_hostname`, `status` ('ok' or 'failed'), `disk`,
+        and on failure the `stage` which failed and the `error`.
+
+    Notes
+    -----
+    The VMs go through each phase together. VMs sharing an image and disk settings fetch and
+    extract it once: the first VM gets its disk as usual and the others a sparse copy of it,
+    or an overlay on the same base image in linked mode, taken before any VM boots. Then the
+    cloud-init seeds are generated, and the VMs are launched, over a single libvirt connection
+    per URI with the libvirt backend. A failing VM is reported and does not stop the others.
+    """
+    parser = build_parser()
+    entries = []
+    for index, vm in enumerate(load_manifest(manifest_path)):
+        result = {
+            'vm_qcow_name': vm.get('vm_qcow_name', f'vm-{index}'),
+            'vm_hostname': vm.get('vm_hostname'),
+            'status': 'ok',
+            'disk': None,
+        }
+        try:
+            args = validate_args(parser, parser.parse_args(shared_argv + manifest_argv(vm)))
+        except SystemExit:
+            # argparse has printed the reason
+            args = None
+            result.update(status='failed', stage='arguments', error='Invalid arguments')
+        entries.append({'args': args, 'result': result})
+
+    def fail(entry, stage, error):
+        print(f"{entry['result']['vm_qcow_name']} failed at {stage}: {error}")
+        entry['result'].update(status='failed', stage=stage, error=str(error))
+
+    def pending():
+        return [entry for entry in entries if entry['result']['status'] == 'ok']
+
+    # Disks: one fetch and extraction per image
+    groups = {}
+    for entry in pending():
+        args = entry['args']
+        key = (
+            args.hypervisor_vm_image_loc, args.hypervisor_vm_image_sha256, args.hypervisor_dest_directory,
+            args.vm_disk_mode, args.image_cache, args.image_cache_max_gb,
+        )
+        groups.setdefault(key, []).append(entry)
+    archives = {}
+    for group in groups.values():
+        source_disk = None
+        for entry in group:
+            args = entry['args']
+            try:
+                if source_disk is None:
+                    disk, extract_path, tar_file_path = provision_disk(args)
+                    source_disk = disk
+                    archives[tar_file_path] = args
+                else:
+                    extract_path = Path(os.path.join(args.hypervisor_dest_directory, args.vm_qcow_name))
+                    disk = clone_qcow2(source_disk, str(extract_path), args.vm_qcow_name + '.qcow2', args.vm_disk_mode)
+            except Exception as e:
+                fail(entry, 'disk', e)
+                continue
+            entry.update(disk=disk, extract_path=extract_path)
+            entry['result']['disk'] = disk
+
+    # Cloud-init seeds
+    for entry in pending():
+        try:
+            entry['iso'] = generate_seed(entry['args'], entry['extract_path'])
+        except Exception as e:
+            fail(entry, 'cloud-init', e)
+
+    # Launch, libvirt domains over one connection per URI
+    connections = {}
+    try:
+        for entry in pending():
+            args = entry['args']
+            try:
+                if args.vm_backend == 'libvirt':
+                    if args.libvirt_uri not in connections:
+                        connections[args.libvirt_uri] = open_connection(args.libvirt_uri)
+                    define_and_start(
+                        connections[args.libvirt_uri], vm_domain_xml(args, entry['disk'], entry['iso']),
+                    )
+                else:
+                    virt_install(args, entry['disk'], entry['iso'])
+            except Exception as e:
+                fail(entry, 'launch', e)
+    finally:
+        for connection in connections.values():
+            connection.close()
+
+    for tar_file_path, args in archives.items():
+        remove_archive(args, tar_file_path)
+
+    results = [entry['result'] for entry in entries]
+    if results_path:
+        with open(results_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results))
+    return results
+
+
+if __name__ == '__main__':
+    """
+    This code orchestrates the setup and launch of a vETO(virtual Encrypted Traffic Orchestrator) on a hypervisor.
+
+    Steps:
+    1. Parse command-line arguments to extract parameters necessary for VM setup and launch.
+    2. Download, extract, and rename the QCOW2 image file required for the VM.
+    3. Render the cloud-init user data and metadata, which contain VM configuration details, in memory.
+    4. Write the cloud-init ISO file, which initializes the VM, unless --vm_seed_url points the VM at a seed server.
+    5. Pass the seed server URL to the VM in its SMBIOS serial when one is given.
+    6. Check if the disk (QCOW2 image file) exists; if not, raise an exception.
+    7. With the libvirt backend, generate the domain XML and define and start the VM through the libvirt API.
+    8. Otherwise construct the command to launch the VM using the `virt-install` command-line tool.
+    9. Print the constructed `virt-install` command for debugging purposes, run it and fail on a non-zero exit code.
+    10. Clean up sensitive information by removing temporary files or directories related to the VM setup process.
+
+    With --manifest, every VM of the manifest goes through these steps in one run, see `run_manifest`.
+    """
+    manifest_parser = argparse.ArgumentParser(add_help=False)
+    manifest_parser.add_argument('--manifest')
+    manifest_parser.add_argument('--results')
+    manifest_args, shared_argv = manifest_parser.parse_known_args()
+
+    if manifest_args.manifest:
+        results = run_manifest(manifest_args.manifest, shared_argv, manifest_args.results)
+        sys.exit(0 if all(result['status'] == 'ok' for result in results) else 1)
+
+    build_vm(parse_args())
@@ -0,0 +1,160 @@
+"""
+Benchmark the image pipeline decompression of gzip, zstd and xz image archives.
+
+A synthetic image made of random, compressible and zero blocks, roughly like a qcow2
+image, is archived with each compression and extracted through the same code the
+hypervisor runs (`stream_qcow2` in the build_kvm role helpers), once per decompressor
+found on the machine and once in-process.
+
+Execute:
+    python3 benchmarks/decompression_benchmark.py --size_gb 4
+"""
+import argparse
+import contextlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# helpers.py runs on the hypervisor next to the cloud_init_seed package, which lives in ansible_automation here
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ansible', 'roles', 'build_kvm', 'files'),
+)
+
+import helpers  # noqa: E402
+
+# Compressors by format, in order of preference, reading stdin and writing stdout
+compression_commands = {
+    'gzip': (
+        ['pigz', '-c'],
+        ['gzip', '-c'],
+    ),
+    'zstd': (
+        ['pzstd', '-c', '-p', str(os.cpu_count() or 1)],
+        ['zstd', '-c', '-T0'],
+    ),
+    'xz': (
+        ['xz', '-c', '-T0'],
+    ),
+}
+
+block_size = 1024 * 1024
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compare the extraction time of image archives per compression and decompressor',
+    )
+    parser.add_argument('--size_gb', type=float, default=2, help='Size of the synthetic image in GB')
+    parser.add_argument(
+        '--formats', nargs='+', choices=list(compression_commands), default=list(compression_commands),
+        help='Compressions to benchmark',
+    )
+    parser.add_argument('--work_dir', default=None, help='Directory for the image and archives (default: a temporary directory)')
+    parser.add_argument('--keep', action='store_true', help='Keep the work directory')
+    return parser.parse_args()
+
+
+def write_synthetic_image(path, size):
+    """
+    Write an image of `size` bytes, alternating random, compressible and zero 1 MiB blocks.
+    """
+    text = (b'vETO synthetic image block ' * (block_size // 27 + 1))[:block_size]
+    with open(path, 'wb') as file:
+        for index in range(size // block_size):
+            kind = index % 10
+            if kind < 4:
+                file.write(os.urandom(block_size))
+            elif kind < 7:
+                file.write(text)
+            else:
+                file.write(bytes(block_size))
+
+
+def create_archive(image_path, archive_path, command):
+    """
+    Archive the image with tar, compressing it with `command`, and return the time it took.
+    """
+    start = time.monotonic()
+    with open(archive_path, 'wb') as archive:
+        tar = subprocess.Popen(
+            ['tar', '-C', os.path.dirname(image_path), '-cf', '-', os.path.basename(image_path)],
+            stdout=subprocess.PIPE,
+        )
+        subprocess.run(command, stdin=tar.stdout, stdout=archive, check=True)
+        tar.stdout.close()
+        if tar.wait() != 0:
+            raise RuntimeError('tar failed')
+    return time.monotonic() - start
+
+
+def time_extraction(archive_path, extract_path, commands):
+    """
+    Extract the archive with only `commands` as decompressors and return the time it took.
+    """
+    saved = helpers.decompression_commands
+    helpers.decompression_commands = commands
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.monotonic()
+            qcow2_file = helpers.stream_qcow2(archive_path, extract_path, 'benchmark.qcow2')
+            elapsed = time.monotonic() - start
+    finally:
+        helpers.decompression_commands = saved
+    os.remove(qcow2_file)
+    return elapsed
+
+
+def main():
+    args = parse_args()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='decompression_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+    image_path = os.path.join(work_dir, 'image.qcow2')
+    size = int(args.size_gb * 1024 ** 3)
+
+    print(f'Writing a {args.size_gb} GB synthetic image to {image_path}')
+    write_synthetic_image(image_path, size)
+
+    results = []
+    try:
+        for compression in args.formats:
+            commands = [command for command in compression_commands[compression] if shutil.which(command[0])]
+            if not commands:
+                print(f'No {compression} compressor found, skipping')
+                continue
+            archive_path = os.path.join(work_dir, f'image.tar.{compression}')
+            compress_time = create_archive(image_path, archive_path, commands[0])
+            archive_size = os.path.getsize(archive_path)
+
+            decompressors = [
+                command for command in helpers.decompression_commands[compression]
+                if shutil.which(command[0])
+            ]
+            for command in decompressors + [None]:
+                name = command[0] if command else 'in-process'
+                commands_used = {compression: (command,)} if command else {}
+                try:
+                    elapsed = time_extraction(archive_path, os.path.join(work_dir, 'extract'), commands_used)
+                except RuntimeError as e:
+                    print(f'{compression} with {name} failed: {e}')
+                    continue
+                results.append((compression, commands[0][0], compress_time, archive_size, name, elapsed))
+            os.remove(archive_path)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print()
+    print(f'{"format":<6} {"compressor":<10} {"compress s":>10} {"archive MB":>10} {"decompressor":<12} {"extract s":>9} {"MB/s":>8}')
+    for compression, compressor, compress_time, archive_size, name, elapsed in results:
+        print(
+            f'{compression:<6} {compressor:<10} {compress_time:>10.1f} {archive_size / 1024 ** 2:>10.0f} '
+            f'{name:<12} {elapsed:>9.1f} {size / 1024 ** 2 / elapsed:>8.0f}',
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Benchmark the ETO setup of `setup_eto.py` against fake ETOs.
+
+Starts fake ETOs (see `mock_eto.py`) and sets them all up with `setup_etos_bulk`, once per
+number of concurrent ETOs and per way of loading the API spec:
+- download: the spec is downloaded and parsed for every ETO (no spec cache),
+- cache: the spec cache is warmed by an earlier run, the spec is only revalidated,
+- bundled: the spec is read from a file, never requested.
+
+Execute:
+    python3 benchmarks/eto_setup_benchmark.py --concurrency 1 10 100 --latency 0.01 --failure_rate 0.05
+"""
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import setup_eto  # noqa: E402
+from mock_eto import mock_password  # noqa: E402
+from mock_eto import mock_swagger_spec  # noqa: E402
+from mock_eto import mock_username  # noqa: E402
+from mock_eto import start_mock_etos  # noqa: E402
+from mock_eto import stop_mock_etos  # noqa: E402
+
+spec_modes = ('download', 'cache', 'bundled')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Measure the throughput and latency of the ETO setup against fake ETOs',
+    )
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 100], help='Numbers of ETOs set up at once')
+    parser.add_argument('--spec_modes', nargs='+', choices=spec_modes, default=list(spec_modes), help='Ways of loading the API spec')
+    parser.add_argument('--latency', type=float, default=0.005, help='Mean seconds added to every request')
+    parser.add_argument('--failure_rate', type=float, default=0, help='Fraction of the requests answered with 503')
+    parser.add_argument('--drop_rate', type=float, default=0, help='Fraction of the connections closed without an answer')
+    parser.add_argument('--boot_seconds', type=float, default=0, help='Seconds the ETOs answer with 503 after their start')
+    parser.add_argument('--retry_delay', type=float, default=0.2, help='Delay before the first retry')
+    parser.add_argument('--spec_paths', type=int, default=400, help='Number of filler operations in the spec')
+    return parser.parse_args()
+
+
+def run_setup(servers, spec_mode, work_dir, args):
+    """
+    Set up every fake ETO once and return the wall time and the report entries.
+    """
+    etos = [
+        {'ip': server.address, 'username': mock_username, 'old_password': mock_password, 'password': 'N3w-P@ssw0rd'}
+        for server in servers
+    ]
+    report_file = os.path.join(work_dir, 'report.jsonl')
+    # Every deployment runs setup_eto.py in a new process, without parsed specs in memory
+    setup_eto._spec_memo.clear()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.monotonic()
+        setup_eto.setup_etos_bulk(
+            etos, workers=len(etos), report_file=report_file, scheme='http',
+            spec_cache=os.path.join(work_dir, 'cache') if spec_mode == 'cache' else None,
+            bundled_spec=os.path.join(work_dir, 'swagger.json') if spec_mode == 'bundled' else None,
+            bundled_spec_only=spec_mode == 'bundled',
+            retry_delay=args.retry_delay, max_delay=max(args.retry_delay, 2), deadline=120,
+        )
+        elapsed = time.monotonic() - start
+    with open(report_file) as report:
+        return elapsed, [json.loads(line) for line in report]
+
+
+def main():
+    args = parse_args()
+    spec = mock_swagger_spec(args.spec_paths)
+    work_dir = tempfile.mkdtemp(prefix='eto_setup_benchmark_')
+    with open(os.path.join(work_dir, 'swagger.json'), 'w') as spec_file:
+        json.dump(spec, spec_file)
+    print(f'Spec of {len(spec["paths"])} paths, {os.path.getsize(os.path.join(work_dir, "swagger.json")) / 1024:.0f} KB')
+
+    results = []
+    try:
+        for count in args.concurrency:
+            servers = start_mock_etos(
+                count, latency=args.latency, failure_rate=args.failure_rate,
+                drop_rate=args.drop_rate, boot_seconds=args.boot_seconds, spec=spec,
+            )
+            try:
+                for spec_mode in args.spec_modes:
+                    if spec_mode == 'cache':
+                        # Warm the spec cache, as a redeployment of the same ETOs would find it
+                        run_setup(servers, spec_mode, work_dir, args)
+                    for server in servers:
+                        server.reset()
+                    elapsed, report = run_setup(servers, spec_mode, work_dir, args)
+                    print(f'{count} ETOs, {spec_mode}: {elapsed:.2f} seconds')
+                    seconds = sorted(entry['seconds'] for entry in report)
+                    results.append((
+                        count, spec_mode, elapsed, count / elapsed,
+                        statistics.median(seconds), seconds[max(0, int(len(seconds) * 0.95) - 1)],
+                        sum(entry['status'] != 'ok' for entry in report),
+                        sum(server.requests for server in servers),
+                        sum(server.spec_downloads for server in servers),
+                    ))
+            finally:
+                stop_mock_etos(servers)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print()
+    print(f'{"ETOs":>5} {"spec":<8} {"wall s":>7} {"ETO/s":>7} {"p50 s":>6} {"p95 s":>6} {"failed":>6} {"requests":>8} {"spec dl":>7}')
+    for count, spec_mode, elapsed, rate, p50, p95, failed, requests, downloads in results:
+        print(
+            f'{count:>5} {spec_mode:<8} {elapsed:>7.2f} {rate:>7.1f} {p50:>6.2f} {p95:>6.2f} '
+            f'{failed:>6} {requests:>8} {downloads:>7}',
+        )
+
+
+if __name__ == '__main__':
+    main()
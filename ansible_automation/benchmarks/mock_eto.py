@@ -0,0 +1,358 @@
+"""
+Fake ETO REST API for exercising `setup_eto.py` without a vETO.
+
+Serves a representative `/api/swagger.json` and implements the calls of the ETO setup:
+`POST /api/auth/login/` (with the password change of the first login) and
+`PUT /api/system/enrollment/enroll/`. Latency, injected failures and a slow boot, during
+which every request is answered with 503, can be configured. Plain HTTP only, use
+`setup_eto.py --scheme http` against it.
+
+Execute:
+    python3 benchmarks/mock_eto.py --port 8080 --count 3 --boot_seconds 20 --failure_rate 0.1
+"""
+import argparse
+import hashlib
+import json
+import random
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# Credentials of a freshly installed ETO
+mock_username = 'admin'
+mock_password = 'admin'
+
+# Number of filler operations in the spec, bringing it to the size of a real ETO spec
+mock_spec_filler_paths = 400
+
+login_path = '/api/auth/login/'
+enroll_path = '/api/system/enrollment/enroll/'
+spec_path = '/api/swagger.json'
+
+
+def mock_swagger_spec(filler_paths=mock_spec_filler_paths):
+    """
+    Build a swagger 2.0 spec with the operations used by `setup_eto.py` and filler operations.
+    """
+    paths = {
+        '/auth/login/': {
+            'post': {
+                'operationId': 'auth_login_create',
+                'tags': ['auth'],
+                'parameters': [{'name': 'data', 'in': 'body', 'required': True, 'schema': {'$ref': '#/definitions/Login'}}],
+                'responses': {'201': {'description': '', 'schema': {'$ref': '#/definitions/Login'}}},
+            },
+        },
+        '/system/enrollment/enroll/': {
+            'put': {
+                'operationId': 'system_enrollment_enroll_update',
+                'tags': ['system'],
+                'parameters': [{'name': 'data', 'in': 'body', 'required': True, 'schema': {'$ref': '#/definitions/Enrollment'}}],
+                'responses': {'200': {'description': '', 'schema': {'$ref': '#/definitions/Enrollment'}}},
+            },
+        },
+    }
+    definitions = {
+        'Login': {
+            'required': ['username', 'password'],
+            'type': 'object',
+            'properties': {
+                'username': {'type': 'string', 'minLength': 1},
+                'password': {'type': 'string', 'minLength': 1},
+                'new_password': {'type': 'string', 'x-nullable': True},
+            },
+        },
+        'Enrollment': {
+            'required': ['state'],
+            'type': 'object',
+            'properties': {'state': {'type': 'string', 'enum': ['allow', 'deny']}},
+        },
+    }
+    for index in range(filler_paths):
+        tag = f'segment{index // 20}'
+        model = f'Setting{index}'
+        definitions[model] = {
+            'type': 'object',
+            'properties': {
+                'name': {'type': 'string', 'maxLength': 64},
+                'address': {'type': 'string', 'format': 'ipv4'},
+                'enabled': {'type': 'boolean'},
+                'port': {'type': 'integer', 'minimum': 1, 'maximum': 65535},
+            },
+        }
+        paths[f'/{tag}/settings{index}/'] = {
+            'get': {
+                'operationId': f'{tag}_settings{index}_read',
+                'tags': [tag],
+                'responses': {'200': {'description': '', 'schema': {'$ref': f'#/definitions/{model}'}}},
+            },
+            'put': {
+                'operationId': f'{tag}_settings{index}_update',
+                'tags': [tag],
+                'parameters': [{'name': 'data', 'in': 'body', 'required': True, 'schema': {'$ref': f'#/definitions/{model}'}}],
+                'responses': {'200': {'description': '', 'schema': {'$ref': f'#/definitions/{model}'}}},
+            },
+        }
+    return {
+        'swagger': '2.0',
+        'info': {'title': 'ETO API', 'version': 'v1'},
+        'basePath': '/api',
+        'consumes': ['application/json'],
+        'produces': ['application/json'],
+        'paths': paths,
+        'definitions': definitions,
+    }
+
+
+class MockETOHandler(BaseHTTPRequestHandler):
+    """
+    Answer the API calls of `setup_eto.py` from the state of its `MockETOServer`.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status, body=None, headers=None):
+        payload = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_json(self):
+        try:
+            return json.loads(self.body or b'{}')
+        except ValueError:
+            return None
+
+    def injected_failure(self):
+        """
+        Apply the latency of the server and tell whether the request was failed on purpose.
+        """
+        # Read the body first, a failed request must not leave it in the kept-alive connection
+        self.body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        server = self.server
+        with server.state_lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency * random.uniform(0.5, 1.5))
+        if time.monotonic() < server.booted_at:
+            self.send_json(503, {'detail': 'The ETO is starting'})
+            return True
+        if random.random() < server.drop_rate:
+            # Close the connection without an answer, like a reset
+            self.close_connection = True
+            return True
+        if random.random() < server.failure_rate:
+            self.send_json(503, {'detail': 'Injected failure'})
+            return True
+        return False
+
+    def session_valid(self):
+        cookies = dict(
+            cookie.strip().split('=', 1) for cookie in self.headers.get('Cookie', '').split(';') if '=' in cookie
+        )
+        with self.server.state_lock:
+            return cookies.get('sessionid') in self.server.sessions
+
+    def do_GET(self):
+        if self.injected_failure():
+            return
+        if urlparse(self.path).path != spec_path:
+            self.send_json(404, {'detail': 'Not found.'})
+            return
+        server = self.server
+        if self.headers.get('If-None-Match') == server.spec_etag:
+            with server.state_lock:
+                server.spec_revalidations += 1
+            self.send_response(304)
+            self.send_header('ETag', server.spec_etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        with server.state_lock:
+            server.spec_downloads += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', server.spec_etag)
+        self.send_header('Content-Length', str(len(server.spec_body)))
+        self.end_headers()
+        self.wfile.write(server.spec_body)
+
+    def do_POST(self):
+        if self.injected_failure():
+            return
+        if urlparse(self.path).path != login_path:
+            self.send_json(404, {'detail': 'Not found.'})
+            return
+        body = self.read_json()
+        if not body or not body.get('username') or not body.get('password'):
+            self.send_json(400, {'detail': 'username and password are required'})
+            return
+        server = self.server
+        with server.state_lock:
+            if body['username'] != server.username or body['password'] != server.password:
+                self.send_json(401, {'detail': 'Invalid credentials'})
+                return
+            if body.get('new_password'):
+                server.password = body['new_password']
+            session = secrets.token_hex(16)
+            server.sessions.add(session)
+        self.send_json(
+            201, {'username': body['username'], 'password': '', 'new_password': None},
+            headers={'Set-Cookie': f'sessionid={session}; Path=/; HttpOnly'},
+        )
+
+    def do_PUT(self):
+        if self.injected_failure():
+            return
+        if urlparse(self.path).path != enroll_path:
+            self.send_json(404, {'detail': 'Not found.'})
+            return
+        if not self.session_valid():
+            self.send_json(403, {'detail': 'Authentication credentials were not provided.'})
+            return
+        body = self.read_json()
+        if not body or body.get('state') not in ('allow', 'deny'):
+            self.send_json(400, {'state': ['Must be allow or deny']})
+            return
+        with self.server.state_lock:
+            self.server.enrollment_state = body['state']
+        self.send_json(200, {'state': body['state']})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockETOServer(ThreadingHTTPServer):
+    """
+    A fake ETO listening on one port, recording its password, sessions and enrollment state.
+
+    Parameters
+    ----------
+    address : tuple
+        The (host, port) to listen on, port 0 picks a free one.
+    latency : float, optional
+        Mean seconds added to every request (default is 0).
+    failure_rate : float, optional
+        Fraction of the requests answered with 503 (default is 0).
+    drop_rate : float, optional
+        Fraction of the connections closed without an answer (default is 0).
+    boot_seconds : float, optional
+        Seconds after the start during which every request is answered with 503 (default is 0).
+    spec : dict, optional
+        The swagger spec served (default is None, `mock_swagger_spec()`).
+    """
+    daemon_threads = True
+
+    def __init__(self, address, latency=0, failure_rate=0, drop_rate=0, boot_seconds=0, spec=None):
+        super().__init__(address, MockETOHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.boot_seconds = boot_seconds
+        self.booted_at = time.monotonic() + boot_seconds
+        self.spec_body = json.dumps(spec or mock_swagger_spec()).encode()
+        self.spec_etag = '"%s"' % hashlib.sha256(self.spec_body).hexdigest()[:32]
+        self.username = mock_username
+        self.password = mock_password
+        self.sessions = set()
+        self.enrollment_state = 'deny'
+        self.requests = 0
+        self.spec_downloads = 0
+        self.spec_revalidations = 0
+        self.state_lock = threading.Lock()
+
+    def reset(self):
+        """
+        Bring the ETO back to its freshly installed state, booting again.
+        """
+        with self.state_lock:
+            self.password = mock_password
+            self.sessions.clear()
+            self.enrollment_state = 'deny'
+            self.requests = 0
+            self.spec_downloads = 0
+            self.spec_revalidations = 0
+            self.booted_at = time.monotonic() + self.boot_seconds
+
+    @property
+    def address(self):
+        return f'{self.server_address[0]}:{self.server_address[1]}'
+
+
+def start_mock_etos(count, host='127.0.0.1', port=0, **options):
+    """
+    Start fake ETOs, each on its own port and serving from a background thread.
+
+    Parameters
+    ----------
+    count : int
+        The number of ETOs.
+    host : str, optional
+        The address to listen on (default is '127.0.0.1').
+    port : int, optional
+        The port of the first ETO, the next ones following it (default is 0, free ports).
+    **options
+        The options of `MockETOServer`.
+
+    Returns
+    -------
+    list
+        The running `MockETOServer`s, stopped with `stop_mock_etos`.
+    """
+    spec = options.pop('spec', None) or mock_swagger_spec()
+    servers = []
+    for index in range(count):
+        server = MockETOServer((host, port + index if port else 0), spec=spec, **options)
+        # A short poll interval keeps stopping hundreds of servers quick
+        threading.Thread(
+            target=server.serve_forever, kwargs={'poll_interval': 0.05}, name=f'mock-eto-{index}', daemon=True,
+        ).start()
+        servers.append(server)
+    return servers
+
+
+def stop_mock_etos(servers):
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serve fake ETO APIs for setup_eto.py')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='Port of the first ETO')
+    parser.add_argument('--count', type=int, default=1, help='Number of ETOs, on consecutive ports')
+    parser.add_argument('--latency', type=float, default=0, help='Mean seconds added to every request')
+    parser.add_argument('--failure_rate', type=float, default=0, help='Fraction of the requests answered with 503')
+    parser.add_argument('--drop_rate', type=float, default=0, help='Fraction of the connections closed without an answer')
+    parser.add_argument('--boot_seconds', type=float, default=0, help='Seconds during which every request is answered with 503')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    servers = start_mock_etos(
+        args.count, args.host, args.port, latency=args.latency, failure_rate=args.failure_rate,
+        drop_rate=args.drop_rate, boot_seconds=args.boot_seconds,
+    )
+    for server in servers:
+        print(f'Fake ETO at http://{server.address}/api ({mock_username}/{mock_password})')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_mock_etos(servers)
+        for server in servers:
+            print(f'{server.address}: password {server.password!r}, enrollment {server.enrollment_state}, {server.requests} requests')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,20 @@
 import argparse
+import contextlib
 import datetime
 import json
 import logging as log
 import os
 import re
 
-from utils.ansible import ansible_add_to_inventory_executor
+from utils.agent import container_agent
 from utils.ansible import ansible_log_writer_analyzer
+from utils.ansible import ansible_playbook_backends
+from utils.ansible import ansible_playbook_command
 from utils.ansible import ansible_run_check
+from utils.ansible import ansible_runner_configure
+from utils.fleet import build_step_timeout
+from utils.fleet import fleet_config_install
+from utils.fleet import fleet_execute
 from utils.utils import setup_logging
 
 docker_name = 'ansible_automation'
@@ -18,8 +25,6 @@ def cleanup_func(config_opts, cleanup_log_name, log_level, use_docker=True):
 
     for conf in config_opts:
         hypervisor_hostname = conf.get('hypervisor_hostname')
-        hypervisor_username = conf.get('hypervisor_username')
-        hypervisor_password = conf.get('hypervisor_password')
 
         vm_qcow_name = conf.get('vm_qcow_name')
 
@@ -32,20 +37,6 @@ def cleanup_func(config_opts, cleanup_log_name, log_level, use_docker=True):
         vm_network_mir_a = conf.get('vm_network_mir_a')
         vm_network_mir_b = conf.get('vm_network_mir_b')
 
-        # Check if it was not successfully added to the inventory
-        if not ansible_add_to_inventory_executor(
-            hostname=hypervisor_hostname,
-            username=hypervisor_username,
-            password=hypervisor_password,
-            use_docker=use_docker,
-            docker_name=docker_name,
-            install_log_name=cleanup_log_name,
-            log_level=log_level,
-        ):
-            raise Exception(
-                f'Something went wrong when adding {hypervisor_hostname} to the inventory',
-            )
-
         log.info('Step 1: Add the SSH keys')
         # Step 1: Add the SSH keys
         log_check_bool.append(
@@ -53,28 +44,37 @@ def cleanup_func(config_opts, cleanup_log_name, log_level, use_docker=True):
                 cleanup_log_name, 'echo Adding SSH Keys',
             ),
         )
-        make_sure_ssh_available = f'ansible-playbook playbooks/ssh_setup_individual.yml --extra-vars "hypervisor_username={conf["hypervisor_username"]} hypervisor_password={conf["hypervisor_password"]} hypervisor_hostname={conf["hypervisor_hostname"]}"'
+        make_sure_ssh_available = ansible_playbook_command('playbooks/ssh_setup_individual.yml', {
+            'hypervisor_username': conf['hypervisor_username'],
+            'hypervisor_password': conf['hypervisor_password'],
+            'hypervisor_hostname': conf['hypervisor_hostname'],
+        })
         ssh_docker_command = f'docker exec -t {docker_name} {make_sure_ssh_available}'
         log_check_bool.append(
             ansible_log_writer_analyzer(
                 cleanup_log_name, ssh_docker_command,
+                step='Step 1: Add the SSH keys',
+                timeout=build_step_timeout(conf, 'ssh_setup'),
             ),
         )
 
-        ansible_cleanup_command = f'ansible-playbook playbooks/cleanup.yml --extra-vars\
-            "hypervisor_hostname={conf["hypervisor_hostname"]}\
-            hypervisor_dest_directory={conf["hypervisor_dest_directory"]}\
-            vm_qcow_name={vm_qcow_name}\
-            vm_network_net_a={vm_network_net_a}\
-            vm_network_net_b={vm_network_net_b}\
-            vm_network_app_a={vm_network_app_a}\
-            vm_network_app_b={vm_network_app_b}\
-            vm_network_mir_a={vm_network_mir_a}\
-            vm_network_mir_b={vm_network_mir_b}"'
+        ansible_cleanup_command = ansible_playbook_command('playbooks/cleanup.yml', {
+            'hypervisor_hostname': conf['hypervisor_hostname'],
+            'hypervisor_dest_directory': conf['hypervisor_dest_directory'],
+            'vm_qcow_name': vm_qcow_name,
+            'vm_network_net_a': vm_network_net_a,
+            'vm_network_net_b': vm_network_net_b,
+            'vm_network_app_a': vm_network_app_a,
+            'vm_network_app_b': vm_network_app_b,
+            'vm_network_mir_a': vm_network_mir_a,
+            'vm_network_mir_b': vm_network_mir_b,
+        })
         docker_cleanup_command = f'docker exec -t {docker_name} {ansible_cleanup_command}'
         log_check_bool.append(
             ansible_log_writer_analyzer(
                 cleanup_log_name, docker_cleanup_command,
+                step='Step 2: Remove the VM',
+                timeout=build_step_timeout(conf, 'cleanup'),
             ),
         )
 
@@ -86,6 +86,40 @@ def cleanup_func(config_opts, cleanup_log_name, log_level, use_docker=True):
         return True
 
 
+def fleet_cleanup_func(config_opts, cleanup_log_name, log_level, forks=5, serial=0):
+    """
+    Remove every VM of the configuration with one ansible-playbook run per step.
+
+    Parameters
+    ----------
+    config_opts : list
+        A list of dictionaries containing the deployment configuration.
+    cleanup_log_name : str
+        The name of the cleanup log file.
+    log_level : str
+        The logging level.
+    forks : int, optional
+        The number of hosts Ansible works on in parallel (default is 5).
+    serial : int, optional
+        The batch size of hosts running each play, 0 runs all hosts in one batch (default is 0).
+
+    Returns
+    -------
+    bool
+        True if the cleanup succeeded, otherwise False.
+    """
+    stages = [
+        ('Step 1: Add the SSH keys', 'Adding SSH Keys', 'playbooks/ssh_setup_individual.yml', 'ssh_setup'),
+        ('Step 2: Remove the VMs', 'Removing VMs', 'playbooks/cleanup.yml', 'cleanup'),
+    ]
+    if fleet_execute(config_opts, stages, cleanup_log_name, log_level, docker_name, forks, serial):
+        log.info('Fleet Cleanup Succeeded\n')
+        return True
+    else:
+        log.error('Fleet Cleanup Failed\n')
+        return False
+
+
 def parse_cleanup_arguments():
     """
     Parse command-line arguments for cleanup configuration.
@@ -119,6 +153,38 @@ def parse_cleanup_arguments():
             'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL', 'VERBOSE',
         ], help='Log level (DEBUG, INFO, WARNING, ERROR, CRITICAL, VERBOSE)',
     )
+    parser.add_argument(
+        '--stream-logs', action='store_true',
+        help='Write the command output to the log file line by line while it runs',
+    )
+    parser.add_argument(
+        '--fail-fast', action='store_true',
+        help='Kill a running playbook as soon as a task fails, a host is unreachable or a traceback is printed',
+    )
+    parser.add_argument(
+        '--step-timeout', type=float, default=None, metavar='SECONDS',
+        help='Seconds a step may run before it is killed and marked as timed out, build entries can override it with step_timeouts (default: no limit)',
+    )
+    parser.add_argument(
+        '--playbook-backend', choices=ansible_playbook_backends, default='ansible-playbook',
+        help='Run the playbooks with ansible-playbook, judged by their output, or through the ansible-runner API, judged by their events (default: ansible-playbook)',
+    )
+    parser.add_argument(
+        '--no-agent', action='store_true',
+        help='Start docker exec for every step instead of sending the steps to the command agent of the container',
+    )
+    parser.add_argument(
+        '--fleet', action='store_true',
+        help='Run every playbook once across all hosts of the configuration instead of once per host',
+    )
+    parser.add_argument(
+        '--forks', type=int, default=5,
+        help='Number of hosts Ansible works on in parallel in fleet mode (default: 5)',
+    )
+    parser.add_argument(
+        '--serial', type=int, default=0,
+        help='Batch size of hosts running each play in fleet mode, 0 runs all hosts at once (default: 0)',
+    )
     args = parser.parse_args()
     return args
 
@@ -145,6 +211,10 @@ if __name__ == '__main__':
         os.makedirs(os.path.dirname(log_file_path))
     log_level = str.upper(args.log_level)
     setup_logging(log_file_path, log_level=log_level)
+    ansible_runner_configure(
+        stream=args.stream_logs, fail_fast=args.fail_fast, timeout=args.step_timeout,
+        backend=args.playbook_backend,
+    )
 
     config_file_path = args.config
     with open(config_file_path) as json_file:
@@ -152,4 +222,17 @@ if __name__ == '__main__':
 
     use_docker = True
 
-    cleanup_func(conf_arr, log_file_path, log_level, use_docker)
+    # Every step is sent to the command agent of the container instead of its own docker exec
+    agent = container_agent(docker_name) if not args.no_agent else contextlib.nullcontext()
+    with agent as running_agent:
+        ansible_runner_configure(agent=running_agent)
+        if args.fleet:
+            fleet_cleanup_func(
+                conf_arr, log_file_path, log_level,
+                forks=args.forks, serial=args.serial,
+            )
+        else:
+            # The hypervisors are found in the dynamic inventory generated from the configuration
+            if not fleet_config_install(conf_arr, docker_name):
+                raise Exception('Something went wrong when copying the configuration')
+            cleanup_func(conf_arr, log_file_path, log_level, use_docker)
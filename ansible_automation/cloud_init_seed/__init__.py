@@ -0,0 +1,9 @@
+"""
+Cloud-init NoCloud seeds: the user-data and meta-data of a VM, the hash of its password and the
+`cidata` ISO holding them.
+
+The package only needs the standard library. It is shared by `deploy.py` (the seed server of
+`utils.seed_server`), `setup_kvm.py` on the hypervisor, which the ansible image ships it to
+with the `build_kvm` role, and `cloud_init_scripts/cloud_init_utils.py`, for which it is
+installed with `pip install .` from the repository root.
+"""
@@ -0,0 +1,280 @@
+import os
+import re
+import struct
+import time
+
+# Size of the logical blocks (sectors) of an ISO 9660 image
+iso_sector_size = 2048
+
+# Rock Ridge extension reference written to the continuation area of the root directory
+iso_rock_ridge_id = b'RRIP_1991A'
+iso_rock_ridge_description = b'THE ROCK RIDGE INTERCHANGE PROTOCOL PROVIDES SUPPORT FOR POSIX FILE SYSTEM SEMANTICS'
+iso_rock_ridge_source = (
+    b'PLEASE CONTACT DISC PUBLISHER FOR SPECIFICATION SOURCE.  '
+    b'SEE PUBLISHER IDENTIFIER IN PRIMARY VOLUME DESCRIPTOR FOR CONTACT INFORMATION.'
+)
+
+
+def _both16(value):
+    return struct.pack('<H', value) + struct.pack('>H', value)
+
+
+def _both32(value):
+    return struct.pack('<I', value) + struct.pack('>I', value)
+
+
+def _iso_recording_date(timestamp):
+    return bytes([
+        timestamp.tm_year - 1900, timestamp.tm_mon, timestamp.tm_mday,
+        timestamp.tm_hour, timestamp.tm_min, timestamp.tm_sec, 0,
+    ])
+
+
+def _iso_volume_date(timestamp):
+    return time.strftime('%Y%m%d%H%M%S00', timestamp).encode() + b'\x00'
+
+
+def _iso_level1_name(name):
+    """
+    Map a file name to an ISO 9660 level 1 identifier, e.g. 'user-data' to 'USER_DAT.;1'.
+    """
+    base, _, extension = name.upper().rpartition('.') if '.' in name else (name.upper(), '', '')
+    base = re.sub(r'[^A-Z0-9_]', '_', base)[:8]
+    extension = re.sub(r'[^A-Z0-9_]', '_', extension)[:3]
+    return f'{base}.{extension};1'.encode()
+
+
+def _iso_rock_ridge(mode, nlinks, timestamp, name=None):
+    """
+    Build the Rock Ridge RR, NM, PX and TF entries of a directory record.
+    """
+    flags = 0x81 | (0x08 if name is not None else 0)
+    entries = b'RR' + bytes([5, 1, flags])
+    if name is not None:
+        entries += b'NM' + bytes([5 + len(name), 1, 0]) + name
+    entries += b'PX' + bytes([36, 1]) + _both32(mode) + _both32(nlinks) + _both32(0) + _both32(0)
+    entries += b'TF' + bytes([26, 1, 0x0E]) + _iso_recording_date(timestamp) * 3
+    return entries
+
+
+def _iso_directory_record(identifier, extent, size, timestamp, directory=False, system_use=b''):
+    """
+    Build an ISO 9660 directory record.
+    """
+    record = b''.join([
+        bytes([0, 0]), _both32(extent), _both32(size), _iso_recording_date(timestamp),
+        bytes([2 if directory else 0, 0, 0]), _both16(1), bytes([len(identifier)]), identifier,
+    ])
+    if len(identifier) % 2 == 0:
+        record += b'\x00'
+    record += system_use
+    if len(record) % 2:
+        record += b'\x00'
+    return bytes([len(record)]) + record[1:]
+
+
+def _iso_path_table(root_extent, byteorder):
+    return bytes([1, 0]) + root_extent.to_bytes(4, byteorder) + (1).to_bytes(2, byteorder) + b'\x00\x00'
+
+
+def _iso_volume_descriptor(
+        descriptor_type, volume_id, volume_sectors, path_table_size,
+        path_table_extents, root_record, timestamp, joliet=False,
+):
+    """
+    Build a primary (type 1) or Joliet supplementary (type 2) volume descriptor.
+    """
+    def text(value, length):
+        if joliet:
+            return (value.encode('utf-16-be') + b'\x00 ' * length)[:length]
+        return value.encode().ljust(length, b' ')[:length]
+
+    date = _iso_volume_date(timestamp)
+    descriptor = b''.join([
+        bytes([descriptor_type]), b'CD001', bytes([1, 0]),
+        text('', 32), text(volume_id, 32), bytes(8),
+        _both32(volume_sectors),
+        b'%/E'.ljust(32, b'\x00') if joliet else bytes(32),
+        _both16(1), _both16(1), _both16(iso_sector_size),
+        _both32(path_table_size),
+        struct.pack('<I', path_table_extents[0]), bytes(4),
+        struct.pack('>I', path_table_extents[1]), bytes(4),
+        root_record,
+        text('', 128) * 4, text('', 37) * 3,
+        date, date, b'0' * 16, b'\x00', date,
+        bytes([1, 0]),
+    ])
+    return descriptor.ljust(iso_sector_size, b'\x00')
+
+
+def build_iso9660(files, volume_id='cidata', timestamp=None):
+    """
+    Build an ISO 9660 image with Joliet and Rock Ridge names in memory.
+
+    Parameters
+    ----------
+    files : dict
+        The file names mapped to their content (bytes), all placed in the root directory.
+    volume_id : str, optional
+        The volume label (default is 'cidata', the label cloud-init looks for).
+    timestamp : time.struct_time, optional
+        The time recorded for the volume and files, in UTC (default is None, the current time).
+
+    Returns
+    -------
+    bytes
+        The ISO image.
+
+    Raises
+    ------
+    ValueError
+        If two names map to the same ISO 9660 identifier or the directory outgrows a sector.
+
+    Notes
+    -----
+    The image matches what `genisoimage -volid cidata -joliet -rock` writes for a flat set of
+    files: level 1 names (`USER_DAT.;1`) with the real name in a Rock Ridge NM entry, a Joliet
+    tree with the real names, and the Rock Ridge extension reference in a continuation area.
+    Sectors: 16 primary and 17 Joliet volume descriptors, 18 terminator, 19-22 path tables,
+    23 and 24 root directories, 25 continuation area, file data from 26 on.
+    """
+    timestamp = timestamp or time.gmtime()
+    names = sorted(files)
+    iso_names = {name: _iso_level1_name(name) for name in names}
+    if len(set(iso_names.values())) != len(iso_names):
+        raise ValueError(f'File names collide as ISO 9660 identifiers: {names}')
+    joliet_names = {name: name.encode('utf-16-be') for name in names}
+
+    root_extent, joliet_root_extent, continuation_extent, data_extent = 23, 24, 25, 26
+    extents = {}
+    for name in names:
+        extents[name] = data_extent
+        data_extent += max(1, -(-len(files[name]) // iso_sector_size))
+    volume_sectors = data_extent
+
+    extension_reference = b''.join([
+        b'ER',
+        bytes([
+            8 + len(iso_rock_ridge_id) + len(iso_rock_ridge_description) + len(iso_rock_ridge_source), 1,
+            len(iso_rock_ridge_id), len(iso_rock_ridge_description), len(iso_rock_ridge_source), 1,
+        ]),
+        iso_rock_ridge_id, iso_rock_ridge_description, iso_rock_ridge_source,
+    ])
+
+    directory_mode = 0o40555
+    file_mode = 0o100444
+    root_self = _iso_rock_ridge(directory_mode, 2, timestamp)
+    root = [
+        _iso_directory_record(
+            b'\x00', root_extent, iso_sector_size, timestamp, directory=True,
+            system_use=b''.join([
+                b'SP', bytes([7, 1, 0xBE, 0xEF, 0]), root_self,
+                b'CE', bytes([28, 1]), _both32(continuation_extent), _both32(0), _both32(len(extension_reference)),
+            ]),
+        ),
+        _iso_directory_record(b'\x01', root_extent, iso_sector_size, timestamp, directory=True, system_use=root_self),
+    ]
+    joliet_root = [
+        _iso_directory_record(b'\x00', joliet_root_extent, iso_sector_size, timestamp, directory=True),
+        _iso_directory_record(b'\x01', joliet_root_extent, iso_sector_size, timestamp, directory=True),
+    ]
+    for name in sorted(names, key=iso_names.get):
+        root.append(_iso_directory_record(
+            iso_names[name], extents[name], len(files[name]), timestamp,
+            system_use=_iso_rock_ridge(file_mode, 1, timestamp, name.encode()),
+        ))
+    for name in sorted(names, key=joliet_names.get):
+        joliet_root.append(_iso_directory_record(joliet_names[name], extents[name], len(files[name]), timestamp))
+    root, joliet_root = b''.join(root), b''.join(joliet_root)
+    if max(len(root), len(joliet_root)) > iso_sector_size:
+        raise ValueError('Too many files for a single directory sector')
+
+    path_table_size = len(_iso_path_table(root_extent, 'little'))
+    image = bytearray(iso_sector_size * volume_sectors)
+
+    def write(extent, data):
+        image[extent * iso_sector_size:extent * iso_sector_size + len(data)] = data
+
+    write(16, _iso_volume_descriptor(
+        1, volume_id, volume_sectors, path_table_size, (19, 20),
+        _iso_directory_record(b'\x00', root_extent, iso_sector_size, timestamp, directory=True),
+        timestamp,
+    ))
+    write(17, _iso_volume_descriptor(
+        2, volume_id, volume_sectors, path_table_size, (21, 22),
+        _iso_directory_record(b'\x00', joliet_root_extent, iso_sector_size, timestamp, directory=True),
+        timestamp, joliet=True,
+    ))
+    write(18, b'\xffCD001\x01')
+    write(19, _iso_path_table(root_extent, 'little'))
+    write(20, _iso_path_table(root_extent, 'big'))
+    write(21, _iso_path_table(joliet_root_extent, 'little'))
+    write(22, _iso_path_table(joliet_root_extent, 'big'))
+    write(root_extent, root)
+    write(joliet_root_extent, joliet_root)
+    write(continuation_extent, extension_reference)
+    for name in names:
+        write(extents[name], files[name])
+    return bytes(image)
+
+
+def write_cloud_init_iso(cloud_init_iso_name, user_data, meta_data):
+    """
+    Write a cloud-init ISO image from the user data and metadata held in memory.
+
+    Parameters
+    ----------
+    cloud_init_iso_name : str
+        The name of the cloud-init ISO image to generate.
+    user_data : str
+        The cloud-init user data.
+    meta_data : str
+        The cloud-init metadata.
+
+    Returns
+    -------
+    str
+        The name of the ISO image.
+
+    Notes
+    -----
+    The image is built in-process by `build_iso9660`, labelled `cidata` with the files `user-data`
+    and `meta-data`. It is only readable by its owner as it holds the hashed password.
+    """
+    image = build_iso9660({
+        'user-data': user_data.encode(),
+        'meta-data': meta_data.encode(),
+    })
+    fd = os.open(cloud_init_iso_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as output_file:
+        output_file.write(image)
+    return cloud_init_iso_name
+
+
+def generate_cloud_init_iso(cloud_init_iso_name, user_data_directory, meta_data_directory):
+    """
+    Generate a cloud-init ISO image.
+
+    Parameters
+    ----------
+    cloud_init_iso_name : str
+        The name of the cloud-init ISO image to generate.
+    user_data_directory : str
+        The directory containing the user data file.
+    meta_data_directory : str
+        The directory containing the metadata file.
+
+    Returns
+    -------
+    None
+
+    Notes
+    -----
+    This function reads the user data and metadata files from the specified directories and writes them into
+    the ISO image with `write_cloud_init_iso`. The generated ISO image is saved with the provided `cloud_init_iso_name`.
+    """
+    with open(user_data_directory) as f:
+        user_data = f.read()
+    with open(meta_data_directory) as f:
+        meta_data = f.read()
+    write_cloud_init_iso(cloud_init_iso_name, user_data, meta_data)
@@ -0,0 +1,78 @@
+import hashlib
+import secrets
+
+# Rounds of a SHA-512 crypt ($6$) hash which does not name them
+sha512_crypt_rounds = 5000
+
+# Alphabet and byte order of the SHA-512 crypt encoding, as used by `mkpasswd -m sha-512`
+sha512_crypt_alphabet = './0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+sha512_crypt_order = (
+    (0, 21, 42), (22, 43, 1), (44, 2, 23), (3, 24, 45), (25, 46, 4), (47, 5, 26), (6, 27, 48),
+    (28, 49, 7), (50, 8, 29), (9, 30, 51), (31, 52, 10), (53, 11, 32), (12, 33, 54), (34, 55, 13),
+    (56, 14, 35), (15, 36, 57), (37, 58, 16), (59, 17, 38), (18, 39, 60), (40, 61, 19), (62, 20, 41),
+)
+
+
+def sha512_crypt(password, salt=None, rounds=None):
+    """
+    Hash a password with SHA-512 crypt, the `$6$` format of `mkpasswd -m sha-512`.
+
+    Parameters
+    ----------
+    password : str
+        The plaintext password.
+    salt : str, optional
+        The salt, at most 16 characters are used (default is None, a random salt).
+    rounds : int, optional
+        The number of rounds, kept within 1000 to 999999999 and written into the hash as
+        `rounds=<rounds>$` (default is None, the implicit 5000 rounds of the format).
+
+    Returns
+    -------
+    str
+        The hashed password, e.g. '$6$<salt>$<hash>'.
+
+    Notes
+    -----
+    The hash is the one `crypt(3)` of glibc returns for the same salt and rounds, computed with
+    `hashlib` as the `crypt` module is gone from Python 3.13.
+    """
+    prefix = '$6$'
+    if rounds is None:
+        rounds = sha512_crypt_rounds
+    else:
+        rounds = max(1000, min(999999999, rounds or sha512_crypt_rounds))
+        prefix += f'rounds={rounds}$'
+    if salt is None:
+        salt = ''.join(secrets.choice(sha512_crypt_alphabet) for _ in range(16))
+    key = password.encode()
+    salt = salt.encode()[:16]
+
+    alternate = hashlib.sha512(key + salt + key).digest()
+    intermediate = hashlib.sha512(key + salt)
+    intermediate.update((alternate * (len(key) // 64 + 1))[:len(key)])
+    length = len(key)
+    while length:
+        intermediate.update(alternate if length & 1 else key)
+        length >>= 1
+    digest = intermediate.digest()
+
+    key_sequence = hashlib.sha512(key * len(key)).digest()
+    key_sequence = (key_sequence * (len(key) // 64 + 1))[:len(key)]
+    salt_sequence = hashlib.sha512(salt * (16 + digest[0])).digest()[:len(salt)]
+
+    for round_number in range(rounds):
+        rounds_hash = hashlib.sha512(key_sequence if round_number & 1 else digest)
+        if round_number % 3:
+            rounds_hash.update(salt_sequence)
+        if round_number % 7:
+            rounds_hash.update(key_sequence)
+        rounds_hash.update(digest if round_number & 1 else key_sequence)
+        digest = rounds_hash.digest()
+
+    def encode(value, count):
+        return ''.join(sha512_crypt_alphabet[(value >> (6 * i)) & 0x3f] for i in range(count))
+
+    encoded = ''.join(encode((digest[a] << 16) | (digest[b] << 8) | digest[c], 4) for a, b, c in sha512_crypt_order)
+    encoded += encode(digest[63], 2)
+    return f'{prefix}{salt.decode()}${encoded}'
@@ -0,0 +1,99 @@
+from ipaddress import IPv4Network
+
+
+def render_cloud_init_templates(
+        vm_username,
+        vm_hashed_password,
+        vm_hostname,
+        vm_static_ip_address=None,
+        vm_ip_gateway=None,
+        vm_ip_netmask=None,
+        vm_dns_server_1=None,
+        vm_dns_server_2=None,
+        vm_nameserver=None,
+):
+    """
+    Render the cloud-init user data and metadata of a virtual machine in memory.
+
+    Parameters
+    ----------
+    vm_username : str
+        The username for the virtual machine.
+    vm_hashed_password : str
+        The hashed password for the virtual machine user, unescaped.
+    vm_hostname : str
+        The hostname for the virtual machine.
+    vm_static_ip_address : str, optional
+        The static IP address for the virtual machine (default is None).
+    vm_ip_gateway : str, optional
+        The IP gateway for the virtual machine (default is None).
+    vm_ip_netmask : str, optional
+        The IP netmask for the virtual machine (default is None).
+        Supports dotted-decimal (eg. '255.255.255.255') and CIDR (eg. '/32') notations.
+    vm_dns_server_1 : str, optional
+        The primary DNS server for the virtual machine (default is None).
+    vm_dns_server_2 : str, optional
+        The secondary DNS server for the virtual machine (default is None).
+    vm_nameserver: str, optional
+        The nameserver for the virtual machine (default is None).
+        Multiple can be specified comma-seperated.
+
+    Returns
+    -------
+    Tuple[str, str]
+        The user data and the metadata.
+
+    Notes
+    -----
+    This is the only template of the seeds: `setup_kvm.py` writes it into the ISO on the hypervisor,
+    `cloud_init_scripts/cloud_init_utils.py` into the ISOs it generates and the seed server of
+    `deploy.py` serves it (see `utils.seed_server`).
+    """
+    # Convert netmask to CIDR notation for nmcli
+    if vm_ip_netmask is not None:
+        netmask_len = len(vm_ip_netmask.split('.'))
+        if netmask_len == 1 and len(vm_ip_netmask.split('/')) == 1:
+            vm_ip_netmask = f'/{vm_ip_netmask}'
+        if netmask_len == 4:
+            vm_ip_netmask = '/' + str(IPv4Network(f'0.0.0.0/{vm_ip_netmask}').prefixlen)
+    else:
+        vm_ip_netmask = ''
+
+    cloud_init_user_data_template = '''#cloud-config
+user: {}
+password: "{}"
+chpasswd: {{expire: False}}
+ssh_pwauth: True
+runcmd:
+- hostnamectl set-hostname {}
+'''.format(vm_username, vm_hashed_password, vm_hostname)
+
+    if vm_static_ip_address:
+        cloud_init_user_data_template += f"- set -x; nmcli connection modify eth0 ipv4.method manual ipv4.addresses '{vm_static_ip_address}{vm_ip_netmask}'\n"
+
+    if vm_ip_gateway:
+        cloud_init_user_data_template += f"- set -x; nmcli connection modify eth0 ipv4.gateway '{vm_ip_gateway}'\n"
+
+    if vm_dns_server_1:
+        cloud_init_user_data_template += (
+            f"- set -x; nmcli connection modify eth0 ipv4.dns '{vm_dns_server_1}'\n"
+        )
+
+    if vm_dns_server_2:
+        cloud_init_user_data_template += (
+            f"- set -x; nmcli connection modify eth0 +ipv4.dns '{vm_dns_server_2}'\n"
+        )
+
+    if vm_nameserver:
+        cloud_init_user_data_template += (
+            f"- set -x; nmcli connection modify eth0 ipv4.dns-search '{vm_nameserver}'\n"
+        )
+
+    # Restart the network to apply the changes
+    cloud_init_user_data_template += (
+        '- set -x; if uname -a | grep el7; then systemctl restart network; else systemctl restart NetworkManager ; fi\n'
+    )
+
+    cloud_init_meta_data_template = f'hostname: {vm_hostname}'
+
+    return cloud_init_user_data_template, cloud_init_meta_data_template
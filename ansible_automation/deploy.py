@@ -1,13 +1,19 @@
 import argparse
+import contextlib
 import datetime
+import functools
 import json
 import logging as log
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 
-from utils.ansible import ansible_add_to_inventory_executor
+from utils.agent import container_agent
 from utils.ansible import ansible_log_writer_analyzer
+from utils.ansible import ansible_playbook_backends
+from utils.ansible import ansible_playbook_command
 from utils.ansible import ansible_run_check
+from utils.ansible import ansible_runner_configure
 from utils.ansible import ansible_ssh_key_exist
 from utils.ansible import ansible_ssh_keys_generate
 from utils.cloud_init import cloud_init_sha512_crypt
@@ -15,13 +21,430 @@ from utils.cloud_init import generate_random_salt
 from utils.docker import ensure_container_running
 from utils.docker import is_docker_running
 from utils.docker import stop_container
+from utils.fleet import build_optional_extra_vars
+from utils.fleet import build_step_timeout
+from utils.fleet import fleet_config_install
+from utils.fleet import fleet_execute
+from utils.fleet import fleet_group
+from utils.fleet import fleet_host_aliases
+from utils.fleet import fleet_hypervisor_group
+from utils.fleet import fleet_inventory_path
+from utils.fleet import fleet_setup_etos
+from utils.fleet import fleet_step_timeout
+from utils.readiness import query_domain_states
+from utils.readiness import readiness_configure
+from utils.readiness import vm_ready_target
+from utils.readiness import wait_for_vms
+from utils.seed_server import seed_server
 from utils.utils import colors
 from utils.utils import setup_logging
 
 docker_name = 'ansible_automation'
 
 
-def builder_func(build_options, install_log_name, log_level, use_docker=True):
+def deploy_build(build, install_log_name, log_level, use_docker=True):
+    """
+    Deploy a single build entry onto its hypervisor.
+
+    Parameters
+    ----------
+    build : dict
+        A dictionary containing the build options for one VM.
+    install_log_name : str
+        The name of the installation log file.
+    log_level : str
+        The logging level.
+    use_docker : bool, optional
+        Whether the commands are run through the ansible docker container (default is True).
+
+    Returns
+    -------
+    bool
+        True if every step succeeded, False as soon as a step fails.
+    """
+    log_check_bool = []
+
+    # -- Hypervisor
+    hypervisor_hostname = build.get('hypervisor_hostname')
+    hypervisor_username = build.get('hypervisor_username')
+    hypervisor_password = build.get('hypervisor_password')
+
+    # -- VM Configuration
+    hypervisor_vm_image_loc = build.get('hypervisor_vm_image_loc')
+    hypervisor_dest_directory = build.get('hypervisor_dest_directory')
+    vm_qcow_name = build.get('vm_qcow_name')
+    vm_vcpus = build.get('vm_vcpus', 8)
+    vm_memory = build.get('vm_memory', 16384)
+    vm_os_variant = build.get('vm_os_variant', 'centos7.0')
+    vm_boot = build.get('vm_boot', 'hd,cdrom')
+    vm_cpu = build.get('vm_cpu', 'host')
+    vm_source = build.get('vm_source')
+    vm_model = build.get('vm_model')
+    vm_source_mode = build.get('vm_source_mode', 'bridge')
+
+    vm_network_net_a = build.get('vm_network_net_a')
+    vm_network_net_b = build.get('vm_network_net_b')
+
+    vm_network_app_a = build.get('vm_network_app_a')
+    vm_network_app_b = build.get('vm_network_app_b')
+
+    vm_network_mir_a = build.get('vm_network_mir_a')
+    vm_network_mir_b = build.get('vm_network_mir_b')
+
+    vm_hostname = build.get('vm_hostname')
+    vm_password = build.get('vm_password')
+    vm_hashed_password = cloud_init_sha512_crypt(
+        vm_password, salt=generate_random_salt(), rounds=5000,
+    )
+
+    vm_username = build.get('vm_username', 'root')
+
+    # ETO Network configuration
+    vm_static_ip_address = build.get('vm_static_ip_address')
+    vm_ip_gateway = build.get('vm_ip_gateway')
+    vm_ip_netmask = build.get('vm_ip_netmask')
+    vm_dns_server_1 = build.get('vm_dns_server_1')
+    vm_dns_server_2 = build.get('vm_dns_server_2')
+
+    if vm_static_ip_address is None:
+        log.info('Cannot connect to ETO unless a static IP is provided, please note that the default settings for the API will have to be changed manually')
+
+    log.info(f'[{hypervisor_hostname}] Step 1: Add the SSH keys')
+    # Step 1: Add the SSH keys
+    log_check_bool.append(
+        ansible_log_writer_analyzer(
+            install_log_name, 'echo Adding SSH Keys',
+        ),
+    )
+    make_sure_ssh_available = ansible_playbook_command('playbooks/ssh_setup_individual.yml', {
+        'hypervisor_username': hypervisor_username,
+        'hypervisor_password': hypervisor_password,
+        'hypervisor_hostname': hypervisor_hostname,
+    })
+    ssh_docker_command = f'docker exec -t {docker_name} {make_sure_ssh_available}'
+    log_check_bool.append(
+        ansible_log_writer_analyzer(
+            install_log_name, ssh_docker_command, log_level,
+            step='Step 1: Add the SSH keys',
+            timeout=build_step_timeout(build, 'ssh_setup'),
+        ),
+    )
+
+    # If failed stop this build
+    if ansible_run_check(log_check_bool):
+        log.error(f'[{hypervisor_hostname}] Failed Step 1')
+        return False
+
+    log.info(f'[{hypervisor_hostname}] Step 2: Install required packages and dependencies')
+    log_check_bool.append(
+        ansible_log_writer_analyzer(
+            install_log_name, 'echo Installing requirements',
+        ),
+    )
+    install_required_packages = ansible_playbook_command('playbooks/setup.yml', {
+        'hypervisor_hostname': hypervisor_hostname,
+        'vm_network_net_a': vm_network_net_a,
+        'vm_network_net_b': vm_network_net_b,
+        'vm_network_app_a': vm_network_app_a,
+        'vm_network_app_b': vm_network_app_b,
+        'vm_network_mir_a': vm_network_mir_a,
+        'vm_network_mir_b': vm_network_mir_b,
+        'vm_qcow_name': vm_qcow_name,
+    })
+    install_required_packages_docker_command = f'docker exec -t {docker_name} {install_required_packages}'
+    log_check_bool.append(
+        ansible_log_writer_analyzer(
+            install_log_name, install_required_packages_docker_command,
+            step='Step 2: Install required packages and dependencies',
+            timeout=build_step_timeout(build, 'setup'),
+        ),
+    )
+
+    # If failed stop this build
+    if ansible_run_check(log_check_bool):
+        log.error(f'[{hypervisor_hostname}] Failed Step 2')
+        return False
+
+    log.info(f'[{hypervisor_hostname}] Step 3: Run KVM Installation')
+    log_check_bool.append(
+        ansible_log_writer_analyzer(
+            install_log_name, 'echo Running Build',
+        ),
+    )
+    command_name = ansible_playbook_command('playbooks/install_kvm.yml', {
+        'hypervisor_hostname': hypervisor_hostname,
+        'hypervisor_vm_image_loc': hypervisor_vm_image_loc,
+        'hypervisor_dest_directory': hypervisor_dest_directory,
+        'vm_qcow_name': vm_qcow_name,
+        'vm_vcpus': vm_vcpus,
+        'vm_memory': vm_memory,
+        'vm_os_variant': vm_os_variant,
+        'vm_boot': vm_boot,
+        'vm_cpu': vm_cpu,
+        'vm_source': vm_source,
+        'vm_model': vm_model,
+        'vm_source_mode': vm_source_mode,
+        'vm_network_net_a': vm_network_net_a,
+        'vm_network_net_b': vm_network_net_b,
+        'vm_network_app_a': vm_network_app_a,
+        'vm_network_app_b': vm_network_app_b,
+        'vm_network_mir_a': vm_network_mir_a,
+        'vm_network_mir_b': vm_network_mir_b,
+        'vm_username': vm_username,
+        'vm_hashed_password': vm_hashed_password,
+        'vm_hostname': vm_hostname,
+        'vm_static_ip_address': vm_static_ip_address,
+        'vm_ip_gateway': vm_ip_gateway,
+        'vm_ip_netmask': vm_ip_netmask,
+        'vm_dns_server_1': vm_dns_server_1,
+        'vm_dns_server_2': vm_dns_server_2,
+        **build_optional_extra_vars(build),
+    })
+    docker_command = f'docker exec -t {docker_name} {command_name}'
+    log_check_bool.append(
+        ansible_log_writer_analyzer(
+            install_log_name, docker_command,
+            step='Step 3: Run KVM Installation',
+            timeout=build_step_timeout(build, 'install_kvm'),
+        ),
+    )
+
+    # If failed stop this build
+    if ansible_run_check(log_check_bool):
+        log.error(f'[{hypervisor_hostname}] Failed Step 3')
+        return False
+
+    log.info(f'[{hypervisor_hostname}] Step 4: Wait for the VM to be ready')
+    ready = wait_for_vms(
+        [vm_ready_target(hypervisor_hostname, build)],
+        query_states=functools.partial(query_domain_states, docker_name, vm_qcow_name=vm_qcow_name) if use_docker else None,
+        timeout=build_step_timeout(build, 'vm_ready'),
+    )
+    if not ready[hypervisor_hostname]:
+        log.error(f'[{hypervisor_hostname}] Failed Step 4')
+        return False
+
+    if vm_static_ip_address:
+        # Setup the VM Instance
+        log.info(f'[{hypervisor_hostname}] Step 5: Setup the VM via API')
+        log_check_bool.append(setup_eto_executor(build, install_log_name))
+    else:
+        log.warning('Cannot connect to ETO unless a static IP is provided')
+
+    return not ansible_run_check(log_check_bool)
+
+
+def setup_eto_executor(build, install_log_name):
+    """
+    Change the default API settings of the ETO of a build entry.
+
+    Parameters
+    ----------
+    build : dict
+        A dictionary containing the build options for one VM.
+    install_log_name : str
+        The name of the installation log file.
+
+    Returns
+    -------
+    bool
+        True if failures were detected, otherwise False (see `ansible_log_writer_analyzer`).
+    """
+    log_check_bool = [
+        ansible_log_writer_analyzer(
+            install_log_name, 'echo Setting up the ETO',
+        ),
+    ]
+    command_name = f"python3 /deploy/setup_eto.py --ip={build.get('vm_static_ip_address')} --username={build.get('vm_api_username')} --old_password={build.get('vm_old_password')} --password={build.get('vm_password')} --allow-enrollment={build.get('vm_allow_enrollment', True)}"
+    docker_command = f'docker exec -t {docker_name} {command_name}'
+    log_check_bool.append(
+        ansible_log_writer_analyzer(
+            install_log_name, docker_command,
+            step='Step 5: Setup the VM via API',
+            timeout=build_step_timeout(build, 'setup_eto'),
+        ),
+    )
+    return ansible_run_check(log_check_bool)
+
+
+def fleet_builder_func(build_options, install_log_name, log_level, forks=5, serial=0):
+    """
+    Deploy every build entry with one ansible-playbook run per step for the whole fleet.
+
+    Parameters
+    ----------
+    build_options : list
+        A list of dictionaries containing build options.
+    install_log_name : str
+        The name of the installation log file.
+    log_level : str
+        The logging level.
+    forks : int, optional
+        The number of hosts Ansible works on in parallel (default is 5).
+    serial : int, optional
+        The batch size of hosts running each play, 0 runs all hosts in one batch (default is 0).
+
+    Returns
+    -------
+    bool
+        True if every step succeeded, otherwise False.
+
+    Notes
+    -----
+    The configuration is turned into a single inventory (see `utils.fleet.fleet_inventory`)
+    so the hypervisors do not have to be added to the container inventory one by one. Steps 1
+    to 3 run once across all hosts, step 3 setting up all VMs of a hypervisor in a single
+    `setup_kvm.py --manifest` run. The VMs are then waited for together (see
+    `utils.readiness.wait_for_vms`) and the ETOs which came up are set up via the API together
+    by a single bulk run (see `utils.fleet.fleet_setup_etos`).
+    """
+    stages = [
+        ('Step 1: Add the SSH keys', 'Adding SSH Keys', 'playbooks/ssh_setup_individual.yml', 'ssh_setup'),
+        ('Step 2: Install required packages and dependencies', 'Installing requirements', 'playbooks/setup.yml', 'setup'),
+        ('Step 3: Run KVM Installation', 'Running Build', 'playbooks/install_kvm_batch.yml', 'install_kvm', fleet_hypervisor_group),
+    ]
+    if not fleet_execute(build_options, stages, install_log_name, log_level, docker_name, forks, serial):
+        log.error('Fleet Installation Failed\n')
+        return False
+
+    log.info(f'[{fleet_group}] Step 4: Wait for the VMs to be ready')
+    aliases = fleet_host_aliases(build_options)
+    ready = wait_for_vms(
+        [vm_ready_target(alias, build) for alias, build in zip(aliases, build_options)],
+        query_states=functools.partial(query_domain_states, docker_name, inventory_path=fleet_inventory_path),
+        timeout=fleet_step_timeout(build_options, 'vm_ready'),
+    )
+
+    results = {}
+    eto_builds = []
+    for alias, build in zip(aliases, build_options):
+        hypervisor_hostname = build.get('hypervisor_hostname')
+        if not ready[alias]:
+            results[hypervisor_hostname] = False
+        elif build.get('vm_static_ip_address'):
+            eto_builds.append(build)
+        else:
+            log.warning(f'[{hypervisor_hostname}] Cannot connect to ETO unless a static IP is provided')
+            results.setdefault(hypervisor_hostname, True)
+
+    if eto_builds:
+        log.info(f'[{fleet_group}] Step 5: Setup the VMs via API')
+        ansible_log_writer_analyzer(install_log_name, 'echo Setting up the ETOs')
+        eto_results = fleet_setup_etos(eto_builds, install_log_name, docker_name)
+        for build in eto_builds:
+            hypervisor_hostname = build.get('hypervisor_hostname')
+            ok = eto_results[build.get('vm_static_ip_address')]
+            if not ok:
+                log.error(f"[{hypervisor_hostname}] Failed to set up the ETO at {build.get('vm_static_ip_address')}")
+            results[hypervisor_hostname] = results.get(hypervisor_hostname, True) and ok
+
+    return log_deployment_summary(results)
+
+
+def deploy_hypervisor(hypervisor_hostname, builds, install_log_name, log_level, use_docker=True):
+    """
+    Deploy every build entry of one hypervisor, one after the other.
+
+    Parameters
+    ----------
+    hypervisor_hostname : str
+        The hostname of the hypervisor the builds are deployed on.
+    builds : list
+        The build options targeting `hypervisor_hostname`, in configuration order.
+    install_log_name : str
+        The name of the installation log file for this hypervisor.
+    log_level : str
+        The logging level.
+    use_docker : bool, optional
+        Whether the commands are run through the ansible docker container (default is True).
+
+    Returns
+    -------
+    bool
+        True if all builds succeeded, False if one of them failed.
+
+    Notes
+    -----
+    Builds sharing a hypervisor are kept sequential as they touch the same network
+    configuration and libvirt daemon. The remaining builds are skipped after a failure.
+    """
+    for build in builds:
+        try:
+            if not deploy_build(build, install_log_name, log_level, use_docker):
+                return False
+        except Exception as ex:
+            log.exception(f'[{hypervisor_hostname}] {ex}')
+            return False
+    return True
+
+
+def group_builds_by_hypervisor(build_options):
+    """
+    Group the build options by their hypervisor, keeping the configuration order.
+
+    Parameters
+    ----------
+    build_options : list
+        A list of dictionaries containing build options.
+
+    Returns
+    -------
+    dict
+        A mapping of hypervisor hostname to the list of its build options.
+    """
+    hypervisors = {}
+    for build in build_options:
+        hypervisors.setdefault(build.get('hypervisor_hostname'), []).append(build)
+    return hypervisors
+
+
+def hypervisor_log_name(install_log_name, hypervisor_hostname):
+    """
+    Derive the per-hypervisor log file name from the main installation log name.
+
+    Parameters
+    ----------
+    install_log_name : str
+        The name of the installation log file (e.g. logs/deploy-2024-01-01T00-00-00.log).
+    hypervisor_hostname : str
+        The hostname of the hypervisor.
+
+    Returns
+    -------
+    str
+        The log file name for the hypervisor (e.g. logs/deploy-2024-01-01T00-00-00-<hostname>.log).
+    """
+    base, ext = os.path.splitext(install_log_name)
+    return f"{base}-{re.sub(r'[^A-Za-z0-9_.-]', '_', str(hypervisor_hostname))}{ext}"
+
+
+def log_deployment_summary(results, action='Installation'):
+    """
+    Log which hypervisors succeeded and which failed.
+
+    Parameters
+    ----------
+    results : dict
+        A mapping of hypervisor hostname to its result (True if it succeeded).
+    action : str, optional
+        The name of the action reported in the summary (default is 'Installation').
+
+    Returns
+    -------
+    bool
+        True if every hypervisor succeeded, otherwise False.
+    """
+    succeeded = [host for host, result in results.items() if result]
+    failed = [host for host, result in results.items() if not result]
+    log.info(f'{action} summary: {len(succeeded)} succeeded, {len(failed)} failed')
+    for host in succeeded:
+        log.info(f'{host} {action} Succeeded')
+    for host in failed:
+        log.error(f'{host} {action} Failed')
+    return len(failed) == 0
+
+
+def builder_func(build_options, install_log_name, log_level, use_docker=True, parallel=1):
     """
     Execute a series of build steps based on provided options.
 
@@ -33,10 +456,15 @@ def builder_func(build_options, install_log_name, log_level, use_docker=True):
         The name of the installation log file.
     log_level : str
         The logging level.
+    use_docker : bool, optional
+        Whether the commands are run through the ansible docker container (default is True).
+    parallel : int, optional
+        The number of hypervisors deployed at the same time (default is 1).
 
     Returns
     -------
-    None
+    bool
+        True if every build succeeded, otherwise False.
 
     Notes
     -----
@@ -46,191 +474,41 @@ def builder_func(build_options, install_log_name, log_level, use_docker=True):
     The function logs each step and checks for failures using the `ansible_log_writer_analyzer`
     and `ansible_run_check` functions. If a failure occurs, the function logs an error message
     and returns False. Otherwise, it returns True upon successful completion.
+
+    When `parallel` is greater than 1 the builds are grouped per hypervisor and up to
+    `parallel` hypervisors are deployed concurrently. Each hypervisor then writes its
+    command output to its own log file (see `hypervisor_log_name`) and a failure only
+    stops the builds of that hypervisor. A summary of the results is logged at the end.
     """
-    log_check_bool = []
+    results = {}
 
-    for build in build_options:
-        # -- Hypervisor
-        hypervisor_hostname = build.get('hypervisor_hostname')
-        hypervisor_username = build.get('hypervisor_username')
-        hypervisor_password = build.get('hypervisor_password')
-
-        # -- VM Configuration
-        hypervisor_vm_image_loc = build.get('hypervisor_vm_image_loc')
-        hypervisor_dest_directory = build.get('hypervisor_dest_directory')
-        vm_qcow_name = build.get('vm_qcow_name')
-        vm_vcpus = build.get('vm_vcpus', 8)
-        vm_memory = build.get('vm_memory', 16384)
-        vm_os_variant = build.get('vm_os_variant', 'centos7.0')
-        vm_boot = build.get('vm_boot', 'hd,cdrom')
-        vm_cpu = build.get('vm_cpu', 'host')
-        vm_source = build.get('vm_source')
-        vm_model = build.get('vm_model')
-        vm_source_mode = build.get('vm_source_mode', 'bridge')
-
-        vm_network_net_a = build.get('vm_network_net_a')
-        vm_network_net_b = build.get('vm_network_net_b')
-
-        vm_network_app_a = build.get('vm_network_app_a')
-        vm_network_app_b = build.get('vm_network_app_b')
-
-        vm_network_mir_a = build.get('vm_network_mir_a')
-        vm_network_mir_b = build.get('vm_network_mir_b')
-
-        vm_hostname = build.get('vm_hostname')
-        vm_password = build.get('vm_password')
-        vm_hashed_password = cloud_init_sha512_crypt(
-            vm_password, salt=generate_random_salt(), rounds=5000,
-        )
-        vm_hashed_password = vm_hashed_password.replace('$', '\\$')
-
-        vm_old_password = build.get('vm_old_password')
-        vm_username = build.get('vm_username', 'root')
-
-        # ETO Network configuration
-        vm_static_ip_address = build.get('vm_static_ip_address')
-        vm_ip_gateway = build.get('vm_ip_gateway')
-        vm_ip_netmask = build.get('vm_ip_netmask')
-        vm_dns_server_1 = build.get('vm_dns_server_1')
-        vm_dns_server_2 = build.get('vm_dns_server_2')
-
-        # ETO API Config
-        vm_api_username = build.get('vm_api_username')
-        vm_allow_enrollment = build.get('vm_allow_enrollment')
-
-        if vm_static_ip_address is None:
-            log.info('Cannot connect to ETO unless a static IP is provided, please note that the default settings for the API will have to be changed manually')
-
-        # Check if it was not successfully added to the inventory
-        if not ansible_add_to_inventory_executor(
-            hostname=hypervisor_hostname,
-            username=hypervisor_username,
-            password=hypervisor_password,
-            use_docker=use_docker,
-            docker_name=docker_name,
-            install_log_name=install_log_name,
-            log_level=log_level,
-        ):
-            raise Exception(
-                f'Something went wrong when adding {hypervisor_hostname} to the inventory',
+    if parallel <= 1:
+        for build in build_options:
+            hypervisor_hostname = build.get('hypervisor_hostname')
+            results[hypervisor_hostname] = deploy_build(
+                build, install_log_name, log_level, use_docker,
             )
-
-        log.info('Step 1: Add the SSH keys')
-        # Step 1: Add the SSH keys
-        log_check_bool.append(
-            ansible_log_writer_analyzer(
-                install_log_name, 'echo Adding SSH Keys',
-            ),
-        )
-        make_sure_ssh_available = f'ansible-playbook playbooks/ssh_setup_individual.yml --extra-vars "hypervisor_username={hypervisor_username} hypervisor_password={hypervisor_password} hypervisor_hostname={hypervisor_hostname}"'
-        ssh_docker_command = f'docker exec -t {docker_name} {make_sure_ssh_available}'
-        log_check_bool.append(
-            ansible_log_writer_analyzer(
-                install_log_name, ssh_docker_command, log_level,
-            ),
-        )
-
-        # If failed exit the loop
-        if ansible_run_check(log_check_bool):
-            log.error('Failed Step 1')
-            break
-
-        log.info('Step 2: Install required packages and dependencies')
-        log_check_bool.append(
-            ansible_log_writer_analyzer(
-                install_log_name, 'echo Installing requirements',
-            ),
-        )
-        install_required_packages = f'ansible-playbook playbooks/setup.yml --extra-vars \
-            "hypervisor_hostname={hypervisor_hostname}\
-             vm_network_net_a={vm_network_net_a}\
-             vm_network_net_b={vm_network_net_b}\
-             vm_network_app_a={vm_network_app_a}\
-             vm_network_app_b={vm_network_app_b}\
-             vm_network_mir_a={vm_network_mir_a}\
-             vm_network_mir_b={vm_network_mir_b}\
-             vm_qcow_name={vm_qcow_name}"'
-        install_required_packages_docker_command = f'docker exec -t {docker_name} {install_required_packages}'
-        log_check_bool.append(
-            ansible_log_writer_analyzer(
-                install_log_name, install_required_packages_docker_command,
-            ),
-        )
-
-        # If failed exit the loop
-        if ansible_run_check(log_check_bool):
-            log.error('Failed Step 2')
-            break
-
-        log.info('Step 3: Run KVM Installation')
-        log_check_bool.append(
-            ansible_log_writer_analyzer(
-                install_log_name, 'echo Running Build',
-            ),
-        )
-        command_name = f'ansible-playbook playbooks/install_kvm.yml --extra-vars \
-            "hypervisor_hostname={hypervisor_hostname}\
-             hypervisor_vm_image_loc={hypervisor_vm_image_loc}\
-             hypervisor_dest_directory={hypervisor_dest_directory}\
-             vm_qcow_name={vm_qcow_name}\
-             vm_vcpus={vm_vcpus}\
-             vm_memory={vm_memory}\
-             vm_os_variant={vm_os_variant}\
-             vm_boot={vm_boot}\
-             vm_cpu={vm_cpu}\
-             vm_source={vm_source}\
-             vm_model={vm_model}\
-             vm_source_mode={vm_source_mode}\
-             vm_network_net_a={vm_network_net_a}\
-             vm_network_net_b={vm_network_net_b}\
-             vm_network_app_a={vm_network_app_a}\
-             vm_network_app_b={vm_network_app_b}\
-             vm_network_mir_a={vm_network_mir_a}\
-             vm_network_mir_b={vm_network_mir_b}\
-             vm_username={vm_username}\
-             vm_hashed_password={vm_hashed_password}\
-             vm_hostname={vm_hostname}\
-             vm_static_ip_address={vm_static_ip_address}\
-             vm_ip_gateway={vm_ip_gateway}\
-             vm_ip_netmask={vm_ip_netmask}\
-             vm_dns_server_1={vm_dns_server_1}\
-             vm_dns_server_2={vm_dns_server_2}"'
-        docker_command = f'docker exec -t {docker_name} {command_name}'
-        log_check_bool.append(
-            ansible_log_writer_analyzer(
-                install_log_name, docker_command,
-            ),
-        )
-
-        # If failed break out of the loop
-        if ansible_run_check(log_check_bool):
-            log.error('Failed Step 3')
-            break
-
-        if vm_static_ip_address:
-            # Setup the VM Instance
-            log.info('Step 4: Setup the VM via API')
-            log_check_bool.append(
-                ansible_log_writer_analyzer(
-                    install_log_name, 'echo Setting up the ETO',
-                ),
+            # If failed exit the loop
+            if not results[hypervisor_hostname]:
+                break
+        return log_deployment_summary(results)
+
+    hypervisors = group_builds_by_hypervisor(build_options)
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        futures = {}
+        for hypervisor_hostname, builds in hypervisors.items():
+            host_log_name = hypervisor_log_name(
+                install_log_name, hypervisor_hostname,
             )
-            command_name = f'python3 /deploy/setup_eto.py --ip={vm_static_ip_address} --username={vm_api_username} --old_password={vm_old_password} --password={vm_password} --allow-enrollment={vm_allow_enrollment}'
-            docker_command = f'docker exec -t {docker_name} {command_name}'
-            log_check_bool.append(
-                ansible_log_writer_analyzer(
-                    install_log_name, docker_command,
-                ),
+            log.info(f'[{hypervisor_hostname}] Logs are stored in {host_log_name}')
+            futures[hypervisor_hostname] = executor.submit(
+                deploy_hypervisor, hypervisor_hostname, builds,
+                host_log_name, log_level, use_docker,
             )
-        else:
-            log.warning('Cannot connect to ETO unless a static IP is provided')
+        for hypervisor_hostname, future in futures.items():
+            results[hypervisor_hostname] = future.result()
 
-    if ansible_run_check(log_check_bool):
-        log.error(hypervisor_hostname + ' Installation Failed\n')
-        return False
-    else:
-        log.info(hypervisor_hostname + ' Installation Succeeded\n')
-        return True
+    return log_deployment_summary(results)
 
 
 def parse_deployment_arguments():
@@ -245,7 +523,7 @@ def parse_deployment_arguments():
     Example
     -------
     Example usage:
-        python deploy.py --config /path/to/config.json --log-dir /path/to/logs --log-level DEBUG --allow-enrollment True
+        python deploy.py --config /path/to/config.json --log-dir /path/to/logs --log-level DEBUG --allow-enrollment True --parallel 4
 
     Notes
     -----
@@ -269,6 +547,50 @@ def parse_deployment_arguments():
     parser.add_argument(
         '--allow-enrollment', type=bool, default=False,
     )
+    parser.add_argument(
+        '--parallel', type=int, default=1, metavar='N',
+        help='Number of hypervisors to deploy at the same time, each with its own log file (default: 1)',
+    )
+    parser.add_argument(
+        '--stream-logs', action='store_true',
+        help='Write the command output to the log file line by line while it runs',
+    )
+    parser.add_argument(
+        '--fail-fast', action='store_true',
+        help='Kill a running playbook as soon as a task fails, a host is unreachable or a traceback is printed',
+    )
+    parser.add_argument(
+        '--step-timeout', type=float, default=None, metavar='SECONDS',
+        help='Seconds a step may run before it is killed and marked as timed out, build entries can override it with step_timeouts (default: no limit)',
+    )
+    parser.add_argument(
+        '--playbook-backend', choices=ansible_playbook_backends, default='ansible-playbook',
+        help='Run the playbooks with ansible-playbook, judged by their output, or through the ansible-runner API, judged by their events (default: ansible-playbook)',
+    )
+    parser.add_argument(
+        '--no-agent', action='store_true',
+        help='Start docker exec for every step instead of sending the steps to the command agent of the container',
+    )
+    parser.add_argument(
+        '--fleet', action='store_true',
+        help='Run every playbook once across all hosts of the configuration instead of once per host',
+    )
+    parser.add_argument(
+        '--forks', type=int, default=5,
+        help='Number of hosts Ansible works on in parallel in fleet mode (default: 5)',
+    )
+    parser.add_argument(
+        '--serial', type=int, default=0,
+        help='Batch size of hosts running each play in fleet mode, 0 runs all hosts at once (default: 0)',
+    )
+    parser.add_argument(
+        '--vm-ready-timeout', type=float, default=900, metavar='SECONDS',
+        help='Seconds a VM may take to boot before it is marked as failed, build entries can override it with step_timeouts (default: 900)',
+    )
+    parser.add_argument(
+        '--seed-server', type=str, default=None, metavar='URL',
+        help='Serve the cloud-init seeds from this machine at URL (e.g. http://10.0.0.2:8000/), which the VMs must reach, instead of building an ISO on each hypervisor',
+    )
     args = parser.parse_args()
     return args
 
@@ -281,8 +603,11 @@ if __name__ == '__main__':
     3. Sets up logging, creating a log file path based on the current timestamp and specified log directory.
     4. Creates the log directory if it doesn't exist.
     5. Reads configuration data from a JSON file specified in the arguments.
-    6. Initiates deployment, displaying progress and storing logs in the specified log file.
-    7. Outputs messages indicating the start and end of deployment.
+    6. With --seed-server, starts serving the cloud-init seed of every build entry (see `utils.seed_server`).
+    7. Copies the configuration into the container, where it is the Ansible inventory (see `inventory.py`).
+    8. Unless --no-agent is given, starts the command agent of the container (see `utils.agent`).
+    9. Initiates deployment, displaying progress and storing logs in the specified log file.
+    10. Outputs messages indicating the start and end of deployment.
     """
 
     args = parse_deployment_arguments()
@@ -330,6 +655,11 @@ if __name__ == '__main__':
         os.makedirs(os.path.dirname(log_file_path))
     log_level = str.upper(args.log_level)
     setup_logging(log_file_path, log_level=log_level)
+    ansible_runner_configure(
+        stream=args.stream_logs, fail_fast=args.fail_fast, timeout=args.step_timeout,
+        backend=args.playbook_backend,
+    )
+    readiness_configure(timeout=args.vm_ready_timeout)
 
     # Get the data from the JSON file
     config_file_path = args.config
@@ -339,10 +669,26 @@ if __name__ == '__main__':
     # Begin Deployment
     print(colors.GREEN + 'Deployment has begun' + colors.END)
     print(f'Logs are stored in {log_file_path}')
-    result = builder_func(
-        configuration, log_file_path,
-        log_level, use_docker=True,
-    )
+    # The seed server runs until the end of the deployment, the VMs fetch their seed when they first boot
+    seeds = seed_server(args.seed_server, configuration) if args.seed_server else contextlib.nullcontext()
+    # Every step is sent to the command agent of the container instead of its own docker exec
+    agent = container_agent(docker_name) if not args.no_agent else contextlib.nullcontext()
+    with seeds as server, agent as running_agent:
+        readiness_configure(seed_server=server)
+        ansible_runner_configure(agent=running_agent)
+        if args.fleet:
+            result = fleet_builder_func(
+                configuration, log_file_path, log_level,
+                forks=args.forks, serial=args.serial,
+            )
+        else:
+            # The hypervisors are found in the dynamic inventory generated from the configuration
+            if not fleet_config_install(configuration, docker_name):
+                raise Exception('Something went wrong when copying the configuration')
+            result = builder_func(
+                configuration, log_file_path,
+                log_level, use_docker=True, parallel=args.parallel,
+            )
     print(
         (colors.GREEN if result else colors.RED),
         'Deployment has Ended', colors.END,
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import sys
+
+from utils.fleet import fleet_config_path
+from utils.fleet import fleet_dynamic_inventory
+
+
+def load_configuration(config_path):
+    """
+    Read the deployment configuration, an empty one when the file does not exist yet.
+    """
+    if not os.path.exists(config_path):
+        return []
+    with open(config_path) as json_file:
+        return json.load(json_file)
+
+
+def parse_inventory_arguments():
+    """
+    Parse the command-line arguments Ansible passes to a dynamic inventory.
+
+    Returns
+    -------
+    argparse.Namespace
+        Parsed command-line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Ansible dynamic inventory of the deployment configuration')
+    parser.add_argument(
+        '--list', action='store_true',
+        help='Print every group and the variables of every host',
+    )
+    parser.add_argument(
+        '--host', type=str,
+        help='Print the variables of a host',
+    )
+    parser.add_argument(
+        '--config', type=str, default=os.environ.get('DEPLOY_CONFIG', fleet_config_path),
+        help=f'Path to deployment configuration file (default: DEPLOY_CONFIG or {fleet_config_path})',
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    """This script is the dynamic inventory of the ansible container. When executed directly, it:
+
+    1. Reads the deployment configuration installed by deploy.py and cleanup.py (see `utils.fleet.fleet_config_install`).
+    2. With --list, prints the groups and host variables generated from it (see `utils.fleet.fleet_dynamic_inventory`).
+    3. With --host, prints the variables of one host.
+    """
+
+    args = parse_inventory_arguments()
+    inventory = fleet_dynamic_inventory(load_configuration(args.config))
+    if args.host:
+        json.dump(inventory['_meta']['hostvars'].get(args.host, {}), sys.stdout)
+    else:
+        json.dump(inventory, sys.stdout)
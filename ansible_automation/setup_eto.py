@@ -1,13 +1,291 @@
 import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
 import time
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 
+import requests
 import urllib3
 from bravado.client import SwaggerClient
 from bravado.client import SwaggerFormat
 from bravado.requests_client import RequestsClient
+from requests.adapters import HTTPAdapter
 
+# Directory the API specs of the ETOs are cached in, see `fetch_swagger_spec`
+spec_cache_directory = os.path.join(os.path.expanduser('~'), '.cache', 'setup_eto')
 
-def connect(server_url, username=None, password=None, new_password=None, ssl_verify=True):
+# Seconds to wait for the API spec of an ETO
+spec_request_timeout = 60
+
+# Content of the spec files by path, read once per process
+_spec_memo = {}
+
+# Retry policy of `setup_eto_with_retry`: exponential backoff from the base delay up to the
+# maximum delay, with jitter, until the retries or the deadline in seconds run out
+retry_max_retries = 30
+retry_base_delay = 2
+retry_max_delay = 30
+retry_deadline = 600
+
+# Consecutive authentication failures after which the credentials are taken as wrong
+retry_max_auth_failures = 3
+
+# Kinds of errors told apart by `classify_error`
+error_connection = 'connection'
+error_auth = 'auth'
+error_request = 'request'
+error_unknown = 'unknown'
+
+# HTTP statuses met while the ETO is still booting, retried like connection errors
+retry_http_statuses = (404, 408, 425, 429)
+
+# Number of ETOs set up at the same time by `setup_etos_bulk`
+bulk_workers = 32
+
+# Fields of an entry of the `--bulk` list, `allow_enrollment` defaulting to True
+bulk_required_fields = ('ip', 'username', 'old_password', 'password')
+
+
+def swagger_client_config():
+    """
+    Build the bravado configuration of the ETO API clients.
+    """
+    return {
+        'validate_responses': False,
+        'validate_requests': True,
+        'validate_swagger_spec': False,
+        'use_models': False,
+        'formats': [
+            SwaggerFormat(
+                format='uri',
+                to_wire=lambda b: b if isinstance(b, str) else str(b),
+                to_python=lambda s: s if isinstance(s, str) else str(s),
+                validate=lambda v: v,
+                description='Converts [wire]string:byte <=> python byte',
+            ),
+            SwaggerFormat(
+                format='email',
+                to_wire=lambda b: b if isinstance(b, str) else str(b),
+                to_python=lambda s: s if isinstance(s, str) else str(s),
+                validate=lambda v: v,
+                description='Converts [wire]string:byte <=> python byte',
+            ),
+            SwaggerFormat(
+                format='ipv4',
+                to_wire=lambda b: b if isinstance(b, str) else str(b),
+                to_python=lambda s: s if isinstance(s, str) else str(s),
+                validate=lambda v: v,
+                description='Converts [wire]string:byte <=> python byte',
+            ),
+            SwaggerFormat(
+                format='ipv6',
+                to_wire=lambda b: b if isinstance(b, str) else str(b),
+                to_python=lambda s: s if isinstance(s, str) else str(s),
+                validate=lambda v: v,
+                description='Converts [wire]string:byte <=> python byte',
+            ),
+        ],
+    }
+
+
+def _write_atomic(path, data):
+    """
+    Write a file of the spec cache through a temporary file, so that concurrent runs never read half of it.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as temp_file:
+        temp_file.write(data)
+    os.replace(temp_file.name, path)
+
+
+def load_spec_file(path):
+    """
+    Parse a swagger spec file, reading it only once for the life of the process.
+
+    Parameters
+    ----------
+    path : str
+        The path of the spec, a cached or bundled swagger.json.
+
+    Returns
+    -------
+    dict
+        The spec, a new copy on every call: bravado annotates the spec dict of a client with the
+        URL it was loaded from, so clients of different servers cannot share one.
+    """
+    path = os.path.abspath(path)
+    content = _spec_memo.get(path)
+    if content is None:
+        with open(path, 'rb') as spec_file:
+            content = _spec_memo[path] = spec_file.read()
+    return json.loads(content)
+
+
+def fetch_swagger_spec(session, server_url, ssl_verify=True, spec_cache=spec_cache_directory):
+    """
+    Get the API spec of a server, downloading it only when it differs from the cached one.
+
+    Parameters
+    ----------
+    session : requests.Session
+        The HTTP session to download the spec with.
+    server_url : str
+        The URL of the API of the server.
+    ssl_verify : bool, optional
+        Whether to verify SSL certificates (default is True).
+    spec_cache : str, optional
+        The directory of the spec cache (default is spec_cache_directory). None disables the cache.
+
+    Returns
+    -------
+    dict
+        The spec.
+
+    Notes
+    -----
+    The specs are stored once per content under `<spec_cache>/specs/<sha256>.json`, so every ETO
+    running the same software version shares one file. `<spec_cache>/servers/` records per server
+    the hash and the ETag and Last-Modified headers of its spec, sent back as If-None-Match and
+    If-Modified-Since: an unchanged spec costs a 304 response, and an upgraded ETO sends its new spec.
+    """
+    spec_url = f'{server_url}/swagger.json'
+    if spec_cache is None:
+        response = session.get(spec_url, verify=ssl_verify, timeout=spec_request_timeout)
+        response.raise_for_status()
+        return response.json()
+
+    server_path = os.path.join(spec_cache, 'servers', hashlib.sha256(server_url.encode()).hexdigest() + '.json')
+    try:
+        with open(server_path) as server_file:
+            server_entry = json.load(server_file)
+        spec_path = os.path.join(spec_cache, 'specs', server_entry['sha256'] + '.json')
+        if not os.path.exists(spec_path):
+            server_entry = None
+    except (OSError, ValueError, KeyError):
+        server_entry = None
+
+    headers = {}
+    if server_entry is not None:
+        if server_entry.get('etag'):
+            headers['If-None-Match'] = server_entry['etag']
+        if server_entry.get('last_modified'):
+            headers['If-Modified-Since'] = server_entry['last_modified']
+    response = session.get(spec_url, headers=headers, verify=ssl_verify, timeout=spec_request_timeout)
+    if response.status_code == 304 and server_entry is not None:
+        return load_spec_file(spec_path)
+    response.raise_for_status()
+
+    spec = response.json()
+    spec_hash = hashlib.sha256(response.content).hexdigest()
+    spec_path = os.path.join(spec_cache, 'specs', spec_hash + '.json')
+    _spec_memo.setdefault(os.path.abspath(spec_path), response.content)
+    try:
+        if not os.path.exists(spec_path):
+            _write_atomic(spec_path, response.content)
+        _write_atomic(server_path, json.dumps({
+            'server_url': server_url,
+            'sha256': spec_hash,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }).encode())
+    except OSError as e:
+        print(f'Could not cache the API spec of {server_url}: {e}')
+    return spec
+
+
+def load_swagger_client(
+        server_url, ssl_verify=True, spec_cache=spec_cache_directory, bundled_spec=None, http_adapter=None,
+        bundled_spec_only=False,
+):
+    """
+    Load the API specification of a server into a SwaggerClient instance.
+
+    Parameters
+    ----------
+    server_url : str
+        The URL of the server to connect to.
+    ssl_verify : bool, optional
+        Whether to verify SSL certificates (default is True).
+    spec_cache : str, optional
+        The directory of the spec cache, see `fetch_swagger_spec` (default is spec_cache_directory).
+        None downloads the spec every time.
+    bundled_spec : str, optional
+        The path of a swagger.json used when the spec of the server cannot be fetched or
+        revalidated (default is None). It must match the software version of the ETO.
+    http_adapter : HTTPAdapter, optional
+        The adapter, and so the pool of keep-alive connections, of the HTTP session (default is
+        None, a new one). Clients set up together share one, see `setup_etos_bulk`.
+    bundled_spec_only : bool, optional
+        Whether `bundled_spec` is used straight away, never requesting the spec of the server
+        (default is False).
+
+    Returns
+    -------
+    swagger_client : SwaggerClient
+        A SwaggerClient instance for the specified server, not logged in. Its HTTP session keeps
+        the cookies of a later login.
+
+    Notes
+    -----
+    The spec comes from the spec cache or is downloaded (see `fetch_swagger_spec`). The bundled
+    spec stands in when that fails with an HTTP error, a timeout or an invalid spec, but not
+    when the server cannot be reached at all: the error is raised then, and the next attempt
+    asks the server again.
+    """
+    if not ssl_verify:
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    http_client = RequestsClient(ssl_verify=ssl_verify)
+    if http_adapter is not None:
+        http_client.session.mount('https://', http_adapter)
+        http_client.session.mount('http://', http_adapter)
+    if bundled_spec is not None and bundled_spec_only:
+        spec = load_spec_file(bundled_spec)
+    else:
+        try:
+            spec = fetch_swagger_spec(http_client.session, server_url, ssl_verify, spec_cache)
+        except requests.exceptions.ConnectionError:
+            raise
+        except (requests.exceptions.RequestException, ValueError) as e:
+            if bundled_spec is None:
+                raise
+            print(f'Could not get the API spec of {server_url} ({type(e).__name__}: {e}), using {bundled_spec}')
+            spec = load_spec_file(bundled_spec)
+    # A spec shared between ETOs may name the host it was downloaded from, requests go to this server
+    parsed_url = urlparse(server_url)
+    spec['host'] = parsed_url.netloc
+    spec['schemes'] = [parsed_url.scheme]
+    swagger_client = SwaggerClient.from_spec(
+        spec,
+        origin_url='%s/swagger.json' % server_url,
+        http_client=http_client,
+        config=swagger_client_config(),
+    )
+    swagger_client.server_url = server_url
+    return swagger_client
+
+
+def auth_login(swagger_client, username, password, new_password=None):
+    """
+    Log in to the API of a server, changing the password when `new_password` is given.
+    """
+    swagger_client.auth.auth_login_create(
+        data=swagger_client.get_model('Login')(
+            username=username, password=password, new_password=new_password,
+        ),
+    ).response().result
+
+
+def connect(
+        server_url, username=None, password=None, new_password=None, ssl_verify=True,
+        spec_cache=spec_cache_directory, bundled_spec=None, bundled_spec_only=False,
+):
     """
     Connect to a server and return a SwaggerClient instance.
 
@@ -23,6 +301,12 @@ def connect(server_url, username=None, password=None, new_password=None, ssl_ver
         The new password to set (default is None).
     ssl_verify : bool, optional
         Whether to verify SSL certificates (default is True).
+    spec_cache : str, optional
+        The directory of the spec cache (default is spec_cache_directory), see `load_swagger_client`.
+    bundled_spec : str, optional
+        The path of a swagger.json used when the spec of the server cannot be fetched (default is None).
+    bundled_spec_only : bool, optional
+        Whether `bundled_spec` is used without requesting the spec of the server (default is False).
 
     Returns
     -------
@@ -37,61 +321,104 @@ def connect(server_url, username=None, password=None, new_password=None, ssl_ver
     is performed using the provided credentials. If `new_password` is provided, it is used for changing
     the password. The resulting SwaggerClient instance is returned.
     """
-    if not ssl_verify:
-        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-    http_client = RequestsClient(ssl_verify=ssl_verify)
-    swagger_client = SwaggerClient.from_url(
-        '%s/swagger.json' % server_url,
-        http_client=http_client,
-        config={
-            'validate_responses': False,
-            'validate_requests': True,
-            'validate_swagger_spec': False,
-            'use_models': False,
-            'formats': [
-                SwaggerFormat(
-                    format='uri',
-                    to_wire=lambda b: b if isinstance(b, str) else str(b),
-                    to_python=lambda s: s if isinstance(s, str) else str(s),
-                    validate=lambda v: v,
-                    description='Converts [wire]string:byte <=> python byte',
-                ),
-                SwaggerFormat(
-                    format='email',
-                    to_wire=lambda b: b if isinstance(b, str) else str(b),
-                    to_python=lambda s: s if isinstance(s, str) else str(s),
-                    validate=lambda v: v,
-                    description='Converts [wire]string:byte <=> python byte',
-                ),
-                SwaggerFormat(
-                    format='ipv4',
-                    to_wire=lambda b: b if isinstance(b, str) else str(b),
-                    to_python=lambda s: s if isinstance(s, str) else str(s),
-                    validate=lambda v: v,
-                    description='Converts [wire]string:byte <=> python byte',
-                ),
-                SwaggerFormat(
-                    format='ipv6',
-                    to_wire=lambda b: b if isinstance(b, str) else str(b),
-                    to_python=lambda s: s if isinstance(s, str) else str(s),
-                    validate=lambda v: v,
-                    description='Converts [wire]string:byte <=> python byte',
-                ),
-            ],
-        },
+    swagger_client = load_swagger_client(
+        server_url, ssl_verify, spec_cache, bundled_spec, bundled_spec_only=bundled_spec_only,
     )
     if username is not None and password is not None:
-        swagger_client.auth.auth_login_create(
-            data=swagger_client.get_model('Login')(
-                username=username, password=password, new_password=new_password,
-            ),
-        ).response().result
-    swagger_client.server_url = server_url
+        auth_login(swagger_client, username, password, new_password)
     return swagger_client
 
 
-def setup_eto_with_retry(hostname, username, old_password, password, allow_enrollment, max_retries=30, retry_delay=5):
+def retry_delays(base_delay=retry_base_delay, max_delay=retry_max_delay, jitter=True):
+    """
+    Yield the delays between attempts: exponential backoff with jitter.
+
+    Parameters
+    ----------
+    base_delay : float, optional
+        The delay before the second attempt (default is retry_base_delay).
+    max_delay : float, optional
+        The longest delay (default is retry_max_delay).
+    jitter : bool, optional
+        Whether each delay is drawn at random between half and all of its backoff value, so
+        that ETOs booted at the same time do not retry in lockstep (default is True).
+
+    Yields
+    ------
+    float
+        The number of seconds to wait before the next attempt.
+    """
+    attempt = 0
+    while True:
+        delay = min(max_delay, base_delay * 2 ** attempt)
+        yield random.uniform(delay / 2, delay) if jitter else delay
+        attempt += 1
+
+
+def classify_error(error):
+    """
+    Tell whether an error of an API call is worth retrying.
+
+    Parameters
+    ----------
+    error : Exception
+        The error raised by the SwaggerClient or the HTTP session.
+
+    Returns
+    -------
+    str
+        error_connection for errors reaching the ETO (refused or reset connections, timeouts,
+        5xx and the statuses of retry_http_statuses), error_auth for 401 and 403, error_request
+        for the other 4xx, which retrying will not fix, and error_unknown otherwise.
+    """
+    status_code = getattr(error, 'status_code', None)
+    if status_code is None and isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        status_code = error.response.status_code
+    if status_code in (401, 403):
+        return error_auth
+    if status_code is not None and (status_code >= 500 or status_code in retry_http_statuses):
+        return error_connection
+    if status_code is not None and 400 <= status_code < 500:
+        return error_request
+    if isinstance(error, (ConnectionError, TimeoutError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return error_connection
+    return error_unknown
+
+
+def login(swagger_client, username, old_password, password):
+    """
+    Log in with the old password, changing it to the new one, or with the new password.
+
+    Notes
+    -----
+    An earlier attempt may have changed the password before its response was lost, so a
+    refused old password is followed by a login with the new password.
+    """
+    try:
+        auth_login(swagger_client, username, old_password, password)
+    except Exception as e:
+        if classify_error(e) != error_auth:
+            raise
+        print(f'[{swagger_client.server_url}] The old password was refused, logging in with the new password')
+        auth_login(swagger_client, username, password)
+
+
+def setup_eto_with_retry(
+        hostname,
+        username,
+        old_password,
+        password,
+        allow_enrollment,
+        max_retries=retry_max_retries,
+        retry_delay=retry_base_delay,
+        max_delay=retry_max_delay,
+        deadline=retry_deadline,
+        spec_cache=spec_cache_directory,
+        bundled_spec=None,
+        http_adapter=None,
+        scheme='https',
+        bundled_spec_only=False,
+):
     """
     Setup ETO (Encrypted Traffic Orchestrator) and change it's enrollment state to allow.
 
@@ -105,76 +432,320 @@ def setup_eto_with_retry(hostname, username, old_password, password, allow_enrol
         The old password for authentication.
     password : str
         The new password for authentication.
+    allow_enrollment : bool
+        Whether the enrollment state is changed to allow.
     max_retries : int, optional
-        The maximum number of retries in case of failure. Default is 30.
-    retry_delay : int, optional
-        The delay (in seconds) between retries. Default is 5.
+        The maximum number of attempts. Default is retry_max_retries.
+    retry_delay : float, optional
+        The delay (in seconds) before the first retry, doubled on every retry. Default is retry_base_delay.
+    max_delay : float, optional
+        The longest delay (in seconds) between retries. Default is retry_max_delay.
+    deadline : float, optional
+        The number of seconds after which no attempt is started anymore. Default is retry_deadline.
+    spec_cache : str, optional
+        The directory of the API spec cache, None to download the spec every time. Default is spec_cache_directory.
+    bundled_spec : str, optional
+        The path of a swagger.json used when the spec of the ETO cannot be fetched. Default is None.
+    http_adapter : HTTPAdapter, optional
+        The adapter shared with the clients of other ETOs. Default is None, a new one.
+    scheme : str, optional
+        The scheme of the API URL, 'http' for test servers. Default is 'https'.
+    bundled_spec_only : bool, optional
+        Whether `bundled_spec` is used without requesting the spec of the ETO. Default is False.
+
+    Returns
+    -------
+    SwaggerClient
+        The logged in client.
 
     Raises
     ------
+    PermissionError
+        If neither password is accepted retry_max_auth_failures times in a row.
     SystemError
-        If the maximum number of retries is reached without success.
+        If the ETO rejects a request, or if the retries or the deadline run out without success.
+
+    Notes
+    -----
+    The API specification is loaded once, from the spec cache when possible and from the bundled
+    spec when it cannot be fetched (see `load_swagger_client`), and the client reused by later attempts, each
+    attempt only redoing the steps which have not succeeded yet. Errors are classified by
+    `classify_error`: connection errors are retried with the backoff of `retry_delays`,
+    rejected requests fail straight away.
     """
+    server_url = f'{scheme}://{hostname}/api'
+    deadline_at = time.monotonic() + deadline
+    delays = retry_delays(retry_delay, max_delay)
+    client = None
+    logged_in = False
+    enrolled = not allow_enrollment
+    auth_failures = 0
+
     for attempt in range(1, max_retries + 1):
+        stage = 'connection'
         try:
-            try:
-                # Changing password from old to new for initial login
-                client = connect(
-                    f'https://{hostname}/api', username, old_password, password, False,
+            if client is None:
+                client = load_swagger_client(
+                    server_url, ssl_verify=False, spec_cache=spec_cache,
+                    bundled_spec=bundled_spec, http_adapter=http_adapter,
+                    bundled_spec_only=bundled_spec_only,
                 )
-            except Exception as e:
-                print(f'Could not establish a connection {e}')
-                time.sleep(retry_delay)
-                continue
+            if not logged_in:
+                stage = 'login'
+                # Changing password from old to new for initial login
+                login(client, username, old_password, password)
+                logged_in = True
+                auth_failures = 0
             # Enable enrollment on the ETO
-            if allow_enrollment:
-                try:
-                    response = client.system.system_enrollment_enroll_update(
-                        data={
-                            'state': 'allow',
-                        },
-                    ).response().result
-                    print(response)
-                except Exception as e:
-                    print(f'Could not change enrollment state {e}')
-                    time.sleep(retry_delay)
-            # If the above steps succeed, break out of the loop
+            if not enrolled:
+                stage = 'enrollment'
+                response = client.system.system_enrollment_enroll_update(
+                    data={
+                        'state': 'allow',
+                    },
+                ).response().result
+                print(f'[{hostname}] {response}')
+                enrolled = True
+            return client
+        except Exception as e:
+            kind = classify_error(e)
+            print(f'[{hostname}] Attempt {attempt} failed at {stage} ({kind}): {type(e).__name__}: {e}')
+            if kind == error_auth:
+                # The session may have expired, log in again
+                logged_in = False
+                auth_failures += 1
+                if auth_failures >= retry_max_auth_failures:
+                    raise PermissionError(f'{username} could not log in to {hostname}: {e}') from e
+            elif kind == error_request:
+                raise SystemError(f'{hostname} rejected the {stage} request: {e}') from e
+
+        remaining = deadline_at - time.monotonic()
+        if attempt == max_retries or remaining <= 0:
             break
+        delay = min(next(delays), remaining)
+        print(f'[{hostname}] Retrying in {delay:.1f} seconds...')
+        time.sleep(delay)
+
+    raise SystemError(f'Could not set up {hostname} after {attempt} attempts')
+
+
+def parse_bool(value):
+    """
+    Read a flag given as a string on the command line, or as any JSON value in a configuration.
+
+    Parameters
+    ----------
+    value : str, bool or int
+        The flag, e.g. 'True', 'false', 'yes', 1 or True.
+
+    Returns
+    -------
+    bool
+        True for '1', 'true' and 'yes' in any case (and True and 1), False otherwise.
+    """
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+def load_bulk_etos(path):
+    """
+    Read the list of ETOs to set up in bulk.
+
+    Parameters
+    ----------
+    path : str
+        A JSON file holding an array of objects, or one object per line, each with the `ip`,
+        `username`, `old_password` and `password` of an ETO and optionally `allow_enrollment`
+        (read by `parse_bool`, default is True). '-' reads the list from the standard input, keeping the passwords off the command line.
+
+    Returns
+    -------
+    list
+        The ETO entries.
+
+    Raises
+    ------
+    ValueError
+        If an entry misses a field.
+    """
+    if path == '-':
+        content = sys.stdin.read()
+    else:
+        with open(path) as bulk_file:
+            content = bulk_file.read()
+    try:
+        etos = json.loads(content)
+    except ValueError:
+        etos = [json.loads(line) for line in content.splitlines() if line.strip()]
+    if isinstance(etos, dict):
+        etos = [etos]
+    for number, eto in enumerate(etos, 1):
+        missing = [field for field in bulk_required_fields if not eto.get(field)]
+        if missing:
+            raise ValueError(f'ETO {number} of {path} misses {", ".join(missing)}')
+    return etos
+
+
+def setup_etos_bulk(etos, workers=bulk_workers, report_file=None, **retry_options):
+    """
+    Set up many ETOs at the same time.
+
+    Parameters
+    ----------
+    etos : list
+        The ETOs, see `load_bulk_etos`.
+    workers : int, optional
+        The number of ETOs set up at the same time (default is bulk_workers).
+    report_file : str, optional
+        A file a JSON line is written to per ETO as soon as it is done, with its `ip`, `status`
+        ('ok' or 'failed'), `error` and `seconds` (default is None, no report).
+    **retry_options
+        The retry and spec options of `setup_eto_with_retry`.
+
+    Returns
+    -------
+    dict
+        The error message per IP, None for the ETOs which were set up.
+
+    Notes
+    -----
+    Each ETO is set up by `setup_eto_with_retry` in a bounded thread pool, with its own client
+    and cookies. The clients share one HTTPAdapter, whose pool keeps the connection to every
+    ETO alive from the spec request through the login to the enrollment update, and the
+    parsed API spec is shared through the spec cache.
+    """
+    # Each ETO is talked to by one thread at a time, one connection per ETO is enough
+    http_adapter = HTTPAdapter(pool_connections=max(1, len(etos)), pool_maxsize=1)
+
+    def setup(eto):
+        started = time.monotonic()
+        try:
+            setup_eto_with_retry(
+                eto['ip'], eto['username'], eto['old_password'], eto['password'],
+                parse_bool(eto.get('allow_enrollment', True)), http_adapter=http_adapter, **retry_options,
+            )
+            error = None
         except Exception as e:
-            print(f'Attempt {attempt} failed: {str(e)}')
-            if attempt < max_retries:
-                print(f'Retrying in {retry_delay} seconds...')
-                time.sleep(retry_delay)
-            else:
-                print('Max retries reached. Exiting.')
-                SystemError('Max retries reached. Exiting.')
+            error = f'{type(e).__name__}: {e}'
+        return error, time.monotonic() - started
+
+    results = {}
+    report = open(report_file, 'w') if report_file else None
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(etos)))) as executor:
+            futures = {executor.submit(setup, eto): eto['ip'] for eto in etos}
+            for future in as_completed(futures):
+                ip = futures[future]
+                results[ip], seconds = future.result()
+                print(f'[{ip}] ETO setup {"failed: " + results[ip] if results[ip] else "succeeded"}')
+                if report is not None:
+                    report.write(json.dumps({
+                        'ip': ip,
+                        'status': 'failed' if results[ip] else 'ok',
+                        'error': results[ip],
+                        'seconds': round(seconds, 3),
+                    }) + '\n')
+                    report.flush()
+    finally:
+        if report is not None:
+            report.close()
+    return results
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Setup ETO')
     parser.add_argument(
-        '--ip', required=True,
+        '--ip',
         help='IPv4 address of the server',
     )
     parser.add_argument(
-        '--username', required=True,
+        '--username',
         help='Username for authentication',
     )
     parser.add_argument(
-        '--old_password', required=True,
+        '--old_password',
         help='Old password for authentication',
     )
     parser.add_argument(
-        '--password', required=True,
+        '--password',
         help='New password for authentication',
     )
     parser.add_argument(
-        '--allow-enrollment', default=True,
-        help='Enable enrollment for ETO',
+        '--allow-enrollment', type=parse_bool, default=True,
+        help='Enable enrollment for ETO, true or false (default: true)',
+    )
+    parser.add_argument(
+        '--max-retries', type=int, default=retry_max_retries,
+        help='Maximum number of attempts',
+    )
+    parser.add_argument(
+        '--deadline', type=float, default=retry_deadline,
+        help='Seconds after which no attempt is started anymore',
+    )
+    parser.add_argument(
+        '--spec-cache', default=spec_cache_directory,
+        help='Directory the API specs are cached in',
+    )
+    parser.add_argument(
+        '--no-spec-cache', action='store_true',
+        help='Download the API spec without caching it',
+    )
+    parser.add_argument(
+        '--bundled-spec',
+        help='Path of a swagger.json matching the ETO version, used when the spec of the ETO cannot be downloaded or revalidated',
+    )
+    parser.add_argument(
+        '--bundled-spec-only', action='store_true',
+        help='Use the --bundled-spec straight away, without requesting the spec of the ETO',
+    )
+    parser.add_argument(
+        '--bulk', metavar='FILE',
+        help='JSON list of the ETOs to set up at the same time instead of --ip, - reads it from the standard input',
+    )
+    parser.add_argument(
+        '--workers', type=int, default=bulk_workers,
+        help='Number of ETOs set up at the same time with --bulk',
+    )
+    parser.add_argument(
+        '--report', metavar='FILE',
+        help='File the result of every ETO of --bulk is written to, one JSON line each',
+    )
+    parser.add_argument(
+        '--scheme', default='https', choices=['https', 'http'],
+        help='Scheme of the API, http is only meant for test servers',
     )
     args = parser.parse_args()
+    if args.bundled_spec_only and args.bundled_spec is None:
+        parser.error('--bundled-spec-only requires --bundled-spec')
+    retry_options = {
+        'max_retries': args.max_retries,
+        'deadline': args.deadline,
+        'spec_cache': None if args.no_spec_cache else args.spec_cache,
+        'bundled_spec': args.bundled_spec,
+        'bundled_spec_only': args.bundled_spec_only,
+        'scheme': args.scheme,
+    }
 
-    setup_eto_with_retry(
-        args.ip, args.username,
-        args.old_password, args.password, args.allow_enrollment,
-    )
+    if args.bulk:
+        try:
+            etos = load_bulk_etos(args.bulk)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        errors = setup_etos_bulk(etos, args.workers, args.report, **retry_options)
+        failed = [ip for ip, error in errors.items() if error]
+        print(f'{len(errors) - len(failed)} of {len(errors)} ETOs set up')
+        if failed:
+            print(f'ETO setup failed: {", ".join(failed)}')
+            sys.exit(1)
+    else:
+        missing = [name for name in ('ip', 'username', 'old_password', 'password') if getattr(args, name) is None]
+        if missing:
+            parser.error(f'--{", --".join(missing)} required unless --bulk is given')
+        try:
+            setup_eto_with_retry(
+                args.ip, args.username,
+                args.old_password, args.password, args.allow_enrollment,
+                **retry_options,
+            )
+        except (PermissionError, SystemError) as e:
+            print(f'ETO setup failed: {e}')
+            sys.exit(1)
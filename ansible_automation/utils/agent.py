@@ -0,0 +1,508 @@
+#!/usr/bin/env python3
+"""
+Long-lived command agent of the ansible container.
+
+The controller starts the agent once with `docker exec -i` and sends it the commands of every
+step over the same channel, instead of starting `docker exec` for each of them. Requests and
+events are JSON lines:
+
+- `{"op": "run", "id": 1, "command": "...", "tty": true}` runs a shell command, with its
+  output on a pseudo-terminal like `docker exec -t` when `tty` is set,
+- `{"op": "kill", "id": 1, "signal": 15}` signals the process group of a command,
+- `{"id": 1, "stream": "stdout", "data": "..."}` carries output as it is produced,
+- `{"id": 1, "exit": 0}` ends a command, after all of its output,
+- `{"ready": true}` is sent once, before anything else, when the agent is up.
+
+The agent exits and kills its commands when its stdin is closed. Only the standard library
+is used, the file runs inside the container as a script.
+"""
+import codecs
+import contextlib
+import functools
+import itertools
+import json
+import logging
+import os
+import pty
+import re
+import signal
+import subprocess
+import sys
+import threading
+
+log = logging.getLogger(__name__)
+
+# Path of this file inside the ansible container, utils is copied to /deploy/utils
+agent_path = '/deploy/utils/agent.py'
+
+# Bytes read from a command output at once
+agent_read_size = 64 * 1024
+
+# Seconds to wait for the ready event of the agent once `docker exec -i` is started
+agent_start_timeout = 30
+
+# Seconds to wait for the agent to exit once its stdin is closed
+agent_close_timeout = 10
+
+# Exit code of the commands which were running when the agent went away, as for a lost `docker exec`
+agent_lost_exit_code = 255
+
+# Commands without side effects which give the same output on either side, run by the agent too
+agent_local_command_pattern = re.compile(r'^echo [^;&|<>$`\\\n]*$')
+
+
+def _agent_send(out, write_lock, event):
+    """
+    Write one event line to the controller.
+    """
+    line = json.dumps(event) + '\n'
+    with write_lock:
+        out.write(line)
+        out.flush()
+
+
+def _agent_forward(fd, command_id, stream, out, write_lock):
+    """
+    Send the output read from a file descriptor until it is closed.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    while True:
+        try:
+            data = os.read(fd, agent_read_size)
+        except OSError:
+            # A pseudo-terminal reports EIO once the command and its children have exited
+            data = b''
+        text = decoder.decode(data, final=not data)
+        if text:
+            _agent_send(out, write_lock, {'id': command_id, 'stream': stream, 'data': text})
+        if not data:
+            break
+    os.close(fd)
+
+
+def _agent_pump(pipe, stream):
+    """
+    Feed the output read from a pipe of a local process to a stream until it is closed.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    while True:
+        data = os.read(pipe.fileno(), agent_read_size)
+        text = decoder.decode(data, final=not data)
+        if text:
+            stream.feed(text)
+        if not data:
+            break
+    pipe.close()
+
+
+def _agent_run(request, processes, out, write_lock):
+    """
+    Start a command and the threads which forward its output and exit code.
+    """
+    command_id = request['id']
+    readers = []
+    try:
+        if request.get('tty'):
+            # stdout and stderr share the terminal, as with `docker exec -t`
+            master, slave = pty.openpty()
+            process = subprocess.Popen(
+                request['command'], shell=True, stdin=subprocess.DEVNULL,
+                stdout=slave, stderr=slave, start_new_session=True,
+            )
+            os.close(slave)
+            readers.append((master, 'stdout'))
+        else:
+            process = subprocess.Popen(
+                request['command'], shell=True, stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True,
+            )
+            readers.append((os.dup(process.stdout.fileno()), 'stdout'))
+            readers.append((os.dup(process.stderr.fileno()), 'stderr'))
+            process.stdout.close()
+            process.stderr.close()
+    except OSError as ex:
+        _agent_send(out, write_lock, {'id': command_id, 'stream': 'stderr', 'data': f'{ex}\n'})
+        _agent_send(out, write_lock, {'id': command_id, 'exit': 127})
+        return
+    processes[command_id] = process
+
+    threads = [
+        threading.Thread(target=_agent_forward, args=(fd, command_id, stream, out, write_lock), daemon=True)
+        for fd, stream in readers
+    ]
+    for thread in threads:
+        thread.start()
+
+    def wait():
+        for thread in threads:
+            thread.join()
+        returncode = process.wait()
+        processes.pop(command_id, None)
+        _agent_send(out, write_lock, {'id': command_id, 'exit': returncode})
+
+    threading.Thread(target=wait, daemon=True).start()
+
+
+def agent_serve(requests=None, out=None):
+    """
+    Run commands sent as JSON lines and stream back their output and exit codes.
+
+    Parameters
+    ----------
+    requests : file, optional
+        The request lines (default is None, stdin).
+    out : file, optional
+        Where the events are written (default is None, stdout).
+
+    Returns
+    -------
+    None
+
+    Notes
+    -----
+    Every command runs in its own session, so a kill reaches all of its children. The
+    commands still running when `requests` is closed are killed.
+    """
+    requests = requests or sys.stdin
+    out = out or sys.stdout
+    write_lock = threading.Lock()
+    processes = {}
+    _agent_send(out, write_lock, {'ready': True})
+    for line in requests:
+        try:
+            request = json.loads(line)
+        except ValueError:
+            continue
+        if request.get('op') == 'run':
+            _agent_run(request, processes, out, write_lock)
+        elif request.get('op') == 'kill':
+            process = processes.get(request.get('id'))
+            if process is not None:
+                with contextlib.suppress(ProcessLookupError):
+                    os.killpg(process.pid, request.get('signal', signal.SIGTERM))
+    for process in list(processes.values()):
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(process.pid, signal.SIGKILL)
+
+
+class AgentStream:
+    """
+    Text output of a command run by the agent, read like the pipes of `subprocess.Popen`.
+    """
+
+    def __init__(self):
+        self._buffer = ''
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def feed(self, data):
+        with self._condition:
+            self._buffer += data
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def readline(self, size=-1):
+        with self._condition:
+            while True:
+                end = self._buffer.find('\n') + 1
+                if end and (size < 0 or end <= size):
+                    break
+                if 0 <= size <= len(self._buffer):
+                    end = size
+                    break
+                if self._closed:
+                    end = len(self._buffer)
+                    break
+                self._condition.wait()
+            line, self._buffer = self._buffer[:end], self._buffer[end:]
+            return line
+
+    def read(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self._closed)
+            data, self._buffer = self._buffer, ''
+            return data
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+
+class AgentProcess:
+    """
+    A command run by the agent, offering the parts of `subprocess.Popen` used by the runners.
+
+    Parameters
+    ----------
+    agent : ContainerAgent
+        The agent running the command.
+    command_id : int
+        The id of the command in the requests and events of the agent.
+    fallback : callable, optional
+        Starts the command without the agent, returning a `subprocess.Popen` with stdout and
+        stderr pipes (default is None). It is called when the agent goes away before the
+        command has written anything or been signalled.
+    """
+
+    def __init__(self, agent, command_id, fallback=None):
+        self._agent = agent
+        self.command_id = command_id
+        self.stdout = AgentStream()
+        self.stderr = AgentStream()
+        self.returncode = None
+        self._exited = threading.Event()
+        self._fallback = fallback
+        self._process = None
+        self._output = False
+        self._signalled = False
+
+    def _feed(self, stream, data):
+        self._output = True
+        (self.stderr if stream == 'stderr' else self.stdout).feed(data)
+
+    def _exit(self, returncode):
+        self.stdout.close()
+        self.stderr.close()
+        self.returncode = returncode
+        self._exited.set()
+
+    def _lost(self):
+        """
+        End the command once the agent has gone away, or start it again without the agent.
+        """
+        if self._fallback is not None and not self._output and not self._signalled:
+            log.warning(f'The command agent of {self._agent.container_name} exited, running command {self.command_id} with docker exec')
+            try:
+                self._process = process = self._fallback()
+            except OSError as ex:
+                self.stderr.feed(f'{ex}\n')
+            else:
+                readers = [
+                    threading.Thread(target=_agent_pump, args=(pipe, stream), daemon=True)
+                    for pipe, stream in ((process.stdout, self.stdout), (process.stderr, self.stderr))
+                ]
+                for reader in readers:
+                    reader.start()
+
+                def wait():
+                    for reader in readers:
+                        reader.join()
+                    self._exit(process.wait())
+
+                threading.Thread(target=wait, daemon=True).start()
+                return
+        self.stderr.feed('The command agent of the container exited\n')
+        self._exit(agent_lost_exit_code)
+
+    def wait(self, timeout=None):
+        if not self._exited.wait(timeout):
+            raise subprocess.TimeoutExpired(self.command_id, timeout)
+        return self.returncode
+
+    def communicate(self, timeout=None):
+        self.wait(timeout)
+        return self.stdout.read(), self.stderr.read()
+
+    def killpg(self, sig):
+        """
+        Signal the process group of the command inside the container.
+        """
+        self._signalled = True
+        if self._process is not None:
+            killpg = getattr(self._process, 'killpg', None) or functools.partial(os.killpg, self._process.pid)
+            killpg(sig)
+            return
+        if self._exited.is_set():
+            raise ProcessLookupError(self.command_id)
+        with contextlib.suppress(BrokenPipeError, ValueError):
+            # An agent which has gone away ends the command itself
+            self._agent.send({'op': 'kill', 'id': self.command_id, 'signal': int(sig)})
+
+
+class ContainerAgent:
+    """
+    Client of the agent running inside a container, shared by every step of a run.
+
+    Parameters
+    ----------
+    container_name : str
+        The name of the Docker container.
+
+    Notes
+    -----
+    The commands of all threads go over the single `docker exec -i` of the agent, a reader
+    thread handing the output of each command to its `AgentProcess`. Once the agent has gone
+    away the commands which have not written anything yet are run again by their fallback,
+    the others end with `agent_lost_exit_code` and the next ones are left to `docker exec`
+    (see `container_command`).
+    """
+
+    def __init__(self, container_name):
+        self.container_name = container_name
+        self._exec_prefix = f'docker exec -t {container_name} '
+        self._ids = itertools.count(1)
+        self._processes = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._agent = None
+        self._reader = None
+        self._ready = False
+        self._started = threading.Event()
+
+    def start(self):
+        """
+        Start the agent and wait for it to be ready.
+
+        Raises
+        ------
+        OSError
+            The agent could not be started or did not get ready within `agent_start_timeout`.
+        """
+        self._agent = subprocess.Popen(
+            ['docker', 'exec', '-i', self.container_name, 'python3', '-u', agent_path],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            encoding='utf-8', errors='replace',
+        )
+        self._reader = threading.Thread(target=self._read_events, daemon=True)
+        self._reader.start()
+        if not self._started.wait(agent_start_timeout) or not self._ready:
+            self._agent.kill()
+            self.close()
+            raise OSError(f'The command agent of {self.container_name} did not start')
+        return self
+
+    @property
+    def alive(self):
+        return self._ready and self._agent is not None and self._agent.poll() is None
+
+    def _read_events(self):
+        for line in self._agent.stdout:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event.get('ready'):
+                self._ready = True
+                self._started.set()
+                continue
+            with self._lock:
+                process = self._processes.get(event.get('id'))
+                if process is not None and 'exit' in event:
+                    del self._processes[event['id']]
+            if process is None:
+                continue
+            if 'exit' in event:
+                process._exit(event['exit'])
+            else:
+                process._feed(event.get('stream'), event.get('data', ''))
+        self._started.set()
+        with self._lock:
+            lost, self._processes = list(self._processes.values()), {}
+        for process in lost:
+            process._lost()
+
+    def send(self, request):
+        with self._write_lock:
+            self._agent.stdin.write(json.dumps(request) + '\n')
+            self._agent.stdin.flush()
+
+    def container_command(self, command):
+        """
+        Find the part of a shell command which the agent can run instead.
+
+        Parameters
+        ----------
+        command : str
+            A command of a step, e.g. `docker exec -t ansible_automation ansible-playbook ...`.
+
+        Returns
+        -------
+        tuple or None
+            The command to run in the container and whether it needs a terminal, None when
+            the command has to run as it is.
+        """
+        if not self.alive:
+            return None
+        if command.startswith(self._exec_prefix):
+            return command[len(self._exec_prefix):], True
+        if agent_local_command_pattern.match(command):
+            return command, False
+        return None
+
+    def popen(self, command, tty=False, fallback=None):
+        """
+        Run a shell command through the agent.
+
+        Parameters
+        ----------
+        command : str
+            The command, run by the shell of the container.
+        tty : bool, optional
+            Whether the command writes to a terminal, stderr merged into stdout (default is False).
+        fallback : callable, optional
+            Starts the command without the agent when the agent goes away before the command
+            has written anything (default is None, see `AgentProcess`).
+
+        Returns
+        -------
+        AgentProcess
+            The running command.
+        """
+        process = AgentProcess(self, next(self._ids), fallback)
+        with self._lock:
+            self._processes[process.command_id] = process
+        try:
+            self.send({'op': 'run', 'id': process.command_id, 'command': command, 'tty': tty})
+        except (BrokenPipeError, ValueError):
+            with self._lock:
+                lost = self._processes.pop(process.command_id, None)
+            if lost is not None:
+                process._lost()
+        return process
+
+    def close(self):
+        if self._agent is None:
+            return
+        with contextlib.suppress(BrokenPipeError, ValueError), self._write_lock:
+            self._agent.stdin.close()
+        try:
+            self._agent.wait(timeout=agent_close_timeout)
+        except subprocess.TimeoutExpired:
+            self._agent.kill()
+            self._agent.wait()
+        self._reader.join()
+
+
+@contextlib.contextmanager
+def container_agent(container_name):
+    """
+    Run the command agent of a container for the duration of the block.
+
+    Parameters
+    ----------
+    container_name : str
+        The name of the Docker container.
+
+    Yields
+    ------
+    ContainerAgent or None
+        The running agent, None when it could not be started (the steps then use `docker exec`).
+    """
+    try:
+        agent = ContainerAgent(container_name).start()
+    except OSError as ex:
+        log.warning(f'Could not start the command agent of {container_name}: {ex}')
+        agent = None
+    try:
+        yield agent
+    finally:
+        if agent is not None:
+            agent.close()
+
+
+if __name__ == '__main__':
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    agent_serve()
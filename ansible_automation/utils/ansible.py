@@ -1,14 +1,97 @@
+#!/usr/bin/env python3
 import argparse
+import contextlib
+import datetime
+import fcntl
+import functools
 import json
 import logging
 import os
 import re
+import shlex
+import signal
+import sqlite3
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
 
 import yaml
 
 log = logging.getLogger(__name__)
 
+# Lines of the default and YAML stdout callbacks read into `AnsibleResults`: the play and task
+# headers, the result of a task on a host (`ok: [host]`, `fatal: [host]: FAILED! => ...`), the
+# `msg` of a failed result printed by the YAML callback and the PLAY RECAP lines
+ansible_play_pattern = re.compile(r'^PLAY \[(.*)\]')
+ansible_header_pattern = re.compile(r'^(?:TASK|RUNNING HANDLER) \[(.*)\]')
+ansible_result_pattern = re.compile(r'^(ok|changed|skipping|fatal): \[([^\]]+)\](?:: (FAILED|UNREACHABLE)!)?(.*)$')
+ansible_yaml_msg_pattern = re.compile(r'^  msg: (.*)$')
+ansible_recap_pattern = re.compile(r'^(\S+)\s+:\s+((?:[a-z]+=\d+\s*)+)$')
+ansible_recap_count_pattern = re.compile(r'([a-z]+)=(\d+)')
+
+# Options used by ansible_log_writer_analyzer when the caller does not set them,
+# see ansible_runner_configure
+ansible_runner_defaults = {
+    'stream': False,
+    'fail_fast': False,
+    'timeout': None,
+    'agent': None,
+    'backend': 'ansible-playbook',
+}
+
+# Ways of running a playbook, see ansible_playbook_command
+ansible_playbook_backends = ('ansible-playbook', 'ansible-runner')
+
+# Script running a playbook through the ansible-runner API inside the container
+ansible_playbook_runner_path = '/deploy/utils/playbook_runner.py'
+
+# Events printed by the ansible-runner backend, one JSON object per line
+ansible_event_pattern = re.compile(r'^\{"event": ')
+
+# Live output lines which end a run straight away when failing fast. A fatal task (which
+# includes unreachable hosts) only counts when Ansible does not report it as ignored.
+ansible_task_pattern = re.compile(r'^TASK \[(.*)\]')
+ansible_fatal_pattern = re.compile(r'^fatal: \[')
+ansible_ignoring_pattern = re.compile(r'^\.\.\.ignoring')
+ansible_traceback_pattern = re.compile(r'^Traceback \(most recent call last\)')
+
+# Seconds a killed command gets to exit before it is killed with SIGKILL
+ansible_kill_grace_period = 5
+
+# Commands of the steps run in a container, whose process group there is recorded when they
+# may be killed (see `AnsibleExecProcess`), in files of the directory below
+ansible_exec_pattern = re.compile(r'^docker exec -t (\S+) (.+)$', re.DOTALL)
+ansible_exec_pid_directory = '/tmp'
+
+# Seconds to wait for Ansible to report a fatal task as ignored before aborting
+ansible_fatal_confirm_seconds = 2
+
+# Number of output lines kept in memory for the JSON summary of a streamed command
+ansible_stream_tail_lines = 200
+
+# Longest document of the JSON stdout callback read into `AnsibleResults`, in characters
+ansible_results_max_document = 64 * 1024 * 1024
+
+# Commands whose output is the document of the JSON stdout callback
+ansible_json_callback_pattern = re.compile(r'\bANSIBLE_STDOUT_CALLBACK=[\'"]?(?:ansible\.posix\.)?json\b')
+
+# Number of failed and of slowest tasks listed in the JSON summary of a command
+ansible_results_summary_tasks = 20
+
+# Longest chunk of a single output line read at once while streaming
+ansible_stream_max_line = 64 * 1024
+
+# Inventory store read when this script is used as a dynamic inventory (`--list`/`--host`),
+# next to the inventory directory of the container so Ansible does not parse it as a source
+ansible_inventory_store_default = os.environ.get('ANSIBLE_INVENTORY_STORE', '/etc/ansible/inventory.db')
+
+# Seconds a connection waits for a concurrent writer of the inventory store
+ansible_inventory_store_timeout = 60
+
 
 def ansible_remove_ansi_escape_sequences(input_string: str):
     """
@@ -55,6 +138,10 @@ def filter_passwords(input_string):
     with asterisks. This is useful for sanitizing sensitive information from
     log files or other textual data.
     """
+    # Passwords in JSON, e.g. the extra vars of `ansible_playbook_command`
+    json_pattern = re.compile(r'("[^"]*password[^"]*"\s*:\s*)"(?:[^"\\]|\\.)*"')
+    input_string = json_pattern.sub(r'\1"****"', input_string)
+
     # Regular expression to find the word "password" and the corresponding password
     pattern = re.compile(r'(password\s+|password\s*=\s*)(\S+)')
 
@@ -66,7 +153,480 @@ def filter_passwords(input_string):
     return filtered_string
 
 
-def ansible_log_writer_analyzer(log_name: str, command: str, log_level: str = 'INFO') -> bool:
+def ansible_runner_configure(**options):
+    """
+    Set the default options of the command runner behind `ansible_log_writer_analyzer`.
+
+    Parameters
+    ----------
+    **options
+        The options to set:
+        - stream: Read the command output line by line instead of buffering it (see
+          `ansible_log_stream_analyzer`).
+        - fail_fast: Kill the command as soon as its live output shows a fatal task, an
+          unreachable host or a Python traceback. Implies stream.
+        - timeout: Seconds a command may run before it is killed, None to wait forever.
+        - agent: The command agent of the ansible container (see `utils.agent.ContainerAgent`)
+          running the `docker exec -t` commands of the steps, None to start `docker exec`
+          for each of them.
+        - backend: How playbooks are run, 'ansible-playbook' or 'ansible-runner' (see
+          `ansible_playbook_command`).
+
+    Returns
+    -------
+    None
+    """
+    unknown = set(options) - set(ansible_runner_defaults)
+    if unknown:
+        raise ValueError(f'Unknown runner options: {sorted(unknown)}')
+    if options.get('backend', ansible_playbook_backends[0]) not in ansible_playbook_backends:
+        raise ValueError(f'Unknown playbook backend: {options["backend"]}')
+    ansible_runner_defaults.update(options)
+
+
+def ansible_playbook_command(playbook: str, extra_vars: dict = None, inventory: str = None, forks: int = None, limit: str = None, backend: str = None) -> str:
+    """
+    Build the command which runs a playbook inside the ansible container.
+
+    Parameters
+    ----------
+    playbook : str
+        The playbook to run (e.g. playbooks/setup.yml).
+    extra_vars : dict, optional
+        The extra vars of the run (default is None).
+    inventory : str, optional
+        The inventory inside the container (default is None, the default inventory).
+    forks : int, optional
+        The number of hosts Ansible works on in parallel (default is None, the Ansible default).
+    limit : str, optional
+        The hosts the run is limited to (default is None).
+    backend : str, optional
+        'ansible-playbook' or 'ansible-runner' (default is None, the backend set with
+        `ansible_runner_configure`).
+
+    Returns
+    -------
+    str
+        The shell command, to be run with `docker exec -t <container>`.
+
+    Notes
+    -----
+    The extra vars are passed as one JSON document instead of `name=value` pairs, so values
+    holding spaces, quotes or `$` reach the playbook unchanged. None values are passed as
+    'None', as the `name=value` pairs did. The single quotes of the JSON are escaped as
+    `\\u0027` so the shell quoting never splits it and `filter_passwords` sees every password.
+
+    The ansible-runner backend runs `ansible_playbook_runner_path` (see
+    `utils/playbook_runner.py`), which prints every event of the run as a JSON line. The
+    analyzers judge the run from these events instead of its text output (see
+    `ansible_output_line`).
+    """
+    backend = backend or ansible_runner_defaults['backend']
+    extra_vars = {
+        name: 'None' if value is None else value for name, value in (extra_vars or {}).items()
+    }
+    if backend == 'ansible-runner':
+        request = {
+            'playbook': playbook, 'extra_vars': extra_vars,
+            'inventory': inventory, 'forks': forks, 'limit': limit,
+        }
+        command = [
+            'python3', ansible_playbook_runner_path,
+            _ansible_json_argument({name: value for name, value in request.items() if value is not None}),
+        ]
+    elif backend == 'ansible-playbook':
+        command = ['ansible-playbook']
+        if inventory:
+            command += ['-i', inventory]
+        if forks:
+            command += ['--forks', str(forks)]
+        if limit:
+            command += ['--limit', limit]
+        command += [playbook, '--extra-vars', _ansible_json_argument(extra_vars)]
+    else:
+        raise ValueError(f'Unknown playbook backend: {backend}')
+    return ' '.join(shlex.quote(argument) for argument in command)
+
+
+def _ansible_json_argument(value):
+    """
+    Serialise a value as JSON without single quotes, which the shell quoting would split.
+    """
+    return json.dumps(value).replace("'", '\\u0027')
+
+
+def ansible_runner_event(line: str):
+    """
+    Read a line of command output as an event of the ansible-runner backend.
+
+    Parameters
+    ----------
+    line : str
+        A line of output, without ANSI escape sequences.
+
+    Returns
+    -------
+    dict or None
+        The event, None when the line is plain text.
+    """
+    if not ansible_event_pattern.match(line):
+        return None
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+def ansible_output_line(line: str):
+    """
+    Turn a line of command output into the text written to the log.
+
+    Parameters
+    ----------
+    line : str
+        A line of output, as read from the command.
+
+    Returns
+    -------
+    tuple
+        The text without ANSI escape sequences and passwords, and the event when the line is
+        an event of the ansible-runner backend, otherwise None.
+
+    Notes
+    -----
+    An event is logged as the text Ansible displays for it, the event itself is read into
+    `AnsibleResults`.
+    """
+    line = ansible_remove_ansi_escape_sequences(line)
+    event = ansible_runner_event(line)
+    if event is None:
+        return filter_passwords(line), None
+    text = ansible_remove_ansi_escape_sequences(event.get('stdout') or '')
+    text = filter_passwords(text + '\n') if text else ''
+    return text, event
+
+
+def _ansible_seconds(duration):
+    """
+    Return the seconds between the `start` and `end` ISO timestamps of a JSON callback duration.
+    """
+    try:
+        start, end = (
+            datetime.datetime.fromisoformat(duration[name].replace('Z', '+00:00'))
+            for name in ('start', 'end')
+        )
+    except (KeyError, TypeError, ValueError):
+        return None
+    return (end - start).total_seconds()
+
+
+class AnsibleResults:
+    """
+    Per-host and per-task results of an Ansible run, read from its output in a single pass.
+
+    Parameters
+    ----------
+    json_document : bool, optional
+        Whether the output is the document of the JSON stdout callback (default is False).
+
+    Notes
+    -----
+    `add` is called with every line of output as it arrives. Three formats are understood:
+    the events of the ansible-runner backend (see `utils/playbook_runner.py`), the document
+    of the JSON stdout callback and the text of the default and YAML stdout callbacks,
+    including their PLAY RECAP. The JSON document is only read with `json_document`, as it
+    has to be held in memory until it ends; tracebacks, task results and the PLAY RECAP are
+    still read from the lines meanwhile. Each task records the result of every host as one of 'ok',
+    'changed', 'failed', 'ignored', 'unreachable' or 'skipped', with its duration and
+    message. Durations come from the events and the JSON document; for text they are the
+    time between the lines, when `add` is given their arrival time.
+
+    The counts of a host come from the PLAY RECAP (or the stats of the events and of the
+    JSON document) when the run got that far, as it accounts for ignored and rescued
+    errors, and from the task results otherwise. The run has failed when a host has failed
+    or unreachable tasks, or when a Python traceback was printed.
+    """
+
+    statuses = ('ok', 'changed', 'failed', 'ignored', 'unreachable', 'skipped')
+    counts = ('ok', 'changed', 'unreachable', 'failed', 'skipped', 'rescued', 'ignored')
+
+    def __init__(self, json_document=False):
+        self.json_document = json_document
+        self.tasks = []
+        self.recap = {}
+        self.tracebacks = 0
+        self._play = None
+        self._last_failed = None
+        self._document = None
+        self._document_size = 0
+
+    def _task(self, name, play=None, timestamp=None):
+        previous = self.tasks[-1] if self.tasks else None
+        if previous is not None and timestamp is not None and previous['start'] is not None:
+            previous['duration'] = timestamp - previous['start']
+        task = {
+            'play': play or self._play, 'task': name, 'start': timestamp,
+            'duration': None, 'hosts': {},
+        }
+        self.tasks.append(task)
+        self._last_failed = None
+        return task
+
+    def _result(self, host, status, duration=None, msg=None, task=None):
+        if task is None:
+            task = self.tasks[-1] if self.tasks else self._task(None)
+        result = {'status': status, 'duration': duration, 'msg': msg}
+        task['hosts'][host] = result
+        if duration is not None:
+            task['duration'] = max(task['duration'] or 0, duration)
+        self._last_failed = result if status == 'failed' else None
+        return result
+
+    def _recap_host(self, host, counts):
+        entry = self.recap.setdefault(host, dict.fromkeys(self.counts, 0))
+        for name, count in counts.items():
+            if name in entry:
+                entry[name] = count
+
+    def add(self, line, event=None, timestamp=None):
+        """
+        Read one line of output.
+
+        Parameters
+        ----------
+        line : str
+            The line, without ANSI escape sequences.
+        event : dict, optional
+            The event when the line is an event of the ansible-runner backend (default is None).
+        timestamp : float, optional
+            The `time.monotonic()` the line arrived at (default is None).
+
+        Returns
+        -------
+        list
+            'failed' or 'unreachable' when the line reports a task which failed without
+            `ignore_errors` or an unreachable host for certain, otherwise an empty list.
+        """
+        if event is not None:
+            return self._add_event(event)
+        text = line.rstrip('\r\n')
+        if self._document is not None:
+            self._add_document_line(line, text)
+        elif self.json_document and text == '{':
+            self._document = [line]
+            self._document_size = len(line)
+            return []
+        if ansible_traceback_pattern.match(text):
+            self.tracebacks += 1
+            return []
+        match = ansible_play_pattern.match(text)
+        if match:
+            self._play = match.group(1)
+            self._last_failed = None
+            return []
+        match = ansible_header_pattern.match(text)
+        if match:
+            self._task(match.group(1), timestamp=timestamp)
+            return []
+        if ansible_ignoring_pattern.match(text):
+            if self._last_failed is not None:
+                self._last_failed['status'] = 'ignored'
+                self._last_failed = None
+            return []
+        match = ansible_yaml_msg_pattern.match(text)
+        if match and self._last_failed is not None and self._last_failed['msg'] is None:
+            self._last_failed['msg'] = match.group(1)
+            return []
+        match = ansible_recap_pattern.match(text)
+        if match:
+            counts = {name: int(count) for name, count in ansible_recap_count_pattern.findall(match.group(2))}
+            if 'failed' in counts and 'unreachable' in counts:
+                self._recap_host(match.group(1), counts)
+                return []
+        match = ansible_result_pattern.match(text)
+        if match and '(item=' not in match.group(4):
+            kind, host, failure, rest = match.groups()
+            status = {'skipping': 'skipped', 'FAILED': 'failed', 'UNREACHABLE': 'unreachable'}.get(
+                failure or kind, kind,
+            )
+            task = self.tasks[-1] if self.tasks else None
+            duration = None
+            if timestamp is not None and task is not None and task['start'] is not None:
+                duration = timestamp - task['start']
+            self._result(host.split(' -> ')[0], status, duration, self._text_msg(rest) if failure else None)
+        return []
+
+    @staticmethod
+    def _text_msg(rest):
+        body = rest.partition('=> ')[2].strip()
+        try:
+            return json.loads(body).get('msg')
+        except (ValueError, AttributeError):
+            return None
+
+    def _add_event(self, event):
+        name = event.get('event')
+        data = event.get('event_data', {})
+        if name == 'playbook_on_play_start':
+            self._play = data.get('play')
+        elif name in ('playbook_on_task_start', 'playbook_on_handler_task_start'):
+            self._task(data.get('task'), play=data.get('play'))
+        elif name in ('runner_on_ok', 'runner_on_failed', 'runner_on_skipped', 'runner_on_unreachable'):
+            res = data.get('res') or {}
+            status = {
+                'runner_on_ok': 'changed' if res.get('changed') else 'ok',
+                'runner_on_failed': 'ignored' if data.get('ignore_errors') else 'failed',
+                'runner_on_skipped': 'skipped',
+                'runner_on_unreachable': 'unreachable',
+            }[name]
+            task = self.tasks[-1] if self.tasks and self.tasks[-1]['task'] == data.get('task') else None
+            self._result(data.get('host'), status, data.get('duration'), res.get('msg'), task)
+            if status in ('failed', 'unreachable'):
+                return [status]
+        elif name == 'playbook_on_stats':
+            self._add_stats(data)
+        return []
+
+    def _add_stats(self, stats):
+        names = {'failures': 'failed', 'dark': 'unreachable'}
+        hosts = set()
+        for counts in stats.values():
+            if isinstance(counts, dict):
+                hosts.update(counts)
+        for host in hosts:
+            self._recap_host(host, {
+                names.get(name, name): counts.get(host, 0)
+                for name, counts in stats.items() if isinstance(counts, dict)
+            })
+
+    def _add_document_line(self, line, text):
+        # The lines are kept whole, a long line may come in several pieces
+        self._document.append(line)
+        self._document_size += len(line)
+        if self._document_size > ansible_results_max_document:
+            log.warning('The JSON output of the run is too large to be read, its results are left out')
+            self._document = None
+            return []
+        if text != '}':
+            return []
+        try:
+            document = json.loads(''.join(self._document))
+        except ValueError:
+            # A closing brace inside the document, keep reading
+            return []
+        self._document = None
+        if not isinstance(document, dict) or 'plays' not in document:
+            return []
+        for play in document.get('plays', []):
+            play_name = play.get('play', {}).get('name')
+            for task in play.get('tasks', []):
+                entry = self._task(task.get('task', {}).get('name'), play=play_name)
+                duration = _ansible_seconds(task.get('task', {}).get('duration'))
+                for host, res in task.get('hosts', {}).items():
+                    if res.get('unreachable'):
+                        status = 'unreachable'
+                    elif res.get('failed'):
+                        status = 'failed'
+                    elif res.get('skipped'):
+                        status = 'skipped'
+                    else:
+                        status = 'changed' if res.get('changed') else 'ok'
+                    self._result(host, status, duration, res.get('msg') if status in ('failed', 'unreachable') else None, entry)
+        self._add_stats({
+            name: {host: counts.get(name, 0) for host, counts in document.get('stats', {}).items()}
+            for name in ('ok', 'changed', 'failures', 'unreachable', 'skipped', 'rescued', 'ignored')
+        })
+        return []
+
+    def close(self, timestamp=None):
+        """
+        Mark the end of the output, ending the duration of the last task read from text.
+        """
+        if self.tasks and timestamp is not None and self.tasks[-1]['start'] is not None and self.tasks[-1]['duration'] is None:
+            self.tasks[-1]['duration'] = timestamp - self.tasks[-1]['start']
+
+    def hosts(self):
+        """
+        Return the counts of every host, see `counts`.
+        """
+        hosts = {}
+        for task in self.tasks:
+            for host, result in task['hosts'].items():
+                entry = hosts.setdefault(host, dict.fromkeys(self.counts, 0))
+                status = result['status']
+                if status in ('ok', 'changed', 'ignored'):
+                    entry['ok'] += 1
+                if status in ('changed', 'ignored', 'failed', 'unreachable', 'skipped'):
+                    entry[status] += 1
+        hosts.update({host: dict(counts) for host, counts in self.recap.items()})
+        return hosts
+
+    def failed_hosts(self):
+        """
+        Return the hosts with failed or unreachable tasks.
+        """
+        return sorted(
+            host for host, counts in self.hosts().items() if counts['failed'] or counts['unreachable']
+        )
+
+    def failed_tasks(self):
+        """
+        Return the tasks which failed or found their host unreachable, one entry per host.
+        """
+        return [
+            {'play': task['play'], 'task': task['task'], 'host': host, **result}
+            for task in self.tasks
+            for host, result in task['hosts'].items()
+            if result['status'] in ('failed', 'unreachable')
+        ]
+
+    def slowest_tasks(self, count=None):
+        """
+        Return the tasks with a known duration, the slowest first.
+        """
+        tasks = sorted(
+            (task for task in self.tasks if task['duration'] is not None),
+            key=lambda task: task['duration'], reverse=True,
+        )
+        return [
+            {'play': task['play'], 'task': task['task'], 'duration': round(task['duration'], 3)}
+            for task in tasks[:count]
+        ]
+
+    def failed(self):
+        """
+        Return whether a host has failed or unreachable tasks, or a Python traceback was printed.
+        """
+        return bool(self.tracebacks or self.failed_hosts())
+
+    def summary(self):
+        """
+        Return the results for the JSON summary of a command, empty when no Ansible output was read.
+        """
+        summary = {}
+        if self.tasks or self.recap:
+            summary['hosts'] = self.hosts()
+            summary['failed_tasks'] = [
+                {name: task[name] for name in ('play', 'task', 'host', 'status', 'msg')}
+                for task in self.failed_tasks()[:ansible_results_summary_tasks]
+            ]
+            summary['slowest_tasks'] = self.slowest_tasks(ansible_results_summary_tasks)
+        if self.tracebacks:
+            summary['tracebacks'] = self.tracebacks
+        return summary
+
+    def log_failures(self, step=None):
+        """
+        Log the failed tasks and the tracebacks of the run.
+        """
+        for task in self.failed_tasks():
+            msg = f': {task["msg"]}' if task['msg'] else ''
+            log.error(f'{step or "Command"}: {task["task"]} {task["status"]} on {task["host"]}{msg}')
+        if self.tracebacks:
+            log.error(f'{step or "Command"}: {self.tracebacks} Python traceback(s) in the output')
+
+
+def ansible_log_writer_analyzer(log_name: str, command: str, log_level: str = 'INFO', stream: bool = None, fail_fast: bool = None, step: str = None, timeout: float = None, results: AnsibleResults = None) -> bool:
     """
     Execute a shell command and write the output to a log file. Return True if the command
     executes successfully (i.e., exits with a zero exit code), otherwise return False.
@@ -79,6 +639,22 @@ def ansible_log_writer_analyzer(log_name: str, command: str, log_level: str = 'I
         The command to be executed.
     log_level : str, optional
         The logging level (default is 'INFO').
+    stream : bool, optional
+        Whether the output is streamed to the log file while the command runs (default is
+        None, using the value set with `ansible_runner_configure`).
+    fail_fast : bool, optional
+        Whether the command is killed on the first failure seen in its output (default is
+        None, using the value set with `ansible_runner_configure`).
+    step : str, optional
+        The name of the deployment step running the command, recorded when it is aborted
+        or timed out.
+    timeout : float, optional
+        The number of seconds the command may run before it is killed and marked as timed
+        out (default is None, using the value set with `ansible_runner_configure`).
+    results : AnsibleResults, optional
+        Filled with the per-host and per-task results of the run, to be queried afterwards
+        (default is None). Its `json_document` is set when the command selects the JSON
+        stdout callback with `ANSIBLE_STDOUT_CALLBACK`.
 
     Returns
     -------
@@ -87,20 +663,53 @@ def ansible_log_writer_analyzer(log_name: str, command: str, log_level: str = 'I
 
     Notes
     -----
-    This function executes the specified shell command using `subprocess.Popen` and captures its
+    This function executes the specified shell command using `ansible_popen` and captures its
     stdout and stderr outputs. It writes the command details, exit code, stdout, and stderr to
-    the log file. If any failures are detected in the command output (e.g., unreachable hosts or failed tasks),
-    the function returns False. If log_level is set to 'VERBOSE', detailed process information is written to the log.
+    the log file. The output is read into an `AnsibleResults`, whose summary is part of the
+    log entry. If any failures are detected in the command output (e.g., unreachable hosts or failed tasks),
+    or the command exits with a non-zero exit code, the failure is reported. If log_level is set to 'VERBOSE', detailed process information is written to the log.
+    When streaming, the work is handed to `ansible_log_stream_analyzer`. A command which
+    runs past its `timeout` has its whole process group killed and is reported as failed
+    with a `timed_out` entry in the log.
     """
+    if stream is None:
+        stream = ansible_runner_defaults['stream']
+    if fail_fast is None:
+        fail_fast = ansible_runner_defaults['fail_fast']
+    if timeout is None:
+        timeout = ansible_runner_defaults['timeout']
+    if stream or fail_fast:
+        return ansible_log_stream_analyzer(
+            log_name, command, log_level, fail_fast=fail_fast, step=step, timeout=timeout,
+            results=results,
+        )
+    if results is None:
+        results = AnsibleResults()
+    if ansible_json_callback_pattern.search(command):
+        results.json_document = True
+
     process_info = {}
+    timed_out = False
     with open(log_name, 'a') as f:
-        process = subprocess.Popen(
-            command, shell=True, stdin=subprocess.PIPE,
+        process = ansible_popen(
+            command, stdin=subprocess.PIPE,
             stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8',
+            start_new_session=bool(timeout),
         )
 
-        stdout, stderr = process.communicate()
-        output = ansible_remove_ansi_escape_sequences(stdout)
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            log.error(f'{step or "Command"} timed out after {timeout} seconds')
+            ansible_kill_process_group(process)
+            stdout, stderr = process.communicate()
+        output = []
+        for line in stdout.splitlines(keepends=True):
+            text, event = ansible_output_line(line)
+            results.add(text, event)
+            output.append(text)
+        output = ''.join(output)
 
         log.debug(output)
 
@@ -109,36 +718,36 @@ def ansible_log_writer_analyzer(log_name: str, command: str, log_level: str = 'I
         process_info['exit_code'] = process.returncode
         process_info['stdout'] = filter_passwords(output)
         process_info['stderr'] = filter_passwords(stderr)
+        results_summary = results.summary()
+        if results_summary:
+            process_info['results'] = results_summary
+        if timed_out:
+            process_info['timed_out'] = {'step': step, 'timeout': timeout}
 
         # Serialize process_info dictionary to JSON
         process_info_str = json.dumps(process_info, indent=4)
 
-        pattern = r'(unreachable=1|failed=1|Traceback)'
-        # Find all matches with capturing groups
-        matches = re.findall(pattern, output)
-
         if log_level == 'VERBOSE':
             f.write(process_info_str)
             f.write('\n')
 
-        log.debug(f'matches {matches}')
-
         f.write(process_info_str)
         f.write('\n')
 
-        if stderr != '':
+        if stderr != '' or timed_out or process.returncode:
             log.error('Execution Failure')
             f.write(process_info_str)
             f.write('\n')
             return True
 
-        # Check if matches list is empty
-        if len(matches) == 0:
+        # Check if any host failed
+        if not results.failed():
             log.info('No failures detected.')
             return False
         else:
             # Write serialized process_info to the log file
             log.warning('Failures were detected.')
+            results.log_failures(step)
             # Only write out the failures
             if log_level != 'VERBOSE':
                 f.write(process_info_str)
@@ -146,6 +755,354 @@ def ansible_log_writer_analyzer(log_name: str, command: str, log_level: str = 'I
             return True
 
 
+def _ansible_stream_reader(pipe, max_line=None):
+    """
+    Return an iterator over the lines of a text pipe, splitting lines longer than `max_line` characters.
+    """
+    max_line = max_line or ansible_stream_max_line
+    return iter(lambda: pipe.readline(max_line), '')
+
+
+def _ansible_stream_stderr(pipe, f, write_lock, stderr_tail):
+    """
+    Sanitise and write the stderr lines of a command to the log file as they arrive.
+    """
+    for line in _ansible_stream_reader(pipe):
+        line = filter_passwords(ansible_remove_ansi_escape_sequences(line))
+        stderr_tail.append(line)
+        with write_lock:
+            f.write('stderr: ' + line)
+            f.flush()
+
+
+class AnsibleExecProcess(subprocess.Popen):
+    """
+    A `docker exec -t` command which records its process group inside the container.
+
+    Parameters
+    ----------
+    container_name : str
+        The name of the Docker container.
+    container_command : str
+        The shell command run in the container.
+    **options
+        The options of `subprocess.Popen`, with `start_new_session=True`.
+
+    Notes
+    -----
+    Signalling the local Docker client does not stop the command in the container, which would
+    keep running and overlap with the next step. The command is run in a new session of the
+    container with `setsid -w`, by a shell which first writes its PID, the process group of the
+    command and its children, to a file of `ansible_exec_pid_directory`. `killpg` signals that
+    group with a second `docker exec` before the local process group.
+    """
+
+    def __init__(self, container_name, container_command, **options):
+        self.container_name = container_name
+        self.pid_file = f'{ansible_exec_pid_directory}/ansible_automation_{uuid.uuid4().hex}.pid'
+        command = f'echo $$ > {self.pid_file}; {container_command}'
+        script = f'setsid -w sh -c {shlex.quote(command)}; status=$?; rm -f {self.pid_file}; exit $status'
+        super().__init__(f'docker exec -t {container_name} sh -c {shlex.quote(script)}', shell=True, **options)
+
+    def killpg(self, sig):
+        """
+        Signal the process group of the command inside the container, then the local one.
+        """
+        script = f'[ -f {self.pid_file} ] && kill -{int(sig)} -$(cat {self.pid_file})'
+        if sig == signal.SIGKILL:
+            script += f'; rm -f {self.pid_file}'
+        try:
+            subprocess.run(
+                ['docker', 'exec', self.container_name, 'sh', '-c', script],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                timeout=ansible_kill_grace_period,
+            )
+        except (OSError, subprocess.TimeoutExpired) as ex:
+            log.warning(f'Could not signal the command in {self.container_name}: {ex}')
+        os.killpg(self.pid, sig)
+
+
+def ansible_popen(command, **options):
+    """
+    Start the command of a step, through the command agent of the container when one is configured.
+
+    Parameters
+    ----------
+    command : str
+        The shell command to be executed.
+    **options
+        The options of `subprocess.Popen` used when the command is not run by the agent.
+
+    Returns
+    -------
+    subprocess.Popen or utils.agent.AgentProcess
+        The running command.
+
+    Notes
+    -----
+    A `docker exec -t <container> ...` command is sent to the agent of the container (see
+    `ansible_runner_configure`), which runs it on a terminal like `docker exec -t` would, so
+    no shell, Docker CLI or exec session is started for it. Plain `echo` commands are run by
+    the agent as well. Without the agent, a `docker exec -t` command which may be killed
+    (`start_new_session`) is started as an `AnsibleExecProcess`, so that a kill stops it in
+    the container too. A command sent to an agent which goes away before the command has
+    written anything is started in that way instead.
+    """
+    agent = ansible_runner_defaults['agent']
+    container_command = agent.container_command(command) if agent is not None else None
+    if container_command is not None:
+        return agent.popen(*container_command, fallback=functools.partial(_ansible_exec_popen, command, **options))
+    return _ansible_exec_popen(command, **options)
+
+
+def _ansible_exec_popen(command, **options):
+    match = ansible_exec_pattern.match(command) if options.get('start_new_session') else None
+    if match is not None:
+        return AnsibleExecProcess(match.group(1), match.group(2), **options)
+    return subprocess.Popen(command, shell=True, **options)
+
+
+def ansible_kill_process_group(process):
+    """
+    Terminate a command started in its own session together with all of its children.
+
+    Parameters
+    ----------
+    process : subprocess.Popen, AnsibleExecProcess or utils.agent.AgentProcess
+        The process started with `start_new_session=True`, or by the command agent.
+
+    Returns
+    -------
+    None
+
+    Notes
+    -----
+    The process group is sent SIGTERM first and SIGKILL when it has not exited after
+    `ansible_kill_grace_period` seconds.
+    """
+    killpg = getattr(process, 'killpg', None) or functools.partial(os.killpg, process.pid)
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            killpg(sig)
+        except ProcessLookupError:
+            return
+        try:
+            process.wait(timeout=ansible_kill_grace_period)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+
+def _ansible_watchdog_expired(process, watchdog_state, step, timeout):
+    """
+    Mark a streamed command as timed out and kill it.
+    """
+    watchdog_state['timed_out'] = True
+    log.error(f'{step or "Command"} timed out after {timeout} seconds')
+    ansible_kill_process_group(process)
+
+
+def _ansible_fail_fast_abort(process, abort_state, abort_lock, line, step, task=None, pending_only=False):
+    """
+    Record the line which triggered a fail-fast abort and kill the command.
+
+    With `pending_only` the abort only happens while `line` is still the unconfirmed fatal
+    task, which is how the confirmation timer avoids racing the output reader.
+    """
+    with abort_lock:
+        if abort_state['line'] is not None:
+            return
+        if pending_only and abort_state['pending'] is not line:
+            return
+        if task is not None:
+            abort_state['task'] = task
+        abort_state['pending'] = None
+        abort_state['line'] = line
+    log.error(
+        f'Aborting {step or "command"} at task {abort_state["task"]}: {line.strip()}',
+    )
+    ansible_kill_process_group(process)
+
+
+def ansible_log_stream_analyzer(log_name: str, command: str, log_level: str = 'INFO', fail_fast: bool = False, step: str = None, timeout: float = None, results: AnsibleResults = None) -> bool:
+    """
+    Execute a shell command and stream its output to a log file while it runs.
+
+    Parameters
+    ----------
+    log_name : str
+        The name of the log file.
+    command : str
+        The command to be executed.
+    log_level : str, optional
+        The logging level (default is 'INFO').
+    fail_fast : bool, optional
+        Whether the command is killed on the first failure seen in its output (default is False).
+    step : str, optional
+        The name of the deployment step running the command, recorded when it is aborted
+        or timed out.
+    timeout : float, optional
+        The number of seconds the command may run before it is killed (default is None).
+    results : AnsibleResults, optional
+        Filled with the per-host and per-task results of the run, to be queried afterwards
+        (default is None). Its `json_document` is set when the command selects the JSON
+        stdout callback with `ANSIBLE_STDOUT_CALLBACK`.
+
+    Returns
+    -------
+    bool
+        True if failures were detected, otherwise False, the same as `ansible_log_writer_analyzer`.
+
+    Notes
+    -----
+    The output is read line by line. Every line has its ANSI escape sequences and passwords
+    removed, is written to the log file straight away and is checked for failures as it
+    arrives, in the same pass, by an `AnsibleResults` (see `ansible_output_line`). Only the
+    last `ansible_stream_tail_lines` lines of output are kept in memory besides the results.
+    stderr is drained by a second thread and written to the log prefixed with `stderr:`.
+    The JSON summary written at the end holds the tail of stdout and stderr and the summary
+    of the results.
+
+    With `fail_fast` the command runs in its own session and the whole process group is
+    killed as soon as a fatal task, an unreachable host or a Python traceback shows up. A
+    fatal task is only acted on once the next line shows Ansible is not ignoring it, unless
+    it comes as an event of the ansible-runner backend, which carries `ignore_errors`. The
+    step, the last task started and the offending line are stored under `aborted` in the
+    JSON summary.
+
+    With `timeout` a watchdog timer kills the process group once the deadline passes and
+    the step is stored under `timed_out` in the JSON summary.
+    """
+    process_info = {}
+    # Fail-fast state, shared with the timer confirming a fatal task
+    abort_state = {'task': None, 'pending': None, 'pending_task': None, 'line': None, 'timer': None}
+    abort_lock = threading.Lock()
+    if results is None:
+        results = AnsibleResults()
+    if ansible_json_callback_pattern.search(command):
+        results.json_document = True
+    stdout_tail = deque(maxlen=ansible_stream_tail_lines)
+    stderr_tail = deque(maxlen=ansible_stream_tail_lines)
+    write_lock = threading.Lock()
+
+    with open(log_name, 'a') as f:
+        process = ansible_popen(
+            command, stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            encoding='utf-8', errors='replace',
+            start_new_session=fail_fast or bool(timeout),
+        )
+        watchdog_state = {'timed_out': False}
+        watchdog = None
+        if timeout:
+            watchdog = threading.Timer(
+                timeout, _ansible_watchdog_expired,
+                args=(process, watchdog_state, step, timeout),
+            )
+            watchdog.daemon = True
+            watchdog.start()
+        stderr_thread = threading.Thread(
+            target=_ansible_stream_stderr,
+            args=(process.stderr, f, write_lock, stderr_tail),
+            daemon=True,
+        )
+        stderr_thread.start()
+
+        for line in _ansible_stream_reader(process.stdout):
+            line, event = ansible_output_line(line)
+            line_failures = results.add(line, event, time.monotonic())
+            if line:
+                log.debug(line.rstrip('\n'))
+                stdout_tail.append(line)
+                with write_lock:
+                    f.write(line)
+                    f.flush()
+
+            if not fail_fast or abort_state['line'] is not None:
+                continue
+            if event is not None:
+                # An event tells whether its error is ignored, there is nothing to confirm
+                if line_failures:
+                    _ansible_fail_fast_abort(
+                        process, abort_state, abort_lock, line or event['event'], step,
+                        task=event.get('event_data', {}).get('task'),
+                    )
+                continue
+            with abort_lock:
+                pending = abort_state['pending']
+                abort_state['pending'] = None
+            if pending is not None and line.strip():
+                abort_state['timer'].cancel()
+                if not ansible_ignoring_pattern.match(line):
+                    _ansible_fail_fast_abort(
+                        process, abort_state, abort_lock, pending, step,
+                        task=abort_state['pending_task'],
+                    )
+                    continue
+            elif pending is not None:
+                abort_state['pending'] = pending
+            task = ansible_task_pattern.match(line)
+            if task:
+                abort_state['task'] = task.group(1)
+            if ansible_fatal_pattern.match(line):
+                # Ansible prints '...ignoring' right after an ignored error, so the abort
+                # waits briefly for the next line before it kills the command
+                abort_state['pending'] = line
+                abort_state['pending_task'] = abort_state['task']
+                abort_state['timer'] = threading.Timer(
+                    ansible_fatal_confirm_seconds, _ansible_fail_fast_abort,
+                    args=(process, abort_state, abort_lock, line, step),
+                    kwargs={'task': abort_state['task'], 'pending_only': True},
+                )
+                abort_state['timer'].start()
+            elif ansible_traceback_pattern.match(line):
+                _ansible_fail_fast_abort(process, abort_state, abort_lock, line, step)
+
+        process.wait()
+        results.close(time.monotonic())
+        stderr_thread.join()
+        if watchdog is not None:
+            watchdog.cancel()
+        if abort_state['timer'] is not None:
+            abort_state['timer'].cancel()
+        if abort_state['line'] is None and abort_state['pending'] is not None:
+            # The command ended right after a fatal task, nothing left to kill
+            abort_state['line'] = abort_state['pending']
+            abort_state['task'] = abort_state['pending_task']
+
+        # Store process details in the dictionary
+        process_info['command'] = filter_passwords(command)
+        process_info['exit_code'] = process.returncode
+        process_info['stdout_tail'] = ''.join(stdout_tail)
+        process_info['stderr_tail'] = ''.join(stderr_tail)
+        results_summary = results.summary()
+        if results_summary:
+            process_info['results'] = results_summary
+        if abort_state['line'] is not None:
+            process_info['aborted'] = {
+                'step': step,
+                'task': abort_state['task'],
+                'line': abort_state['line'].strip(),
+            }
+        if watchdog_state['timed_out']:
+            process_info['timed_out'] = {'step': step, 'timeout': timeout}
+
+        f.write(json.dumps(process_info, indent=4))
+        f.write('\n')
+
+    if stderr_tail or watchdog_state['timed_out'] or process.returncode:
+        log.error('Execution Failure')
+        return True
+
+    if not results.failed() and 'aborted' not in process_info:
+        log.info('No failures detected.')
+        return False
+    else:
+        log.warning('Failures were detected.')
+        results.log_failures(step)
+        return True
+
+
 def ansible_run_check(log_check_bool: list[bool]) -> bool:
     """
     Check a list of boolean values and return True if all values are False,
@@ -177,6 +1134,186 @@ def ansible_run_check(log_check_bool: list[bool]) -> bool:
         return False
 
 
+def ansible_inventory_store_for(inventory_directory: str) -> str:
+    """
+    Return the inventory store kept for an inventory YAML file, next to its directory,
+    e.g. /etc/ansible/inventory.db for /etc/ansible/hosts/main.yml.
+    """
+    inventory_directory = os.path.abspath(inventory_directory)
+    return os.path.join(os.path.dirname(os.path.dirname(inventory_directory)), 'inventory.db')
+
+
+@contextlib.contextmanager
+def ansible_inventory_store(store_path: str, inventory_directory: str = None, write: bool = False):
+    """
+    Open the inventory store, an indexed SQLite database of the inventory hosts.
+
+    Parameters
+    ----------
+    store_path : str
+        The path of the database, created when missing.
+    inventory_directory : str, optional
+        The inventory YAML file the store is exported to. A new store first imports its hosts.
+    write : bool, optional
+        Whether the store is changed. Writers hold an exclusive lock on `<store_path>.lock`
+        for the whole block, across processes, and the block runs in a single transaction
+        (default is False).
+
+    Yields
+    ------
+    sqlite3.Connection
+        The connection to the store.
+
+    Notes
+    -----
+    Every host of every group is a row keyed by `(inventory_group, hostname)` with its
+    variables in JSON, and a second index on `hostname` serves `--host` lookups.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(store_path)), exist_ok=True)
+    with contextlib.ExitStack() as stack:
+        if write:
+            lock_file = stack.enter_context(open(f'{store_path}.lock', 'a'))
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            stack.callback(fcntl.flock, lock_file, fcntl.LOCK_UN)
+        connection = sqlite3.connect(store_path, timeout=ansible_inventory_store_timeout)
+        stack.callback(connection.close)
+        if write:
+            created = not connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'inventory_hosts'",
+            ).fetchone()
+            with connection:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS inventory_hosts ('
+                    'inventory_group TEXT NOT NULL, hostname TEXT NOT NULL, host_vars TEXT NOT NULL, '
+                    'PRIMARY KEY (inventory_group, hostname))',
+                )
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS inventory_hosts_hostname ON inventory_hosts (hostname)',
+                )
+                if created and inventory_directory and os.path.exists(inventory_directory):
+                    _ansible_inventory_import(connection, inventory_directory)
+            with connection:
+                yield connection
+        else:
+            yield connection
+
+
+def _ansible_inventory_import(connection, inventory_directory):
+    """
+    Copy the hosts of an existing inventory YAML file into a new store.
+    """
+    with open(inventory_directory) as f:
+        existing_data = yaml.safe_load(f) or {}
+    rows = [
+        (group, hostname, json.dumps(host_vars or {}))
+        for group, content in existing_data.items()
+        for hostname, host_vars in ((content or {}).get('hosts') or {}).items()
+    ]
+    connection.executemany('INSERT OR REPLACE INTO inventory_hosts VALUES (?, ?, ?)', rows)
+    log.debug(f'Imported {len(rows)} hosts of {inventory_directory} into the inventory store')
+
+
+def ansible_inventory_upsert(store_path: str, hosts: list, inventory_directory: str = None) -> int:
+    """
+    Add or update many inventory hosts in one transaction.
+
+    Parameters
+    ----------
+    store_path : str
+        The path of the inventory store.
+    hosts : list
+        `(inventory_group, hostname, host_vars)` tuples, `host_vars` being a dictionary.
+    inventory_directory : str, optional
+        The inventory YAML file exported when hosts changed (default is None, no export).
+
+    Returns
+    -------
+    int
+        The number of hosts added or changed.
+    """
+    rows = [(group, hostname, json.dumps(host_vars, sort_keys=True)) for group, hostname, host_vars in hosts]
+    with ansible_inventory_store(store_path, inventory_directory, write=True) as connection:
+        before = connection.total_changes
+        connection.executemany(
+            'INSERT INTO inventory_hosts VALUES (?, ?, ?) '
+            'ON CONFLICT (inventory_group, hostname) DO UPDATE SET host_vars = excluded.host_vars '
+            'WHERE host_vars != excluded.host_vars',
+            rows,
+        )
+        changed = connection.total_changes - before
+        if inventory_directory and (changed or not os.path.exists(inventory_directory)):
+            ansible_inventory_export(connection, inventory_directory)
+    return changed
+
+
+def ansible_inventory_host(store_path: str, hostname: str) -> dict:
+    """
+    Look up the variables of an inventory host through the hostname index.
+
+    Returns
+    -------
+    dict
+        The variables of the host merged across its groups, empty when it is unknown.
+    """
+    if not os.path.exists(store_path):
+        return {}
+    host_vars = {}
+    with ansible_inventory_store(store_path) as connection:
+        for (row,) in connection.execute(
+            'SELECT host_vars FROM inventory_hosts WHERE hostname = ? ORDER BY inventory_group', (hostname,),
+        ):
+            host_vars.update(json.loads(row))
+    return host_vars
+
+
+def ansible_inventory_list(store_path: str) -> dict:
+    """
+    Build the dynamic inventory of the store, as printed by `--list`.
+
+    Returns
+    -------
+    dict
+        The hosts of every group and the variables of every host under `_meta`.
+    """
+    inventory = {'_meta': {'hostvars': {}}}
+    if not os.path.exists(store_path):
+        return inventory
+    with ansible_inventory_store(store_path) as connection:
+        for group, hostname, host_vars in connection.execute(
+            'SELECT inventory_group, hostname, host_vars FROM inventory_hosts ORDER BY inventory_group, hostname',
+        ):
+            inventory.setdefault(group, {'hosts': []})['hosts'].append(hostname)
+            inventory['_meta']['hostvars'].setdefault(hostname, {}).update(json.loads(host_vars))
+    return inventory
+
+
+def ansible_inventory_export(connection, inventory_directory: str):
+    """
+    Write the hosts of the store to an inventory YAML file, replacing it atomically.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        The connection to the store, see `ansible_inventory_store`.
+    inventory_directory : str
+        The path of the inventory YAML file.
+
+    Returns
+    -------
+    None
+    """
+    data = {}
+    for group, hostname, host_vars in connection.execute(
+        'SELECT inventory_group, hostname, host_vars FROM inventory_hosts ORDER BY inventory_group, hostname',
+    ):
+        data.setdefault(group, {'hosts': {}})['hosts'][hostname] = json.loads(host_vars)
+    directory = os.path.dirname(os.path.abspath(inventory_directory))
+    # Hidden temporary name, Ansible skips it when it reads the inventory directory meanwhile
+    with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.', suffix='.tmp', delete=False) as f:
+        yaml.safe_dump(data, f, default_flow_style=False)
+    os.replace(f.name, inventory_directory)
+
+
 def ansible_inventory_manager(identifier: str, hostname: str, username: str, password: str, inventory_directory: str, **kwargs):
     """
     Update the Ansible inventory file with the provided host information.
@@ -200,37 +1337,24 @@ def ansible_inventory_manager(identifier: str, hostname: str, username: str, pas
 
     Notes
     -----
-    This function updates the Ansible inventory file located at `inventory_directory` with the provided
-    host information. If the `identifier` already exists in the YAML file, it logs a message indicating
-    that the field already exists. Otherwise, it adds a new entry to the inventory file with the specified
-    `identifier`, `hostname`, `username`, and `password`. The function does not return any value.
+    The host is upserted into the inventory store kept next to the inventory directory (see
+    `ansible_inventory_store_for`), a changed password replacing the old one, and the inventory
+    YAML file is exported from the store when the host changed. Each update costs one indexed
+    write instead of parsing and dumping the whole file, and concurrent processes are
+    serialised by the lock of the store.
     """
     try:
-        # Load existing YAML file
-        with open(inventory_directory) as f:
-            existing_data = yaml.safe_load(f)
-        # Handle for empty file
-        existing_data = existing_data or {}
-        # Handle for existing entries
-        if identifier in existing_data:
+        host_vars = {
+            'ansible_user': f'{username}',
+            'ansible_ssh_pass': f'{password}',
+        }
+        changed = ansible_inventory_upsert(
+            ansible_inventory_store_for(inventory_directory),
+            [(identifier, hostname, host_vars)],
+            inventory_directory,
+        )
+        if not changed:
             log.info('The identifier field already exists in the YAML file.')
-        else:
-            # Update existing data with new dictionary
-            new_data = {
-                f'{identifier}': {
-                    'hosts': {
-                        f'{hostname}': {
-                            'ansible_user': f'{username}',
-                            'ansible_ssh_pass': f'{password}',
-                        },
-                    },
-                },
-            }
-            existing_data.update(new_data)
-
-            # Append updated data to YAML file
-            with open(inventory_directory, 'w') as f:
-                yaml.dump(existing_data, f)
         return True
     except Exception as ex:
         log.exception(ex)
@@ -338,7 +1462,7 @@ def ansible_ssh_keys_generate(directory, key_name):
 
 def execute_ansible_add_to_inventory():
     parser = argparse.ArgumentParser(
-        description='Execute ansible_add_to_inventory function',
+        description='Execute ansible_add_to_inventory function, or print the inventory store as a dynamic inventory',
     )
     parser.add_argument(
         '--identifier', type=str,
@@ -360,11 +1484,56 @@ def execute_ansible_add_to_inventory():
         '--inventory_directory', type=str,
         help='The directory for the ansible inventory file',
     )
-    args = parser.parse_args()
-    ansible_add_to_inventory(
-        args.identifier, args.hostname,
-        args.username, args.password, args.inventory_directory,
+    parser.add_argument(
+        '--bulk', type=str, metavar='FILE',
+        help='JSON list of hosts with their identifier, hostname, username and password, added in one transaction (- reads the standard input)',
+    )
+    parser.add_argument(
+        '--list', action='store_true',
+        help='Print the inventory store as a dynamic inventory',
+    )
+    parser.add_argument(
+        '--host', type=str,
+        help='Print the variables of a host of the inventory store',
     )
+    parser.add_argument(
+        '--store', type=str, default=None,
+        help='The inventory store (default: next to the inventory directory, or ANSIBLE_INVENTORY_STORE)',
+    )
+    args = parser.parse_args()
+    if args.store is None:
+        args.store = (
+            ansible_inventory_store_for(args.inventory_directory) if args.inventory_directory
+            else ansible_inventory_store_default
+        )
+
+    if args.list:
+        json.dump(ansible_inventory_list(args.store), sys.stdout)
+    elif args.host:
+        json.dump(ansible_inventory_host(args.store, args.host), sys.stdout)
+    elif args.bulk:
+        if args.bulk == '-':
+            hosts = json.load(sys.stdin)
+        else:
+            with open(args.bulk) as f:
+                hosts = json.load(f)
+        changed = ansible_inventory_upsert(
+            args.store,
+            [
+                (
+                    host['identifier'], host['hostname'],
+                    {'ansible_user': host['username'], 'ansible_ssh_pass': host['password']},
+                )
+                for host in hosts
+            ],
+            args.inventory_directory,
+        )
+        log.info(f'{changed} of {len(hosts)} hosts added or changed in the inventory')
+    else:
+        ansible_add_to_inventory(
+            args.identifier, args.hostname,
+            args.username, args.password, args.inventory_directory,
+        )
 
 
 if __name__ == '__main__':
@@ -1,11 +1,6 @@
-import crypt
 import os
-import string
-try:  # 3.6 or above
-    from secrets import choice as randchoice
-except ImportError:
-    from random import SystemRandom
-    randchoice = SystemRandom().choice
+
+from cloud_init_seed.password import sha512_crypt
 
 
 def generate_random_salt():
@@ -43,7 +38,7 @@ def cloud_init_sha512_crypt(password: str, salt: str = None, rounds: int = None)
         The salt value to use in the hash (default is None, a random salt will be generated).
     rounds : int, optional
         The number of rounds for hashing (default is None, using a default of 5000 rounds).
-        Rounds must be within the range 1000 to 999999999.
+        Rounds are kept within the range 1000 to 999999999.
 
     Returns
     -------
@@ -52,20 +47,10 @@ def cloud_init_sha512_crypt(password: str, salt: str = None, rounds: int = None)
 
     Notes
     -----
-    This function generates a SHA-512 crypt hash suitable for cloud-init configuration.
-    If `salt` is not provided, a random 8-character salt is generated. The `rounds` parameter
+    This function generates a SHA-512 crypt hash suitable for cloud-init configuration with
+    `cloud_init_seed.password.sha512_crypt`, the hashing `cloud_init_scripts` uses as well.
+    If `salt` is not provided, a random 16-character salt is generated. The `rounds` parameter
     determines the number of hashing rounds; if not provided, a default of 5000 rounds is used.
     The resulting hash is returned as a string.
     """
-    # Adapted from code by Martijn Pieters on Stack Overflow
-    # Original source: https://stackoverflow.com/questions/34463134/sha-512-crypt-output-written-with-python-code-is-different-from-mkpasswd
-    if salt is None:
-        salt = ''.join([
-            randchoice(string.ascii_letters + string.digits)
-            for _ in range(8)
-        ])
-    prefix = '$6$'
-    if rounds is not None:
-        rounds = max(1000, min(999999999, rounds or 5000))
-        prefix += f'rounds={rounds}$'
-    return str(crypt.crypt(password, prefix + salt))
+    return sha512_crypt(password, salt=salt, rounds=rounds)
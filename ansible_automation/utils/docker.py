@@ -109,3 +109,86 @@ def ensure_container_running(container_name, compose_file, build=True):
         start_container(container_name, compose_file, build)
     else:
         print(f'The container {container_name} is already running.')
+
+
+def copy_to_container(container_name, source, destination):
+    """
+    Copy a local file into a Docker container.
+
+    Parameters
+    ----------
+    container_name : str
+        Name of the Docker container.
+    source : str
+        Path of the local file to copy.
+    destination : str
+        Path inside the container the file is copied to.
+
+    Returns
+    -------
+    bool
+        True if the file was copied, False otherwise.
+    """
+    try:
+        subprocess.run(
+            ['docker', 'cp', source, f'{container_name}:{destination}'],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        return True
+    except subprocess.CalledProcessError as e:
+        print(f'An error occurred while copying {source} to the container: {e}')
+        return False
+
+
+def read_from_container(container_name, path):
+    """
+    Read a text file inside a Docker container.
+
+    Parameters
+    ----------
+    container_name : str
+        Name of the Docker container.
+    path : str
+        Path of the file inside the container.
+
+    Returns
+    -------
+    str or None
+        The content of the file, None if it could not be read.
+    """
+    try:
+        result = subprocess.run(
+            ['docker', 'exec', container_name, 'cat', path],
+            check=True, capture_output=True, text=True,
+        )
+        return result.stdout
+    except subprocess.CalledProcessError as e:
+        print(f'An error occurred while reading {path} from the container: {e}')
+        return None
+
+
+def remove_from_container(container_name, *paths):
+    """
+    Remove files inside a Docker container, ignoring the ones which do not exist.
+
+    Parameters
+    ----------
+    container_name : str
+        Name of the Docker container.
+    *paths : str
+        Paths of the files inside the container.
+
+    Returns
+    -------
+    bool
+        True if the files were removed, False otherwise.
+    """
+    try:
+        subprocess.run(
+            ['docker', 'exec', container_name, 'rm', '-f', *paths],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        return True
+    except subprocess.CalledProcessError as e:
+        print(f'An error occurred while removing {", ".join(paths)} from the container: {e}')
+        return False
@@ -0,0 +1,563 @@
+import json
+import logging
+import os
+import re
+import tempfile
+
+from utils.ansible import ansible_log_writer_analyzer
+from utils.ansible import ansible_playbook_command
+from utils.ansible import ansible_run_check
+from utils.cloud_init import cloud_init_sha512_crypt
+from utils.cloud_init import generate_random_salt
+from utils.docker import copy_to_container
+from utils.docker import read_from_container
+from utils.docker import remove_from_container
+
+log = logging.getLogger(__name__)
+
+# Inventory group holding one host per build entry
+fleet_group = 'fleet'
+
+# Inventory group holding one host per hypervisor, carrying all of its VMs in `build_kvm_vms`
+fleet_hypervisor_group = 'fleet_hypervisors'
+
+# Dynamic inventory of the ansible container, generated from the deployment configuration
+# installed at `fleet_config_path` (see inventory.py)
+fleet_inventory_path = '/deploy/inventory.py'
+
+# Location of the deployment configuration inside the ansible container
+fleet_config_path = '/deploy/build_config.json'
+
+# Locations of the ETO list given to `setup_eto.py --bulk` and of its report inside the ansible container
+fleet_eto_list_path = '/deploy/fleet_etos.json'
+fleet_eto_report_path = '/deploy/fleet_etos_report.jsonl'
+
+# Defaults applied by deploy.py when a build entry leaves a field out
+fleet_build_defaults = {
+    'vm_vcpus': 8,
+    'vm_memory': 16384,
+    'vm_os_variant': 'centos7.0',
+    'vm_boot': 'hd,cdrom',
+    'vm_cpu': 'host',
+    'vm_source_mode': 'bridge',
+    'vm_username': 'root',
+}
+
+# Build entry fields which are passed on to the playbooks as host variables
+fleet_host_var_names = (
+    'hypervisor_hostname',
+    'hypervisor_username',
+    'hypervisor_password',
+    'hypervisor_vm_image_loc',
+    'hypervisor_dest_directory',
+    'vm_qcow_name',
+    'vm_vcpus',
+    'vm_memory',
+    'vm_os_variant',
+    'vm_boot',
+    'vm_cpu',
+    'vm_source',
+    'vm_model',
+    'vm_source_mode',
+    'vm_network_net_a',
+    'vm_network_net_b',
+    'vm_network_app_a',
+    'vm_network_app_b',
+    'vm_network_mir_a',
+    'vm_network_mir_b',
+    'vm_username',
+    'vm_hostname',
+    'vm_static_ip_address',
+    'vm_ip_gateway',
+    'vm_ip_netmask',
+    'vm_dns_server_1',
+    'vm_dns_server_2',
+)
+
+# Optional build entry fields, only passed on to the playbooks when they are set as the
+# roles check whether they are defined
+optional_host_var_names = (
+    'hypervisor_vm_image_sha256',
+    'hypervisor_image_cache',
+    'hypervisor_image_cache_max_gb',
+    'vm_disk_mode',
+    'vm_backend',
+    'vm_seed_url',
+)
+
+
+# Build entry fields named differently as setup_kvm.py arguments in the batch manifest
+manifest_argument_names = {
+    'hypervisor_image_cache': 'image_cache',
+    'hypervisor_image_cache_max_gb': 'image_cache_max_gb',
+}
+
+# Host variables which only concern the connection to the hypervisor, kept out of the batch manifest
+connection_host_var_names = (
+    'ansible_host',
+    'ansible_user',
+    'ansible_ssh_pass',
+    'hypervisor_hostname',
+    'hypervisor_username',
+    'hypervisor_password',
+)
+
+
+def build_optional_extra_vars(build):
+    """
+    Select the optional build entry fields which are set as ansible-playbook extra vars.
+
+    Parameters
+    ----------
+    build : dict
+        A dictionary containing the build options for one VM.
+
+    Returns
+    -------
+    dict
+        The optional fields set in the build entry, by name.
+    """
+    return {
+        name: build[name] for name in optional_host_var_names
+        if build.get(name) is not None
+    }
+
+
+def build_step_timeout(build, step_key):
+    """
+    Return the deadline configured for a step of a build entry.
+
+    Parameters
+    ----------
+    build : dict
+        A dictionary containing the build options for one VM.
+    step_key : str
+        The key of the step: 'ssh_setup', 'setup', 'install_kvm', 'vm_ready', 'setup_eto' or 'cleanup'.
+
+    Returns
+    -------
+    float or None
+        The number of seconds the step may run, None when the build entry does not set one
+        and the global `--step-timeout` applies.
+
+    Notes
+    -----
+    Build entries set deadlines with an optional `step_timeouts` dictionary, keyed by step
+    with a `default` key applying to the steps not listed, e.g.
+    `"step_timeouts": {"default": 900, "install_kvm": 3600}`.
+    """
+    step_timeouts = build.get('step_timeouts') or {}
+    return step_timeouts.get(step_key, step_timeouts.get('default'))
+
+
+def fleet_step_timeout(build_options, step_key):
+    """
+    Return the deadline of a step run once across the whole fleet.
+
+    Parameters
+    ----------
+    build_options : list
+        A list of dictionaries containing build options.
+    step_key : str
+        The key of the step (see `build_step_timeout`).
+
+    Returns
+    -------
+    float or None
+        The longest deadline set by the build entries, None when none of them sets one.
+    """
+    timeouts = [
+        build_step_timeout(build, step_key) for build in build_options
+    ]
+    timeouts = [timeout for timeout in timeouts if timeout is not None]
+    return max(timeouts) if timeouts else None
+
+
+def fleet_host_alias(build):
+    """
+    Return the inventory host name used for a build entry.
+
+    Parameters
+    ----------
+    build : dict
+        A dictionary containing the build options for one VM.
+
+    Returns
+    -------
+    str
+        The alias `<hypervisor_hostname>-<vm_qcow_name>`.
+
+    Notes
+    -----
+    A hypervisor can hold several VMs, so the hypervisor hostname on its own cannot be used
+    as the inventory host. Every build entry gets an alias which connects to the hypervisor
+    through `ansible_host` and carries the variables of its VM.
+    """
+    alias = f"{build.get('hypervisor_hostname')}-{build.get('vm_qcow_name')}"
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', alias)
+
+
+def fleet_host_aliases(build_options):
+    """
+    Return the inventory host name of every build entry, made unique across the configuration.
+
+    Parameters
+    ----------
+    build_options : list
+        A list of dictionaries containing build options.
+
+    Returns
+    -------
+    list
+        The aliases (see `fleet_host_alias`), in configuration order. The position of the entry
+        is appended when two build entries would end up with the same alias.
+    """
+    aliases = []
+    for index, build in enumerate(build_options):
+        alias = fleet_host_alias(build)
+        if alias in aliases:
+            alias = f'{alias}-{index}'
+        aliases.append(alias)
+    return aliases
+
+
+def fleet_host_vars(build):
+    """
+    Build the inventory variables of a build entry.
+
+    Parameters
+    ----------
+    build : dict
+        A dictionary containing the build options for one VM.
+
+    Returns
+    -------
+    dict
+        The host variables, including the connection settings for the hypervisor and the
+        hashed VM password used by the cloud-init configuration.
+    """
+    host_vars = {
+        'ansible_host': build.get('hypervisor_hostname'),
+        'ansible_user': build.get('hypervisor_username'),
+        'ansible_ssh_pass': build.get('hypervisor_password'),
+    }
+    for name in fleet_host_var_names:
+        host_vars[name] = build.get(name, fleet_build_defaults.get(name))
+    for name in optional_host_var_names:
+        if build.get(name) is not None:
+            host_vars[name] = build[name]
+
+    if build.get('vm_password') is not None:
+        host_vars['vm_hashed_password'] = cloud_init_sha512_crypt(
+            build['vm_password'], salt=generate_random_salt(), rounds=5000,
+        )
+    return host_vars
+
+
+def fleet_manifest_entry(host_vars):
+    """
+    Turn the host variables of a build entry into a VM of the setup_kvm.py batch manifest.
+
+    Parameters
+    ----------
+    host_vars : dict
+        The host variables of the build entry, see `fleet_host_vars`.
+
+    Returns
+    -------
+    dict
+        The setup_kvm.py arguments of the VM, without the unset ones.
+    """
+    names = fleet_host_var_names + optional_host_var_names + ('vm_hashed_password',)
+    return {
+        manifest_argument_names.get(name, name): host_vars[name]
+        for name in names
+        if name not in connection_host_var_names and host_vars.get(name) is not None
+    }
+
+
+def fleet_inventory(build_options):
+    """
+    Turn the deployment configuration into a single Ansible inventory.
+
+    Parameters
+    ----------
+    build_options : list
+        A list of dictionaries containing build options.
+
+    Returns
+    -------
+    dict
+        An inventory with one host per build entry in the `fleet` group, and one host per
+        hypervisor in the `fleet_hypervisors` group.
+
+    Notes
+    -----
+    The hosts of the `fleet` group are named by `fleet_host_aliases`. The first alias of every
+    hypervisor is flagged with `fleet_first_on_host` so the roles run package installs only once
+    per hypervisor instead of once per VM. The hosts of `fleet_hypervisors` carry the VMs of their hypervisor as the
+    `build_kvm_vms` manifest of `install_kvm_batch.yml`.
+    """
+    hosts = {}
+    hypervisors = {}
+    for alias, build in zip(fleet_host_aliases(build_options), build_options):
+        host_vars = fleet_host_vars(build)
+        hypervisor = host_vars['ansible_host']
+        host_vars['fleet_first_on_host'] = hypervisor not in hypervisors
+        hosts[alias] = host_vars
+
+        if hypervisor not in hypervisors:
+            hypervisors[hypervisor] = {
+                name: host_vars[name] for name in connection_host_var_names
+            }
+            hypervisors[hypervisor]['build_kvm_vms'] = []
+        hypervisors[hypervisor]['build_kvm_vms'].append(fleet_manifest_entry(host_vars))
+
+    hypervisor_hosts = {
+        re.sub(r'[^A-Za-z0-9_.-]', '_', str(hypervisor)): host_vars
+        for hypervisor, host_vars in hypervisors.items()
+    }
+    return {
+        fleet_group: {'hosts': hosts},
+        fleet_hypervisor_group: {'hosts': hypervisor_hosts},
+    }
+
+
+def fleet_dynamic_inventory(build_options):
+    """
+    Turn the deployment configuration into the JSON of an Ansible dynamic inventory.
+
+    Parameters
+    ----------
+    build_options : list
+        A list of dictionaries containing build options.
+
+    Returns
+    -------
+    dict
+        The groups of `fleet_inventory`, plus a `<hypervisor_hostname>-deployed` group per
+        hypervisor holding the hypervisor with its SSH credentials, as the per-host steps
+        target it. The variables of every host are under `_meta`, so Ansible does not call
+        `--host` for each of them.
+    """
+    inventory = {'_meta': {'hostvars': {}}}
+    host_vars_by_host = inventory['_meta']['hostvars']
+
+    def add(group, hostname, host_vars):
+        hosts = inventory.setdefault(group, {'hosts': []})['hosts']
+        if hostname not in hosts:
+            hosts.append(hostname)
+        host_vars_by_host.setdefault(hostname, {}).update(host_vars)
+
+    for group, content in fleet_inventory(build_options).items():
+        for hostname, host_vars in content['hosts'].items():
+            add(group, hostname, host_vars)
+    for build in build_options:
+        hypervisor_hostname = build.get('hypervisor_hostname')
+        add(f'{hypervisor_hostname}-deployed', hypervisor_hostname, {
+            'ansible_user': build.get('hypervisor_username'),
+            'ansible_ssh_pass': build.get('hypervisor_password'),
+        })
+    return inventory
+
+
+def fleet_config_install(build_options, docker_name):
+    """
+    Copy the deployment configuration into the ansible container, where it is the inventory.
+
+    Parameters
+    ----------
+    build_options : list
+        A list of dictionaries containing build options.
+    docker_name : str
+        The name of the ansible docker container.
+
+    Returns
+    -------
+    bool
+        True if the configuration was copied, False otherwise.
+
+    Notes
+    -----
+    The dynamic inventory of the container (`fleet_inventory_path`, part of its default
+    inventory) reads the configuration from `fleet_config_path` on every Ansible run, so the
+    hosts no longer have to be added to the inventory one by one and always match the
+    configuration. The configuration holds the passwords, so the file is only readable by
+    its owner.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        local_config = os.path.join(tmp_dir, 'build_config.json')
+        fd = os.open(local_config, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(build_options, f)
+        return copy_to_container(docker_name, local_config, fleet_config_path)
+
+
+def fleet_playbook_command(playbook, inventory_path, forks=5, serial=0, target_hosts=fleet_group):
+    """
+    Build the command which runs a playbook once across the whole fleet.
+
+    Parameters
+    ----------
+    playbook : str
+        The playbook to run (e.g. playbooks/setup.yml).
+    inventory_path : str
+        The path of the fleet inventory inside the ansible container.
+    forks : int, optional
+        The number of hosts Ansible works on in parallel (default is 5).
+    serial : int, optional
+        The batch size of hosts running the play, 0 runs all hosts in one batch (default is 0).
+    target_hosts : str, optional
+        The inventory group the play runs on (default is `fleet_group`).
+
+    Returns
+    -------
+    str
+        The command, see `utils.ansible.ansible_playbook_command`.
+    """
+    return ansible_playbook_command(
+        playbook, {'target_hosts': target_hosts, 'fleet_serial': serial},
+        inventory=inventory_path, forks=forks,
+    )
+
+
+def fleet_execute(build_options, stages, log_name, log_level, docker_name, forks=5, serial=0):
+    """
+    Run each stage playbook once across every build entry of the configuration.
+
+    Parameters
+    ----------
+    build_options : list
+        A list of dictionaries containing build options.
+    stages : list
+        A list of `(step_name, message, playbook, step_key)` tuples, run in order. The
+        `step_key` selects the deadline of the stage (see `fleet_step_timeout`). A fifth
+        element names the inventory group the stage runs on, `fleet` when left out.
+    log_name : str
+        The name of the log file.
+    log_level : str
+        The logging level.
+    docker_name : str
+        The name of the ansible docker container.
+    forks : int, optional
+        The number of hosts Ansible works on in parallel (default is 5).
+    serial : int, optional
+        The batch size of hosts running each play, 0 runs all hosts in one batch (default is 0).
+
+    Returns
+    -------
+    bool
+        True if every stage succeeded, False as soon as a stage fails.
+
+    Notes
+    -----
+    The configuration is copied into the container once and every stage runs on the
+    dynamic inventory generated from it (see `fleet_dynamic_inventory`). Ansible start-up,
+    playbook parsing and fact gathering are paid once per stage instead of once per build entry.
+    """
+    log_check_bool = []
+
+    if not fleet_config_install(build_options, docker_name):
+        raise Exception('Something went wrong when copying the configuration')
+
+    for step_name, message, playbook, step_key, *target in stages:
+        log.info(f'[{fleet_group}] {step_name}')
+        log_check_bool.append(
+            ansible_log_writer_analyzer(log_name, f'echo {message}'),
+        )
+        command = fleet_playbook_command(
+            playbook, fleet_inventory_path, forks, serial, *target,
+        )
+        log_check_bool.append(
+            ansible_log_writer_analyzer(
+                log_name, f'docker exec -t {docker_name} {command}', log_level,
+                step=step_name, timeout=fleet_step_timeout(build_options, step_key),
+            ),
+        )
+        # If failed stop the remaining stages
+        if ansible_run_check(log_check_bool):
+            log.error(f'[{fleet_group}] Failed {step_name}')
+            return False
+
+    return True
+
+
+def fleet_eto_list(build_options):
+    """
+    List the ETOs of the build entries in the format of `setup_eto.py --bulk`.
+
+    Parameters
+    ----------
+    build_options : list
+        A list of dictionaries containing build options, each with a `vm_static_ip_address`.
+
+    Returns
+    -------
+    list
+        One dictionary per build entry with the `ip`, `username`, `old_password`, `password`
+        and `allow_enrollment` of its ETO, the `vm_allow_enrollment` of the entry as it is
+        (True when unset), read by `setup_eto.parse_bool` like `--allow-enrollment`.
+    """
+    return [
+        {
+            'ip': build.get('vm_static_ip_address'),
+            'username': build.get('vm_api_username'),
+            'old_password': build.get('vm_old_password'),
+            'password': build.get('vm_password'),
+            'allow_enrollment': build.get('vm_allow_enrollment', True),
+        }
+        for build in build_options
+    ]
+
+
+def fleet_setup_etos(build_options, log_name, docker_name, workers=32):
+    """
+    Change the default API settings of the ETOs of many build entries with one bulk run.
+
+    Parameters
+    ----------
+    build_options : list
+        A list of dictionaries containing build options, each with a `vm_static_ip_address`.
+    log_name : str
+        The name of the log file.
+    docker_name : str
+        The name of the ansible docker container.
+    workers : int, optional
+        The number of ETOs set up at the same time (default is 32).
+
+    Returns
+    -------
+    dict
+        True per `vm_static_ip_address` if its ETO was set up, otherwise False.
+
+    Notes
+    -----
+    The ETO list is copied into the container, keeping the passwords off the command line,
+    and `setup_eto.py --bulk` sets up all ETOs from a single process sharing its connection
+    pool (see `setup_eto.setup_etos_bulk`). The result of each ETO is read back from the
+    report of the run, an ETO missing from it has failed.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        local_list = os.path.join(tmp_dir, 'fleet_etos.json')
+        fd = os.open(local_list, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(fleet_eto_list(build_options), f)
+        if not copy_to_container(docker_name, local_list, fleet_eto_list_path):
+            raise Exception('Something went wrong when copying the ETO list')
+
+    command = (
+        f'python3 /deploy/setup_eto.py --bulk {fleet_eto_list_path} '
+        f'--report {fleet_eto_report_path} --workers {workers}'
+    )
+    ansible_log_writer_analyzer(
+        log_name, f'docker exec -t {docker_name} {command}',
+        step='Step 5: Setup the VMs via API', timeout=fleet_step_timeout(build_options, 'setup_eto'),
+    )
+
+    results = {build.get('vm_static_ip_address'): False for build in build_options}
+    for line in (read_from_container(docker_name, fleet_eto_report_path) or '').splitlines():
+        entry = json.loads(line)
+        if entry['ip'] in results:
+            results[entry['ip']] = entry['status'] == 'ok'
+    remove_from_container(docker_name, fleet_eto_list_path, fleet_eto_report_path)
+    return results
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Run a playbook through the ansible-runner API inside the ansible container.
+
+The run is described by one JSON argument, so the extra vars reach Ansible as a dictionary
+without being formatted as `name=value` pairs and quoted for the shell:
+
+    python3 /deploy/utils/playbook_runner.py '{"playbook": "playbooks/setup.yml", "extra_vars": {...}}'
+
+Every event of the run is printed as a JSON line as soon as Ansible emits it, and the exit
+code is the one of ansible-playbook. See `utils.ansible.ansible_playbook_command`.
+"""
+import json
+import os
+import sys
+import tempfile
+
+import ansible_runner
+
+# Fields of the event data printed with every event
+playbook_runner_event_fields = (
+    'host', 'play', 'task', 'role', 'task_action', 'ignore_errors', 'duration', 'start', 'end',
+)
+
+# Fields of the task result printed with every event
+playbook_runner_result_fields = ('msg', 'rc', 'changed', 'failed', 'unreachable', 'skipped', 'skip_reason')
+
+# Fields of the play recap printed with the stats event
+playbook_runner_stats_fields = ('ok', 'changed', 'failures', 'dark', 'skipped', 'rescued', 'ignored')
+
+# Longest display text kept per event, so an event always fits one line of the log analyzer
+playbook_runner_max_stdout = 32 * 1024
+
+
+def playbook_runner_event(event):
+    """
+    Keep the parts of an ansible-runner event needed to judge the run.
+
+    Parameters
+    ----------
+    event : dict
+        The event handed to the `event_handler` of ansible-runner.
+
+    Returns
+    -------
+    dict
+        The event name, counter, display text and the selected event data.
+    """
+    data = event.get('event_data', {})
+    event_data = {name: data[name] for name in playbook_runner_event_fields if name in data}
+    if isinstance(data.get('res'), dict):
+        event_data['res'] = {
+            name: data['res'][name] for name in playbook_runner_result_fields if name in data['res']
+        }
+    for name in playbook_runner_stats_fields:
+        if name in data:
+            event_data[name] = data[name]
+    stdout = event.get('stdout', '')
+    if len(stdout) > playbook_runner_max_stdout:
+        stdout = stdout[:playbook_runner_max_stdout] + '\n[output truncated]'
+    return {
+        'event': event.get('event'),
+        'counter': event.get('counter'),
+        'stdout': stdout,
+        'event_data': event_data,
+    }
+
+
+def playbook_runner_run(request):
+    """
+    Run a playbook described by a request and print its events.
+
+    Parameters
+    ----------
+    request : dict
+        - playbook: The playbook, relative to the working directory (e.g. playbooks/setup.yml).
+        - extra_vars: The extra vars, as a dictionary.
+        - inventory: The inventory, None for the default inventory of the container.
+        - forks: The number of hosts Ansible works on in parallel.
+        - limit: The hosts the run is limited to.
+
+    Returns
+    -------
+    int
+        The exit code of the run.
+    """
+    def print_event(event):
+        sys.stdout.write(json.dumps(playbook_runner_event(event)) + '\n')
+        sys.stdout.flush()
+        # The events are not kept in the private data directory, they are not read back
+        return False
+
+    options = {
+        name: request[name] for name in ('inventory', 'forks', 'limit') if request.get(name) is not None
+    }
+    with tempfile.TemporaryDirectory(prefix='playbook_runner_') as private_data_dir:
+        runner = ansible_runner.run(
+            private_data_dir=private_data_dir,
+            project_dir=os.getcwd(),
+            playbook=os.path.abspath(request['playbook']),
+            extravars=request.get('extra_vars') or {},
+            event_handler=print_event,
+            quiet=True,
+            **options,
+        )
+    return runner.rc
+
+
+if __name__ == '__main__':
+    sys.exit(playbook_runner_run(json.loads(sys.argv[1])))
@@ -0,0 +1,241 @@
+import logging
+import re
+import socket
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.seed_server import seed_phoned_home
+
+log = logging.getLogger(__name__)
+
+# Default options of `wait_for_vms`, set with `readiness_configure`
+readiness_defaults = {
+    'timeout': 900,
+    'seed_server': None,
+}
+
+# Port of the management IP probed to tell the ETO is up, the API setup connects to it next
+ready_probe_port = 443
+
+# Seconds between two rounds of probes, and the connect timeout of a probe
+ready_probe_interval = 5
+ready_probe_connect_timeout = 3
+
+# Seconds between two queries of the libvirt domain states, each one is an ansible run
+domain_state_interval = 30
+
+# States of a launched domain which will not come up on its own, 'missing' when it is not defined
+domain_failed_states = ('shut off', 'crashed', 'missing')
+
+# One-line output of the ad-hoc virsh command, e.g. `host | CHANGED | rc=0 | (stdout) running (booted)`
+domain_state_pattern = re.compile(r'^(\S+) \| (CHANGED|SUCCESS|FAILED) \| rc=(\d+) \| \(stdout\) ?(.*)$')
+
+
+def readiness_configure(**options):
+    """
+    Set the default options of `wait_for_vms`.
+
+    Parameters
+    ----------
+    **options
+        The options to set:
+        - timeout: Seconds a VM may take to become ready before it is marked as failed.
+        - seed_server: The seed server the VMs phone home to (see `utils.seed_server`), None when
+          the VMs boot from a cloud-init ISO.
+
+    Returns
+    -------
+    None
+    """
+    unknown = set(options) - set(readiness_defaults)
+    if unknown:
+        raise ValueError(f'Unknown readiness options: {sorted(unknown)}')
+    readiness_defaults.update(options)
+
+
+def tcp_probe(address, port=ready_probe_port, timeout=ready_probe_connect_timeout):
+    """
+    Check whether a TCP connection to a port can be opened.
+
+    Returns
+    -------
+    bool
+        True if the connection was accepted.
+    """
+    try:
+        with socket.create_connection((address, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def domain_state_failed(state):
+    """
+    Tell whether a domain state, as printed by `virsh domstate --reason`, means the VM will not come up.
+    """
+    return state.split(' (', 1)[0] in domain_failed_states
+
+
+def parse_domain_states(output):
+    """
+    Parse the one-line output of `virsh domstate --reason` run as an ansible ad-hoc command.
+
+    Parameters
+    ----------
+    output : str
+        The output of `ansible -o`, one line per host.
+
+    Returns
+    -------
+    dict
+        The state of the domain per inventory host, e.g. 'running (booted)'. Unreachable hosts
+        are left out, hosts without the domain are 'missing'.
+    """
+    states = {}
+    for line in output.splitlines():
+        match = domain_state_pattern.match(line.strip())
+        if match is None:
+            continue
+        host, status, rc, stdout = match.groups()
+        if status == 'FAILED' or rc != '0':
+            if 'failed to get domain' in line:
+                states[host] = 'missing'
+            continue
+        # Multi-line output is joined with literal \n
+        states[host] = stdout.split(' (stderr)', 1)[0].split('\\n', 1)[0].strip()
+    return states
+
+
+def query_domain_states(docker_name, hosts, vm_qcow_name='{{ vm_qcow_name }}', inventory_path=None):
+    """
+    Read the state of the libvirt domains of several inventory hosts with one ad-hoc ansible run.
+
+    Parameters
+    ----------
+    docker_name : str
+        The name of the ansible docker container.
+    hosts : list
+        The inventory hosts, each one a hypervisor or a fleet alias.
+    vm_qcow_name : str, optional
+        The name of the domain, templated per host (default is the `vm_qcow_name` host variable).
+    inventory_path : str, optional
+        The inventory inside the container (default is None, the container's default inventory).
+
+    Returns
+    -------
+    dict
+        The state of the domain per host, see `parse_domain_states`. Hosts which could not be
+        queried are left out.
+    """
+    command = ['docker', 'exec', docker_name, 'ansible', ':'.join(hosts), '-o']
+    if inventory_path:
+        command += ['-i', inventory_path]
+    command += ['-m', 'command', '-a', f'virsh domstate --reason {vm_qcow_name}']
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, timeout=120)
+    except subprocess.TimeoutExpired:
+        log.warning(f'Timed out reading the domain states of {", ".join(hosts)}')
+        return {}
+    return parse_domain_states(result.stdout)
+
+
+def vm_ready_target(name, build):
+    """
+    Describe the VM of a build entry for `wait_for_vms`.
+
+    Parameters
+    ----------
+    name : str
+        The inventory host the domain state of the VM is read from.
+    build : dict
+        A dictionary containing the build options for one VM.
+
+    Returns
+    -------
+    dict
+        The `name`, `vm_hostname` and management `address` of the VM.
+    """
+    return {
+        'name': name,
+        'vm_hostname': build.get('vm_hostname'),
+        'address': build.get('vm_static_ip_address'),
+    }
+
+
+def wait_for_vms(vms, query_states=None, timeout=None, seed_server=None):
+    """
+    Wait until freshly launched VMs are up, returning as soon as each one is.
+
+    Parameters
+    ----------
+    vms : list
+        One dictionary per VM with its `name` (the inventory host its domain state is read
+        from, also used in the logs), `vm_hostname` and management `address` (None when the VM
+        has no static IP).
+    query_states : callable, optional
+        Called with the names of the VMs still pending, returns their domain states (see
+        `query_domain_states`). Default is None, the domain states are not checked.
+    timeout : float, optional
+        Seconds the VMs may take (default is None, the `timeout` of `readiness_configure`).
+    seed_server : ThreadingHTTPServer, optional
+        The seed server the VMs phone home to (default is None, the `seed_server` of
+        `readiness_configure`).
+
+    Returns
+    -------
+    dict
+        True per VM name if it became ready, False if it failed or timed out.
+
+    Notes
+    -----
+    A VM is ready once its management address accepts a TCP connection on `ready_probe_port`
+    or once it phoned home to the seed server. A VM offering neither signal is ready as soon
+    as its domain runs. A domain which shut off or crashed fails the VM straight away rather
+    than at the deadline. The probes run every `ready_probe_interval` seconds and the domain
+    states are read every `domain_state_interval` seconds.
+    """
+    timeout = readiness_defaults['timeout'] if timeout is None else timeout
+    seed_server = readiness_defaults['seed_server'] if seed_server is None else seed_server
+    deadline = time.monotonic() + timeout
+    pending = {vm['name']: vm for vm in vms}
+    results = {}
+    next_state_query = time.monotonic()
+
+    def done(name, ready, message):
+        (log.info if ready else log.error)(f'[{name}] {message}')
+        results[name] = ready
+        del pending[name]
+
+    for name, vm in list(pending.items()):
+        if not vm.get('address') and seed_server is None and query_states is None:
+            done(name, True, 'No readiness signal for the VM, not waiting for it')
+
+    with ThreadPoolExecutor(max_workers=max(1, min(32, len(vms)))) as executor:
+        while pending:
+            if query_states is not None and time.monotonic() >= next_state_query:
+                next_state_query = time.monotonic() + domain_state_interval
+                for name, state in query_states(list(pending)).items():
+                    if name not in pending:
+                        continue
+                    if domain_state_failed(state):
+                        done(name, False, f'The VM is not running: {state}')
+                    elif state.startswith('running') and not pending[name].get('address') and seed_server is None:
+                        done(name, True, 'The VM is running')
+
+            if seed_server is not None:
+                for name, vm in list(pending.items()):
+                    if seed_phoned_home(seed_server, vm['vm_hostname']):
+                        done(name, True, 'The VM phoned home')
+
+            probed = [vm for vm in pending.values() if vm.get('address')]
+            for vm, up in zip(probed, executor.map(lambda vm: tcp_probe(vm['address'], ready_probe_port), probed)):
+                if up and vm['name'] in pending:
+                    done(vm['name'], True, f"The VM accepts connections on {vm['address']}:{ready_probe_port}")
+
+            if pending and time.monotonic() >= deadline:
+                for name in list(pending):
+                    done(name, False, f'The VM was not ready after {timeout} seconds')
+            if pending:
+                time.sleep(ready_probe_interval)
+    return results
@@ -0,0 +1,206 @@
+import contextlib
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import unquote
+from urllib.parse import urlparse
+
+from cloud_init_seed.templates import render_cloud_init_templates
+from utils.cloud_init import cloud_init_sha512_crypt
+from utils.cloud_init import generate_random_salt
+
+log = logging.getLogger(__name__)
+
+# Files cloud-init fetches from a NoCloud-net seed, vendor-data is served empty
+seed_file_names = ('user-data', 'meta-data', 'vendor-data')
+
+# Path the cloud-init phone_home module of a VM posts to once it has finished, under the key of its seed
+seed_phone_home_name = 'phone-home'
+
+
+def seed_key(key):
+    """
+    Normalise the hostname a seed is served under, hostnames being case-insensitive.
+    """
+    return key.strip().lower()
+
+
+class SeedRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serve `/<key>/user-data`, `/<key>/meta-data` and `/<key>/vendor-data` from the seeds of the server,
+    and record the `/<key>/phone-home` posts of the VMs.
+    """
+
+    def do_GET(self):
+        key, _, name = unquote(urlparse(self.path).path).strip('/').rpartition('/')
+        with self.server.seeds_lock:
+            seed = self.server.seeds.get(seed_key(key)) if key else None
+        if seed is None or name not in seed_file_names:
+            self.send_error(404)
+            return
+        body = seed.get(name, '').encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        log.info(f'Seed server: {self.client_address[0]} fetched {name} of {key}')
+
+    def do_POST(self):
+        key, _, name = unquote(urlparse(self.path).path).strip('/').rpartition('/')
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        with self.server.seeds_lock:
+            known = key and seed_key(key) in self.server.seeds
+            if known and name == seed_phone_home_name:
+                self.server.phoned_home.add(seed_key(key))
+        if not known or name != seed_phone_home_name:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        log.info(f'Seed server: {key} phoned home from {self.client_address[0]}')
+
+    def log_message(self, format, *args):
+        log.debug('Seed server: ' + format % args)
+
+
+def start_seed_server(url):
+    """
+    Start serving NoCloud-net seeds in a background thread.
+
+    Parameters
+    ----------
+    url : str
+        The URL the VMs reach this machine on, e.g. 'http://10.0.0.2:8000/'. The server listens
+        on every interface on the port of the URL (80 when none is given).
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        The running server, see `add_seed` and `stop_seed_server`.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme != 'http' or not parsed.hostname:
+        raise ValueError(f'The seed server URL must look like http://<address>:<port>/, not {url}')
+    server = ThreadingHTTPServer(('', parsed.port or 80), SeedRequestHandler)
+    server.daemon_threads = True
+    server.base_url = url.rstrip('/') + '/'
+    server.seeds = {}
+    server.phoned_home = set()
+    server.seeds_lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, name='seed-server', daemon=True).start()
+    log.info(f'Seed server listening on port {server.server_address[1]}, serving {server.base_url}')
+    return server
+
+
+def add_seed(server, keys, user_data, meta_data):
+    """
+    Serve the cloud-init seed of a VM.
+
+    Parameters
+    ----------
+    server : ThreadingHTTPServer
+        The seed server, see `start_seed_server`.
+    keys : Iterable[str]
+        The hostnames the seed is served under.
+    user_data : str
+        The cloud-init user data, a phone_home entry posting to the server is appended to it.
+    meta_data : str
+        The cloud-init metadata.
+
+    Returns
+    -------
+    str
+        The seed URL of the first key, ending with '/' as cloud-init appends the file names to it.
+    """
+    keys = [seed_key(key) for key in keys]
+    # The phone_home module of cloud-init tells the readiness stage that the VM has booted
+    user_data += (
+        'phone_home:\n'
+        f'  url: {server.base_url}{keys[0]}/{seed_phone_home_name}\n'
+        '  post: [instance_id, hostname]\n'
+        '  tries: 10\n'
+    )
+    with server.seeds_lock:
+        for key in keys:
+            server.seeds[key] = {'user-data': user_data, 'meta-data': meta_data}
+            server.phoned_home.discard(key)
+    return f'{server.base_url}{keys[0]}/'
+
+
+def seed_phoned_home(server, key):
+    """
+    Tell whether the VM of a seed has phoned home since its seed was added.
+    """
+    with server.seeds_lock:
+        return seed_key(key) in server.phoned_home
+
+
+def add_build_seed(server, build):
+    """
+    Serve the cloud-init seed of a build entry and point the build at it.
+
+    Parameters
+    ----------
+    server : ThreadingHTTPServer
+        The seed server, see `start_seed_server`.
+    build : dict
+        A dictionary containing the build options for one VM. The seed is served under its
+        `vm_hostname` and its `vm_seed_url` is set.
+
+    Returns
+    -------
+    str
+        The seed URL of the build.
+    """
+    vm_hostname = build.get('vm_hostname')
+    user_data, meta_data = render_cloud_init_templates(
+        vm_username=build.get('vm_username', 'root'),
+        vm_hashed_password=cloud_init_sha512_crypt(
+            build.get('vm_password'), salt=generate_random_salt(), rounds=5000,
+        ),
+        vm_hostname=vm_hostname,
+        vm_static_ip_address=build.get('vm_static_ip_address'),
+        vm_ip_gateway=build.get('vm_ip_gateway'),
+        vm_ip_netmask=build.get('vm_ip_netmask'),
+        vm_dns_server_1=build.get('vm_dns_server_1'),
+        vm_dns_server_2=build.get('vm_dns_server_2'),
+    )
+    build['vm_seed_url'] = add_seed(server, [vm_hostname], user_data, meta_data)
+    return build['vm_seed_url']
+
+
+def stop_seed_server(server):
+    """
+    Stop a seed server and close its socket.
+    """
+    server.shutdown()
+    server.server_close()
+
+
+@contextlib.contextmanager
+def seed_server(url, build_options):
+    """
+    Serve the seeds of every build entry for the duration of the block.
+
+    Parameters
+    ----------
+    url : str
+        The URL the VMs reach this machine on, see `start_seed_server`.
+    build_options : list
+        A list of dictionaries containing build options, each given a `vm_seed_url`.
+
+    Yields
+    ------
+    ThreadingHTTPServer
+        The running server.
+    """
+    server = start_seed_server(url)
+    try:
+        for build in build_options:
+            add_build_seed(server, build)
+        yield server
+    finally:
+        stop_seed_server(server)
@@ -1,7 +1,27 @@
 import argparse
+import csv
+import json
 import os
-import subprocess
-from ipaddress import IPv4Network
+import sys
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+
+from cloud_init_seed.iso9660 import generate_cloud_init_iso
+from cloud_init_seed.iso9660 import write_cloud_init_iso
+from cloud_init_seed.password import sha512_crypt
+from cloud_init_seed.templates import render_cloud_init_templates
+
+# Columns of a generate_batch fleet file, besides vm_password / vm_hashed_password
+batch_required_fields = ('vm_username', 'vm_hostname')
+batch_optional_fields = (
+    'vm_static_ip_address', 'vm_ip_gateway', 'vm_ip_netmask',
+    'vm_dns_server_1', 'vm_dns_server_2', 'vm_nameserver', 'cloud_init_iso_name',
+)
+batch_formats = ('csv', 'json', 'jsonl')
+
+# Size of the reads of a streamed JSON array
+json_read_size = 64 * 1024
 
 
 def generate_cloud_init_files(
@@ -58,90 +78,192 @@ def generate_cloud_init_files(
     settings. The generated user data template is written to the specified `cloud_init_user_data_directory` file,
     while the metadata template containing only the hostname is written to the `cloud_init_meta_data_directory` file.
     """
-    # Convert netmask to desired notation.  dotted-decimal for ifcfg and CIDR for nmcli
-    if vm_ip_netmask is not None:
-        netmask_len = len(vm_ip_netmask.split('.'))
-        if netmask_len == 1 and len(vm_ip_netmask.split('/')) == 1:
-            vm_ip_netmask = f"/{vm_ip_netmask}"
-        if netmask_len == 4:
-            vm_ip_netmask = "/" + str(IPv4Network(f'0.0.0.0/{vm_ip_netmask}').prefixlen)
-    else:
-        vm_ip_netmask = ""
-
-    cloud_init_user_data_template = '''#cloud-config
-user: {}
-password: "{}"
-chpasswd: {{expire: False}}
-ssh_pwauth: True
-runcmd:
-- hostnamectl set-hostname {}
-'''.format(vm_username, vm_hashed_password, vm_hostname)
-
-    if vm_static_ip_address:
-        cloud_init_user_data_template += f"- set -x; nmcli connection modify eth0 ipv4.method manual ipv4.addresses '{vm_static_ip_address}{vm_ip_netmask}'\n"
-
-    if vm_ip_gateway:
-        cloud_init_user_data_template += f"- set -x; nmcli connection modify eth0 ipv4.gateway '{vm_ip_gateway}'\n"
-
-    if vm_dns_server_1:
-        cloud_init_user_data_template += (
-            f"- set -x; nmcli connection modify eth0 ipv4.dns '{vm_dns_server_1}'\n"
-        )
-
-    if vm_dns_server_2:
-        cloud_init_user_data_template += (
-            f"- set -x; nmcli connection modify eth0 +ipv4.dns '{vm_dns_server_2}'\n"
-        )
-
-    if vm_nameserver:
-            cloud_init_user_data_template += (
-                f"- set -x; nmcli connection modify eth0 ipv4.dns-search '{vm_nameserver}'\n"
-            )
-
-    # Restart the network to apply the changes
-    cloud_init_user_data_template += (
-        f"- set -x; if uname -a | grep el7; then systemctl restart network; else systemctl restart NetworkManager ; fi\n"
+    cloud_init_user_data_template, cloud_init_meta_data_template = render_cloud_init_templates(
+        vm_username, vm_hashed_password, vm_hostname, vm_static_ip_address, vm_ip_gateway,
+        vm_ip_netmask, vm_dns_server_1, vm_dns_server_2, vm_nameserver,
     )
 
     # Write the cloud_init_user_data_template to the specified output file
     with open(cloud_init_user_data_directory, 'w') as output_file:
         output_file.write(cloud_init_user_data_template)
 
-    cloud_init_meta_data_template = f'hostname: {vm_hostname}'
-
     # Write the cloud_init_meta_data_template to the specified output file
     with open(cloud_init_meta_data_directory, 'w') as output_file:
         output_file.write(cloud_init_meta_data_template)
 
 
-def generate_cloud_init_iso(cloud_init_iso_name, user_data_directory, meta_data_directory):
+def _iter_json_array(input_file):
+    """
+    Yield the items of a JSON array one at a time, reading the file in chunks.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    started = False
+    eof = False
+    while True:
+        buffer = buffer.lstrip()
+        if not started and buffer:
+            if buffer[0] != '[':
+                raise ValueError('A JSON fleet file must hold an array of objects')
+            buffer = buffer[1:].lstrip()
+            started = True
+        if started and buffer[:1] == ',':
+            buffer = buffer[1:].lstrip()
+        if started and buffer[:1] == ']':
+            return
+        if started and buffer:
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                yield item
+                buffer = buffer[end:]
+                continue
+        if eof:
+            raise ValueError('Unexpected end of the JSON fleet file')
+        chunk = input_file.read(json_read_size)
+        eof = not chunk
+        buffer += chunk
+
+
+def iter_fleet_rows(input_file, file_format):
     """
-    Generate a cloud-init ISO image.
+    Stream the rows of a fleet file.
 
     Parameters
     ----------
-    cloud_init_iso_name : str
-        The name of the cloud-init ISO image to generate.
-    user_data_directory : str
-        The directory containing the user data file.
-    meta_data_directory : str
-        The directory containing the metadata file.
+    input_file : TextIO
+        The open fleet file.
+    file_format : str
+        One of batch_formats: a CSV file with a header row, a JSON array of objects or one JSON object per line.
+
+    Yields
+    ------
+    dict or ValueError
+        The columns of a row, empty CSV cells left out, or the error of a JSONL line which could
+        not be decoded, reported for that row by `generate_batch`.
+    """
+    if file_format == 'csv':
+        for row in csv.DictReader(input_file):
+            yield {key: value for key, value in row.items() if key and value}
+    elif file_format == 'jsonl':
+        for line in input_file:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    yield e
+    else:
+        yield from _iter_json_array(input_file)
+
+
+def generate_batch_seed(row_number, row, output_directory):
+    """
+    Hash the password of a fleet row if needed, then render and write its cloud-init ISO.
+
+    Parameters
+    ----------
+    row_number : int
+        The number of the row in the fleet file, starting at 1.
+    row : dict
+        The columns of the row, see `iter_fleet_rows`.
+    output_directory : str
+        The directory the ISO is written to, unless the row holds an absolute cloud_init_iso_name.
 
     Returns
     -------
-    None
+    dict
+        The report of the row: row, vm_hostname, status ('ok' or 'failed'), iso and error.
 
     Notes
     -----
-    This function generates a cloud-init ISO image using the `genisoimage` command-line tool.
-    It combines the user data and metadata files from the specified directories into the ISO image.
-    The generated ISO image is saved with the provided `cloud_init_iso_name`.
+    Runs in the worker processes of `generate_batch`, errors are reported rather than raised so
+    that one bad row does not stop the batch. Passwords never appear in the report.
     """
-    command = [
-        'genisoimage', '-output', cloud_init_iso_name, '-volid',
-        'cidata', '-joliet', '-rock', user_data_directory, meta_data_directory,
-    ]
-    subprocess.run(command, capture_output=True, text=True)
+    report = {'row': row_number, 'vm_hostname': row.get('vm_hostname'), 'status': 'failed', 'iso': None, 'error': None}
+    try:
+        missing = [field for field in batch_required_fields if not row.get(field)]
+        if not row.get('vm_password') and not row.get('vm_hashed_password'):
+            missing.append('vm_password or vm_hashed_password')
+        if missing:
+            raise ValueError(f'Missing {", ".join(missing)}')
+
+        vm_hashed_password = row.get('vm_hashed_password') or sha512_crypt(row['vm_password'])
+        user_data, meta_data = render_cloud_init_templates(
+            row['vm_username'], vm_hashed_password, row['vm_hostname'],
+            *(row.get(field) for field in batch_optional_fields[:-1]),
+        )
+        iso_name = os.path.join(output_directory, row.get('cloud_init_iso_name') or f'{row["vm_hostname"]}.iso')
+        report['iso'] = write_cloud_init_iso(iso_name, user_data, meta_data)
+        report['status'] = 'ok'
+    except Exception as e:
+        report['error'] = f'{type(e).__name__}: {e}'
+    return report
+
+
+def generate_batch(input_file, file_format, output_directory, report_file, workers=None, window=None):
+    """
+    Generate the cloud-init ISOs of every row of a fleet file across a process pool.
+
+    Parameters
+    ----------
+    input_file : TextIO
+        The open fleet file, see `iter_fleet_rows`.
+    file_format : str
+        One of batch_formats.
+    output_directory : str
+        The directory the ISOs are written to.
+    report_file : TextIO
+        The file the report of each row is written to as a JSON line, in completion order.
+    workers : int, optional
+        The number of worker processes (default is None, the number of CPUs).
+    window : int, optional
+        The maximum number of rows read ahead of the workers (default is None, four per worker).
+
+    Returns
+    -------
+    Tuple[int, int]
+        The number of rows which succeeded and failed.
+
+    Notes
+    -----
+    Rows are submitted as the file is read and at most `window` are in flight, so the memory used
+    does not depend on the size of the fleet file.
+    """
+    workers = workers or os.cpu_count() or 1
+    window = window or workers * 4
+    os.makedirs(output_directory, exist_ok=True)
+    counts = {'ok': 0, 'failed': 0}
+
+    def write_report(report):
+        counts[report['status']] += 1
+        report_file.write(json.dumps(report) + '\n')
+
+    def drain(pending, return_when):
+        done, pending = wait(pending, return_when=return_when)
+        for future in done:
+            write_report(future.result())
+        report_file.flush()
+        return pending
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for row_number, row in enumerate(iter_fleet_rows(input_file, file_format), start=1):
+            if not isinstance(row, dict):
+                # A line which is not a JSON object fails its own row, not the batch
+                error = row if isinstance(row, Exception) else ValueError('A fleet row must be a JSON object')
+                write_report({
+                    'row': row_number, 'vm_hostname': None, 'status': 'failed', 'iso': None,
+                    'error': f'{type(error).__name__}: {error}',
+                })
+                continue
+            if len(pending) >= window:
+                pending = drain(pending, FIRST_COMPLETED)
+            pending.add(executor.submit(generate_batch_seed, row_number, row, output_directory))
+        drain(pending, 'ALL_COMPLETED')
+    return counts['ok'], counts['failed']
 
 
 def setup_arg_parser():
@@ -192,6 +314,29 @@ def setup_arg_parser():
         '--cloud_init_iso_name', required=True, help='Name of the cloud-init ISO image to generate',
     )
 
+    # Sub-parser for generating the cloud-init ISOs of a whole fleet
+    parser_generate_batch = subparsers.add_parser(
+        'generate_batch', help='Generate the cloud-init ISOs of every row of a CSV, JSON or JSONL fleet file',
+    )
+    parser_generate_batch.add_argument(
+        '--input', required=True, help='Fleet file, one row per VM with the columns of generate_cloud_init_iso and vm_password or vm_hashed_password',
+    )
+    parser_generate_batch.add_argument(
+        '--format', choices=batch_formats, help='Format of the fleet file, guessed from its extension by default',
+    )
+    parser_generate_batch.add_argument(
+        '--output_directory', default='.', help='Directory the ISOs are written to, named <vm_hostname>.iso unless the row sets cloud_init_iso_name',
+    )
+    parser_generate_batch.add_argument(
+        '--report', help='File the JSON line report of each row is written to, stdout by default',
+    )
+    parser_generate_batch.add_argument(
+        '--workers', type=int, help='Number of worker processes, the number of CPUs by default',
+    )
+    parser_generate_batch.add_argument(
+        '--window', type=int, help='Maximum number of rows in flight, four per worker by default',
+    )
+
     return parser
 
 
@@ -219,5 +364,21 @@ if __name__ == '__main__':
         generate_cloud_init_iso(
             args.cloud_init_iso_name, user_data_directory, meta_data_directory,
         )
+    elif args.command == 'generate_batch':
+        file_format = args.format or os.path.splitext(args.input)[1].lstrip('.').lower()
+        if file_format not in batch_formats:
+            parser.error(f'Cannot guess the format of {args.input}, use --format')
+
+        with open(args.input, newline='') as input_file:
+            report_file = open(args.report, 'w') if args.report else sys.stdout
+            try:
+                succeeded, failed = generate_batch(
+                    input_file, file_format, args.output_directory, report_file, args.workers, args.window,
+                )
+            finally:
+                if args.report:
+                    report_file.close()
+        print(f'{succeeded} seeds generated, {failed} failed', file=sys.stderr)
+        sys.exit(1 if failed else 0)
     else:
         print('Invalid command')